@@ -3,6 +3,8 @@ from bs4 import BeautifulSoup
 import re
 import os
 
+from kcourse.data import RaceInfoTable
+
 
 class FellRunner(object):
 
@@ -420,19 +422,25 @@ def build_race_info_table():
         for p_idx in p_idxs:
             print p_idx,
             r_idxs = fellrunner.get_race_ids(y_idx, p_idx)
-            for r_idx in r_idxs:
-                print '.',
-                if r_idx in rinfo_table:
-                    continue
-                try:
-                    rinfo = fellrunner.get_race_info(r_idx)
-                except BadRaceInfo:
-                    pass
-                except Exception:
-                    with open('error.log', 'a') as f_out:
-                        f_out.write('Error for race id: %s\n' % r_idx)
-                else:
-                    rinfo_table.add(r_idx, rinfo)
+            new_rinfos = []
+            try:
+                for r_idx in r_idxs:
+                    print '.',
+                    if r_idx in rinfo_table:
+                        continue
+                    try:
+                        rinfo = fellrunner.get_race_info(r_idx)
+                    except BadRaceInfo:
+                        pass
+                    except Exception:
+                        with open('error.log', 'a') as f_out:
+                            f_out.write('Error for race id: %s\n' % r_idx)
+                    else:
+                        new_rinfos.append((r_idx, rinfo))
+            finally:
+                # keep the races already fetched if the page is cut short,
+                # e.g. by a KeyboardInterrupt
+                rinfo_table.add_many(new_rinfos)
         print ''
 
 
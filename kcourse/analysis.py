@@ -1,24 +1,39 @@
 import re
 import os
+import time
+import multiprocessing
 from itertools import izip
 
-from kcourse.file_tools import (EmptyResultSet, DataFolder, ResultsFolder)
+import numpy
+import scipy.sparse
+import scipy.sparse.linalg
+
+from kcourse.domain import EmptyResultSet
+from kcourse.data import DataFolder, ResultsFolder
+from kcourse.components import (connected_components, group_by_label,
+                                MIN_COMPONENT_RACES)
+from kcourse.telemetry import FitTrace, maybe_phase
+from kcourse.uncertainty import theta_stderrs
+from kcourse.optimize import kminimize, OPTIMIZERS
+from kcourse.solvers import (logspace_system, logspace_solve, als_minimize,
+                             fill_new_params)
 
 
 def count_unique_runners():
-    runners = set()
     folder = 'results'
-    res_folder = ResultsFolder(folder)
-    for res_csv in res_folder.values():
-        runners.update(res_csv.runner_names())
-    return len(runners)
+    res_folder = ResultsFolder(folder).compile()
+    return len(res_folder.store.names)
 
 
-def process_results_collection(race_data_dicts):
+def process_results_collection(race_data_dicts, registry=None):
     """
     TODO: ITS HERE ITS HERE! IT MUST BE HERE!
     Args:
         race_data_dicts (Iter[RaceResultSet])
+        registry (RunnerRegistry): when given, every runner is registered
+            and the runners are numbered in registry id order, so that the
+            order is stable between runs. Only runners with results in
+            `race_data_dicts` are included either way.
 
     Returns:
         List[Dict[runner_id, runner_time]]
@@ -43,6 +58,15 @@ def process_results_collection(race_data_dicts):
         min2 = min(d.values())
         assert min1 == min2  # normed and un-normed must have the same winning time
 
+    if registry is not None:
+        ordered = registry.order(runners)
+        positions = dict((name, i) for i, name in enumerate(ordered))
+        new_index = [positions[name] for name in runners]
+        runners = ordered
+        normed_race_dicts = [dict((new_index[runner_id], runner_time)
+                                  for runner_id, runner_time in d.iteritems())
+                             for d in normed_race_dicts]
+
     return normed_race_dicts, runners
 
 
@@ -123,6 +147,125 @@ class Scorer(object):
         return runner_errs
 
 
+def races_to_coo(races):
+    """
+    Flattens a list of race dicts in to COO-style observation arrays.
+
+    Args:
+        races (List[Dict[int, int]]): For each race, a dict of
+            { runner_id: time_s }
+
+    Returns:
+        Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]: race index,
+            runner index and finish time for every observation
+    """
+    n_obs = sum(len(runners) for runners in races)
+    race_idx = numpy.empty(n_obs, dtype=numpy.intp)
+    runner_idx = numpy.empty(n_obs, dtype=numpy.intp)
+    times = numpy.empty(n_obs, dtype=float)
+
+    pos = 0
+    for race_id, runners in enumerate(races):
+        n = len(runners)
+        race_idx[pos:pos + n] = race_id
+        runner_idx[pos:pos + n] = runners.keys()
+        times[pos:pos + n] = runners.values()
+        pos += n
+    return race_idx, runner_idx, times
+
+
+class ArrayScorer(object):
+    """
+    Alternative to Scorer that holds the observations as flat arrays
+    (race index, runner index, time, winning time) and evaluates the
+    cost function and its gradients with numpy reductions.
+    """
+
+    def __init__(self, races, n_races, n_runners, winning_times):
+        race_idx, runner_idx, times = races_to_coo(races)
+        self._set_observations(race_idx, runner_idx, times, winning_times,
+                               n_races, n_runners)
+
+    @classmethod
+    def from_arrays(cls, race_idx, runner_idx, times, winning_times,
+                    n_races, n_runners):
+        scorer = cls.__new__(cls)
+        scorer._set_observations(race_idx, runner_idx, times, winning_times,
+                                 n_races, n_runners)
+        return scorer
+
+    def _set_observations(self, race_idx, runner_idx, times, winning_times,
+                          n_races, n_runners):
+        self.n_races = n_races
+        self.n_runners = n_runners
+        self.winning_times = numpy.asarray(winning_times, dtype=float)
+        self.race_idx = numpy.asarray(race_idx, dtype=numpy.intp)
+        self.runner_idx = numpy.asarray(runner_idx, dtype=numpy.intp)
+        self.times = numpy.asarray(times, dtype=float)
+        self.obs_winning_times = self.winning_times[self.race_idx]
+        self.count = len(self.times)
+
+    def unrolled_cost_function(self, params):
+        params = numpy.asarray(params, dtype=float)
+        race_scores = params[:self.n_races]
+        runner_scores = params[self.n_races:]
+
+        J, race_grads, runner_grads = self.cost_function(race_scores,
+                                                         runner_scores)
+        grads = numpy.concatenate((race_grads, runner_grads))
+        assert len(grads) == self.n_races + self.n_runners
+        return J, grads
+
+    def errors(self, race_scores, runner_scores):
+        d = numpy.asarray(race_scores, dtype=float)[self.race_idx]
+        h = numpy.asarray(runner_scores, dtype=float)[self.runner_idx]
+        prediction = d * h * self.obs_winning_times
+        err = (self.times - prediction) / self.times
+        return d, h, err
+
+    def cost_function(self, race_scores, runner_scores):
+        """
+        Args:
+            race_scores (Sequence[float]): list of race duration scores
+            runner_scores (Sequence[float]): list of runner handicap scores
+
+        Returns:
+            Tuple[float, numpy.ndarray, numpy.ndarray]
+        """
+        d, h, err = self.errors(race_scores, runner_scores)
+        J = 0.5 * numpy.dot(err, err)
+
+        scaled_err = err * self.obs_winning_times / self.times
+        runner_grads = -numpy.bincount(self.runner_idx,
+                                       weights=d * scaled_err,
+                                       minlength=self.n_runners)
+        race_grads = -numpy.bincount(self.race_idx,
+                                     weights=h * scaled_err,
+                                     minlength=self.n_races)
+
+        return J / self.count, race_grads / self.count, runner_grads / self.count
+
+    def race_errors(self, race_scores, runner_scores):
+        _, _, err = self.errors(race_scores, runner_scores)
+        J = numpy.bincount(self.race_idx, weights=0.5 * err**2,
+                           minlength=self.n_races)
+        counts = numpy.bincount(self.race_idx, minlength=self.n_races)
+        return J / counts
+
+    def runner_errors(self, race_scores, runner_scores):
+        _, _, err = self.errors(race_scores, runner_scores)
+        runner_errs = [{} for _ in xrange(self.n_runners)]
+        for race_id, runner_id, e in izip(self.race_idx, self.runner_idx, err):
+            runner_errs[runner_id][race_id] = e
+        return runner_errs
+
+
+SCORER_ENGINES = {
+    'python': Scorer,
+    'numpy': ArrayScorer,
+}
+
+
 def calc_avg_race_time(race_data):
     """
     Args:
@@ -135,17 +278,27 @@ def min_race_time(race_data):
     return min(race_data.values())
 
 
-def get_races_and_runners(data_folder, results_fpath):
-    folder = results_fpath
-    result_folder = ResultsFolder(folder)
+def iter_race_results(data_folder, results_fpath, processes=None,
+                      result_folder=None):
+    """
+    Streams the results that go in to the fit, one race at a time, in
+    result id order so that runner ids come out the same on every run.
+    Any results files that have changed since the last run are parsed on a
+    pool of `processes` worker processes first, unless an already compiled
+    `result_folder` is passed in.
+
+    Yields:
+        Tuple[str, Dict[str, int]]: result id and a mapping of runner
+            name -> finish time (in seconds)
+    """
+    if result_folder is None:
+        result_folder = ResultsFolder(results_fpath).compile(
+            processes=processes)
     result_to_race, _ = data_folder.result_to_race_index
     rinfo_table = data_folder.raceinfo  # used to check race names
     ignore_patterns = ['trunce']
 
-    race_dicts = []
-    race_ids = []
-
-    for result_id in result_to_race:
+    for result_id in sorted(result_to_race):
         race_id = result_to_race[result_id]  # TODO: use iteritems()
         race_name = rinfo_table[race_id].name
         for ig_patt in ignore_patterns:
@@ -160,29 +313,183 @@ def get_races_and_runners(data_folder, results_fpath):
         except EmptyResultSet:
             continue
 
+        yield result_id, race_data
+
+
+def get_races_and_runners(data_folder, results_fpath, processes=None):
+    race_dicts = []
+    race_ids = []
+
+    for result_id, race_data in iter_race_results(data_folder, results_fpath,
+                                                  processes):
         race_ids.append(result_id)
         race_dicts.append(race_data)
-    races, runners = process_results_collection(race_dicts)
+    registry = data_folder.runner_registry
+    races, runners = process_results_collection(race_dicts, registry)
+    registry.save()
     return races, runners, race_ids
 
 
-def create_scorer2(races, runners, winning_times):
-    scorer = Scorer(races, len(races), len(runners), winning_times)
+def create_scorer2(races, runners, winning_times, engine='python'):
+    scorer_cls = SCORER_ENGINES[engine]
+    scorer = scorer_cls(races, len(races), len(runners), winning_times)
     return scorer
 
 
-def create_scorer(data_folder, niters, J_logger_fn=None):
-    races, runners, race_ids = get_races_and_runners(data_folder, 'results')
-    winning_times = [min_race_time(r) for r in races]
-    runner_theta0 = [1.] * len(runners)
-    race_theta0 = [1.0 for _ in winning_times]
-    unrolled_params = race_theta0 + runner_theta0
+def as_array_scorer(scorer, races, runners, winning_times):
+    """
+    The direct solvers need the flat observation arrays, so reuse the scorer
+    if it already has them and build an ArrayScorer if not.
+    """
+    if isinstance(scorer, ArrayScorer):
+        return scorer
+    return create_scorer2(races, runners, winning_times, engine='numpy')
+
 
-    scorer = create_scorer2(races, runners, winning_times)
-    J, params = kminimize(scorer.unrolled_cost_function,
-                          unrolled_params, niters, J_logger_fn)
+def previous_theta0(data_folder, race_ids, runners):
+    """
+    Seeds the parameters from the race_theta.out and runner_theta.out files
+    written by the previous fit.
+
+    Returns:
+        Tuple[numpy.ndarray, numpy.ndarray]: race and runner thetas, with NaN
+            for any race or runner that wasn't part of the previous fit
+    """
+    try:
+        prev_race_theta = data_folder.read_race_theta()
+        prev_runner_theta = data_folder.read_runner_theta()
+    except IOError:
+        prev_race_theta, prev_runner_theta = {}, {}
+
+    nan = float('nan')
+    race_theta0 = numpy.array([prev_race_theta.get(r, nan) for r in race_ids])
+    runner_theta0 = numpy.array([prev_runner_theta.get(r, nan) for r in runners])
+    return race_theta0, runner_theta0
+
+
+def initial_params(init, scorer, races, runners, winning_times, race_ids,
+                   data_folder):
+    """
+    Returns the unrolled starting parameters for the fit, see create_scorer
+    for the choices of `init`.
+    """
+    if init == 'logspace':
+        obs = as_array_scorer(scorer, races, runners, winning_times)
+        race_theta0, runner_theta0 = logspace_solve(obs)
+        return list(race_theta0) + list(runner_theta0)
+    elif init == 'previous':
+        obs = as_array_scorer(scorer, races, runners, winning_times)
+        race_theta0, runner_theta0 = previous_theta0(data_folder, race_ids,
+                                                     runners)
+        race_theta0, runner_theta0 = fill_new_params(obs, race_theta0,
+                                                     runner_theta0)
+        return list(race_theta0) + list(runner_theta0)
+    else:
+        runner_theta0 = [1.] * len(runners)
+        race_theta0 = [1.0 for _ in winning_times]
+        return race_theta0 + runner_theta0
+
+
+def fit_params(scorer, races, runners, winning_times, unrolled_params,
+               niters, J_logger_fn=None, optimizer='descent', tol=None,
+               trace=None):
+    """
+    Runs the chosen optimizer from `unrolled_params` and returns the fitted
+    parameters.
+    """
+    if optimizer is None:
+        return unrolled_params
+    elif optimizer == 'als':
+        obs = as_array_scorer(scorer, races, runners, winning_times)
+        J, params = als_minimize(obs, unrolled_params, niters,
+                                 J_logger_fn, tol, trace=trace)
+    else:
+        minimize = OPTIMIZERS[optimizer]
+        J, params = minimize(scorer.unrolled_cost_function,
+                             unrolled_params, niters, J_logger_fn, tol,
+                             trace=trace)
+    return params
+
+
+def _fit_component(args):
+    """
+    Process pool worker: fits a single connected component.
+    """
+    (race_idx, runner_idx, times, winning_times, unrolled_params,
+     niters, optimizer, tol) = args
+    n_races = len(winning_times)
+    n_runners = len(unrolled_params) - n_races
+    scorer = ArrayScorer.from_arrays(race_idx, runner_idx, times,
+                                     winning_times, n_races, n_runners)
+    params = fit_params(scorer, None, None, None, unrolled_params, niters,
+                        optimizer=optimizer, tol=tol)
+    return numpy.asarray(params, dtype=float)
+
+
+def fit_by_component(scorer, unrolled_params, niters, optimizer='als',
+                     tol=None, processes=None):
+    """
+    Splits the observations in to connected components of the race/runner
+    graph and fits each component independently on a process pool.
 
-    n_races = len(races)
+    Args:
+        scorer (ArrayScorer)
+        processes (int): size of the process pool. None uses every core, 1
+            fits the components in this process.
+
+    Returns:
+        Tuple[List[float], numpy.ndarray, numpy.ndarray]: the merged fitted
+            parameters, the component label of every race, and the number
+            of races and runners in each component
+    """
+    race_labels, runner_labels, n_components = connected_components(
+        scorer.race_idx, scorer.runner_idx, scorer.n_races, scorer.n_runners)
+    race_groups = group_by_label(race_labels, n_components)
+    runner_groups = group_by_label(runner_labels, n_components)
+    obs_groups = group_by_label(race_labels[scorer.race_idx], n_components)
+
+    # maps from global to component-local race/runner indices
+    race_local = numpy.empty(scorer.n_races, dtype=numpy.intp)
+    runner_local = numpy.empty(scorer.n_runners, dtype=numpy.intp)
+    unrolled_params = numpy.asarray(unrolled_params, dtype=float)
+    tasks = []
+    for races_c, runners_c, obs_c in izip(race_groups, runner_groups,
+                                          obs_groups):
+        race_local[races_c] = numpy.arange(len(races_c))
+        runner_local[runners_c] = numpy.arange(len(runners_c))
+        params0 = numpy.concatenate((
+            unrolled_params[races_c],
+            unrolled_params[scorer.n_races + runners_c]))
+        tasks.append((race_local[scorer.race_idx[obs_c]],
+                      runner_local[scorer.runner_idx[obs_c]],
+                      scorer.times[obs_c],
+                      scorer.winning_times[races_c],
+                      params0, niters, optimizer, tol))
+
+    if processes == 1:
+        results = map(_fit_component, tasks)
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_fit_component, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    params = unrolled_params.copy()
+    for races_c, runners_c, params_c in izip(race_groups, runner_groups,
+                                             results):
+        params[races_c] = params_c[:len(races_c)]
+        params[scorer.n_races + runners_c] = params_c[len(races_c):]
+
+    sizes = numpy.array([(len(races_c), len(runners_c)) for races_c, runners_c
+                         in izip(race_groups, runner_groups)])
+    return list(params), race_labels, sizes
+
+
+def write_fit_outputs(data_folder, scorer, race_ids, runners, winning_times,
+                      params):
+    n_races = len(race_ids)
     n_runners = len(runners)
     race_theta = [params[i] for i in xrange(n_races)]
     runner_theta = [params[i + n_races] for
@@ -190,55 +497,282 @@ def create_scorer(data_folder, niters, J_logger_fn=None):
 
     J3, _ = scorer.unrolled_cost_function(params)
     J2, _, _ = scorer.cost_function(race_theta, runner_theta)
-    assert J3 == J2, 'Error: %f != %f' % (J, J2)
+    assert J3 == J2, 'Error: %f != %f' % (J3, J2)
+
+    race_errs = list(scorer.race_errors(race_theta, runner_theta))
+    runner_errs = scorer.runner_errors(race_theta, runner_theta)
+    avg_errs = [sum([e**2 for e in x.values()]) / len(x) for x in runner_errs]
+    num_races = [len(x) for x in runner_errs]
 
-    # Write a bunch of stuff back out to the output folder
-    data_folder.write_winning_times(race_ids, winning_times)
-    data_folder.write_runner_theta(runners, runner_theta)
-    data_folder.write_sorted_runner_theta(runners, runner_theta)
-    data_folder.write_race_theta(race_ids, race_theta)
+    data_folder.write_fit(race_ids, runners, race_theta, runner_theta,
+                          winning_times, race_errs, avg_errs, num_races,
+                          meta={'J': J2})
 
-    race_errs = scorer.race_errors(race_theta, runner_theta)
-    data_folder.write_race_errors(race_ids, race_errs)
 
-    runner_errs = scorer.runner_errors(race_theta, runner_theta)
-    data_folder.write_runner_errs(runners, runner_errs)
+def write_theta_stderrs(data_folder, scorer, race_ids, runners, params):
+    """
+    Works out the standard errors of the fitted thetas and writes them out
+    next to the thetas themselves.
+    """
+    n_races = len(race_ids)
+    race_theta = numpy.asarray(params[:n_races], dtype=float)
+    runner_theta = numpy.asarray(params[n_races:], dtype=float)
+    race_stderr, runner_stderr = theta_stderrs(scorer, race_theta,
+                                               runner_theta)
+    data_folder.write_race_theta_stderr(race_ids, race_theta, race_stderr)
+    data_folder.write_runner_theta_stderr(runners, runner_theta,
+                                          runner_stderr)
+
+
+def create_scorer(data_folder, niters, J_logger_fn=None, engine='python',
+                  optimizer='descent', tol=None, init='ones',
+                  by_component=False, processes=None, trace=None,
+                  uncertainty=False):
+    """
+    Fits the standard runner model to everything in the results folder and
+    writes the fitted parameters out to the data folder.
 
+    Args:
+        data_folder (DataFolder)
+        niters (int): maximum number of optimizer iterations
+        J_logger_fn (Callable[[float], None]): called once per iteration
+            with J. `trace` gets the gradient norm as well.
+        engine (str): key in to SCORER_ENGINES
+        optimizer (str): key in to OPTIMIZERS, 'als' for alternating
+            closed-form race/runner updates, or None to skip the
+            iterative fit
+        tol (float): stop once the relative change in J falls below this
+        init (str): where to start the fit from
+            'ones': every theta starts at 1.0
+            'logspace': the direct log-space least squares solution, as a
+                warm start only. It isn't a solver in its own right: its J
+                is far worse than the iterative fit's, so don't use it with
+                optimizer=None except to inspect it.
+            'previous': the thetas written by the last fit, with only the
+                races and runners that are new since then initialised
+                from scratch
+        by_component (bool): fit each connected component of the
+            race/runner graph separately on a pool of `processes` worker
+            processes. J_logger_fn isn't called in this mode. Components
+            are written out to components.out, with the ones with fewer
+            than MIN_COMPONENT_RACES races flagged as untrusted.
+        processes (int): size of the process pool used to parse new results
+            files and, with by_component, to fit the components
+        trace (FitTrace): records per-iteration telemetry and the time
+            taken by each phase of the fit
+        uncertainty (bool): also write out approximate standard errors for
+            every theta, see kcourse.uncertainty
+    """
+    with maybe_phase(trace, 'ingest'):
+        races, runners, race_ids = get_races_and_runners(data_folder,
+                                                         'results', processes)
+    with maybe_phase(trace, 'index'):
+        winning_times = [min_race_time(r) for r in races]
+        scorer = create_scorer2(races, runners, winning_times, engine)
+
+    with maybe_phase(trace, 'init'):
+        unrolled_params = initial_params(init, scorer, races, runners,
+                                         winning_times, race_ids, data_folder)
+    with maybe_phase(trace, 'fit'):
+        if by_component:
+            obs = as_array_scorer(scorer, races, runners, winning_times)
+            params, race_labels, sizes = fit_by_component(
+                obs, unrolled_params, niters, optimizer, tol, processes)
+            trusted = sizes[:, 0] >= MIN_COMPONENT_RACES
+            data_folder.write_components(race_ids, race_labels, sizes, trusted)
+        else:
+            params = fit_params(scorer, races, runners, winning_times,
+                                unrolled_params, niters, J_logger_fn,
+                                optimizer, tol, trace)
+    with maybe_phase(trace, 'output'):
+        write_fit_outputs(data_folder, scorer, race_ids, runners,
+                          winning_times, params)
+    if uncertainty:
+        with maybe_phase(trace, 'uncertainty'):
+            obs = as_array_scorer(scorer, races, runners, winning_times)
+            write_theta_stderrs(data_folder, obs, race_ids, runners, params)
+
+
+def warm_start_report(data_folder, niters, tol, engine='numpy',
+                      optimizer='lbfgs'):
+    """
+    Refits the model starting from the previous fit's outputs, and again
+    from scratch, and prints how many iterations and how much wall time
+    the warm start saved. The warm-started fit is written out.
 
-def kminimize(fun, initial_params, niters, J_logger_fn=None):
-    if J_logger_fn is None:
-        J_logger_fn = lambda x: None
+    Returns:
+        Dict[str, Dict[str, float]]: iterations, time and J for the 'cold'
+            and 'warm' fits
+    """
+    races, runners, race_ids = get_races_and_runners(data_folder, 'results')
+    winning_times = [min_race_time(r) for r in races]
+    scorer = create_scorer2(races, runners, winning_times, engine)
+
+    report = {}
+    fits = {}
+    for init, label in [('previous', 'warm'), ('ones', 'cold')]:
+        J_vals = []
+        start_time = time.time()
+        unrolled_params = initial_params(init, scorer, races, runners,
+                                         winning_times, race_ids, data_folder)
+        params = fit_params(scorer, races, runners, winning_times,
+                            unrolled_params, niters,
+                            J_vals.append,
+                            optimizer, tol)
+        J, _ = scorer.unrolled_cost_function(params)
+        report[label] = {
+            'iterations': len(J_vals),
+            'time': time.time() - start_time,
+            'J': J,
+        }
+        fits[label] = params
+
+    write_fit_outputs(data_folder, scorer, race_ids, runners, winning_times,
+                      fits['warm'])
+
+    cold, warm = report['cold'], report['warm']
+    print 'cold start: %i iterations, %.2fs, J=%f' % (cold['iterations'],
+                                                       cold['time'], cold['J'])
+    print 'warm start: %i iterations, %.2fs, J=%f' % (warm['iterations'],
+                                                       warm['time'], warm['J'])
+    print 'saved: %i iterations, %.2fs' % (cold['iterations'] - warm['iterations'],
+                                           cold['time'] - warm['time'])
+    return report
+
+
+def race_seasons(data_folder, race_ids):
+    """
+    Returns:
+        List[int]: the year that each result was run in
+    """
+    result_to_race, _ = data_folder.result_to_race_index
+    rinfo_table = data_folder.raceinfo
+    seasons = []
+    for result_id in race_ids:
+        datestr = rinfo_table[result_to_race[result_id]].date  # YYYY-MM-DD
+        seasons.append(int(datestr.split('-')[0]))
+    return seasons
 
-    n = len(initial_params)
-    print 'n:', n
-    alpha = 1000.
-    print 'alpha:', alpha
 
-    params = initial_params[:]
-    i_iter = 0
-    J = 0
-    while True:
-        #print 'Iteration: %i' % i_iter
-        if i_iter > niters:
-            break
-        i_iter += 1
-        J0 = J
-        J, grads = fun(params)
-        J_logger_fn(J)
-        if i_iter > 1:
-            rel_change = (J - J0) / J0
-            if rel_change > 1.1:
-                raise Exception("Convergence is exploding - reduce learning rate: %f" % alpha)
+def seasonal_cost_function(pair_scorer, lo, hi, weights):
+    """
+    Cost function for fit_seasonal_runner_model, over the logs of the race
+    and (runner, season) thetas: the relative error cost of `pair_scorer`
+    plus the smoothness penalty
+        sum(weights * (log h[hi] - log h[lo])**2) / (2 * count)
+    which is on the same scale as J (whose 0.5 * err**2 per result is
+    divided by the number of results).
+
+    Returns:
+        Callable[[numpy.ndarray], Tuple[float, numpy.ndarray]]
+    """
+    n_races = pair_scorer.n_races
+    norm = 2. * pair_scorer.count
+
+    def fun(log_params):
+        params = numpy.exp(log_params)
+        J, grads = pair_scorer.unrolled_cost_function(params)
+        grads = grads * params  # chain rule for the log parameters
+        diff = log_params[n_races + hi] - log_params[n_races + lo]
+        J += numpy.dot(weights, diff**2) / norm
+        pen_grads = 2. * weights * diff / norm
+        grads[n_races + hi] += pen_grads
+        grads[n_races + lo] -= pen_grads
+        return J, grads
+    return fun
 
-        for i, grad in enumerate(grads):
-            p = params[i]
-            p2 = p - alpha * grad
-            params[i] = p2
 
+def fit_seasonal_runner_model(scorer, seasons, smoothness=1.0, tol=1e-8,
+                              niters=5000):
+    """
+    Fits a variant of the standard runner model where each runner gets a
+    separate score for every season they raced in, rather than a single
+    score for their whole career.
+
+    Parameters only exist for the (runner, season) pairs that actually have
+    results. The fit minimises the same relative error cost as the standard
+    model plus a penalty on each runner's change in form between
+    consecutive seasons,
+        smoothness / gap * (log h[runner, season2] - log h[runner, season1])**2
+    where gap is the number of seasons between them (see
+    seasonal_cost_function for the scaling). Large values of `smoothness`
+    tie each runner to a single score; small values let their form change
+    freely from one season to the next. Because a single score for every
+    season costs no penalty, the fitted J is never worse than the standard
+    model's.
+
+    The log-space least squares problem of solvers.logspace_system (with
+    the penalty as extra rows) is solved first, but only as the starting
+    point for L-BFGS.
+
+    Args:
+        scorer (ArrayScorer)
+        seasons (List[int]): season of each race
+        smoothness (float)
+        tol (float): tolerance of the log-space solve, and the relative
+            change in cost that stops the L-BFGS fit
+        niters (int): maximum number of L-BFGS iterations
 
-    return J, params
+    Returns:
+        Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+            race thetas, and for every (runner, season) pair the runner id,
+            season and theta
+    """
+    seasons = numpy.asarray(seasons)
+    uniq_seasons, race_season_idx = numpy.unique(seasons, return_inverse=True)
+    n_seasons = len(uniq_seasons)
+
+    # the (runner, season) pairs, sorted by runner and then by season
+    obs_keys = (scorer.runner_idx * n_seasons +
+                race_season_idx[scorer.race_idx])
+    pair_keys, obs_pair = numpy.unique(obs_keys, return_inverse=True)
+    pair_runner = pair_keys // n_seasons
+    pair_season = uniq_seasons[pair_keys % n_seasons]
+    n_pairs = len(pair_keys)
+
+    pair_scorer = ArrayScorer.from_arrays(scorer.race_idx, obs_pair,
+                                          scorer.times, scorer.winning_times,
+                                          scorer.n_races, n_pairs)
+    A, b = logspace_system(pair_scorer)
+
+    lo = numpy.flatnonzero(pair_runner[1:] == pair_runner[:-1])
+    hi = lo + 1
+    gaps = (pair_season[hi] - pair_season[lo]).astype(float)
+    weights = numpy.sqrt(smoothness / gaps)
+    n_pen = len(lo)
+    penalty = scipy.sparse.csr_matrix(
+        (numpy.concatenate((weights, -weights)),
+         (numpy.tile(numpy.arange(n_pen), 2),
+          scorer.n_races + numpy.concatenate((hi, lo)))),
+        shape=(n_pen, scorer.n_races + n_pairs))
+
+    A = scipy.sparse.vstack((A, penalty)).tocsr()
+    b = numpy.concatenate((b, numpy.zeros(n_pen)))
+    x0 = scipy.sparse.linalg.lsqr(A, b, atol=tol, btol=tol)[0]
+
+    fun = seasonal_cost_function(pair_scorer, lo, hi, weights**2)
+    _, x = OPTIMIZERS['lbfgs'](fun, x0, niters, tol=tol)
+    thetas = numpy.exp(x)
+    return (thetas[:scorer.n_races], pair_runner, pair_season,
+            thetas[scorer.n_races:])
+
+
+def create_seasonal_scorer(data_folder, smoothness=1.0):
+    """
+    Fits the per-season runner model to everything in the results folder
+    and writes seasonal_race_theta.out and runner_season_theta.out.
+    """
+    races, runners, race_ids = get_races_and_runners(data_folder, 'results')
+    winning_times = [min_race_time(r) for r in races]
+    scorer = create_scorer2(races, runners, winning_times, engine='numpy')
+    seasons = race_seasons(data_folder, race_ids)
 
+    race_theta, pair_runner, pair_season, pair_theta = \
+        fit_seasonal_runner_model(scorer, seasons, smoothness)
 
+    data_folder.write_seasonal_race_theta(race_ids, race_theta)
+    data_folder.write_runner_season_theta(
+        [runners[r] for r in pair_runner], pair_season, pair_theta)
 
 
 if __name__ == '__main__':
@@ -253,7 +787,10 @@ if __name__ == '__main__':
     #import time
     #start_time = time.time()
     data_folder = DataFolder('data')
-    create_scorer(data_folder, niters=50, J_logger_fn=J_logger)
+    with FitTrace(os.path.join('data', 'fit_trace.jsonl')) as trace:
+        create_scorer(data_folder, niters=50, J_logger_fn=J_logger,
+                      trace=trace)
+    data_folder.write_fit_tsvs()
     print '\n'.join(map(str, J_vals))
     #print 'Elapsed time: %f' % (time.time() - start_time)
 
@@ -1,55 +1,274 @@
-from flask import Flask, request, jsonify, make_response, url_for
+import os
+
+from flask import Flask, request, jsonify, url_for, abort, send_file
 from kcourse.data import DataFolder, ResultsFolder
+from kcourse.parse_cache import PARSE_CACHE
+from kcourse.runner_index import LiveRunnerIndex, DEFAULT_SEARCH_LIMIT
 from scripts.runner_lookup import build_runner_index
 
 
-def make_app():
-    data_folder = DataFolder('data')
-    result_folder = ResultsFolder('results')
+MAX_SEARCH_LIMIT = 100
+# shorter queries match too much of the index to be useful
+MIN_QUERY_LENGTH = 2
+SEARCH_MODES = ('search', 'prefix', 'fuzzy')
+# most runners or races one batch request may ask for
+MAX_BATCH_SIZE = 100
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
 
-    result_to_race, race_to_result = data_folder.result_to_race_index
-    runner_index = build_runner_index(data_folder, result_folder)
 
-    app = Flask(__name__)
+def requested_list(key):
+    """
+    The items asked for by a batch request, either as repeated query
+    parameters (?name=a&name=b) or, for a POST, a JSON body of
+    {"<key>s": [...]}. Aborts with a 400 if there are none or too many.
+
+    Returns:
+        List[unicode]
+    """
+    if request.method == 'POST':
+        body = request.get_json(silent=True) or {}
+        items = body.get(key + 's')
+        if not isinstance(items, list):
+            abort(400)
+    else:
+        items = request.args.getlist(key)
+    if not items or len(items) > MAX_BATCH_SIZE:
+        abort(400)
+    return [unicode(item) for item in items]
 
-    @app.route('/api/runners/<name>')
-    def hello(name):
-        print name
-        runner_results = runner_index[name.lower()]
 
-        data = {
+def requested_page():
+    """
+    Returns:
+        Tuple[int, int]: offset and limit asked for by the request's
+            ?offset= and ?limit= parameters, clipped to sensible values
+    """
+    offset = max(0, request.args.get('offset', 0, type=int))
+    limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+    return offset, max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def make_app(data_fpath='data', results_fpath='results', background=True,
+             check_interval=30.):
+    """
+    Args:
+        background (bool): serve the last runner index snapshot straight
+            away and keep it up to date from a background thread. If False
+            the index is brought up to date before returning.
+        check_interval (float): seconds between checks for new data
+    """
+    data_folder = DataFolder(data_fpath)
+    result_folder = ResultsFolder(results_fpath)
+
+    runner_index = LiveRunnerIndex(data_fpath, results_fpath,
+                                   build_runner_index, check_interval)
+    if background:
+        runner_index.start()
+    else:
+        runner_index.refresh()
+
+    app = Flask(__name__)
+    app.runner_index = runner_index
+
+    def runner_json(name, registry):
+        """
+        Returns:
+            Dict: the runner's id and results, or None if there's no runner
+                called `name`
+        """
+        key = name.lower().encode('utf-8')
+        runner_results = runner_index.get(key)
+        if runner_results is None:
+            return None
+        return {
             'runner': name,
+            'id': registry.get(key),
             'results': [r.to_json() for r in runner_results]
         }
 
+    def race_json(race_id, rinfo_table, race_to_result):
+        """
+        Returns:
+            Dict: the race's info and where to find its results, or None if
+                there's no race `race_id`
+        """
+        if race_id not in rinfo_table:
+            return None
+        data = rinfo_table[race_id].to_json()
+        data['id'] = race_id
+
+        if race_id in race_to_result:
+            result_id = race_to_result[race_id]
+            result_url = '/api/results/' + result_id
+            data['result_id'] = result_id
+            data['result_url'] = result_url
+        return data
+
+    @app.route('/api/runners/<name>')
+    def hello(name):
+        data = runner_json(name, data_folder.runner_registry)
+        if data is None:
+            abort(404)
         return jsonify(data)
 
+    @app.route('/api/runners', methods=['GET', 'POST'])
+    def runners_batch():
+        """
+        ?name=<name>&name=<name>... or POST {"names": [...]}
+        """
+        registry = data_folder.runner_registry
+        found, missing = [], []
+        for name in requested_list('name'):
+            data = runner_json(name, registry)
+            if data is None:
+                missing.append(name)
+            else:
+                found.append(data)
+        return jsonify({'runners': found, 'missing': missing})
+
+    @app.route('/api/runners/id/<int:runner_id>')
+    def runner_by_id(runner_id):
+        registry = data_folder.runner_registry
+        if not 0 <= runner_id < len(registry):
+            abort(404)
+        return hello(registry[runner_id].decode('utf-8'))
+
+    @app.route('/api/search')
+    def search():
+        """
+        ?q=<name>[&limit=<n>][&mode=search|prefix|fuzzy]
+        """
+        query = request.args.get('q', '').strip().lower()
+        limit = request.args.get('limit', DEFAULT_SEARCH_LIMIT, type=int)
+        mode = request.args.get('mode', 'search')
+        if len(query) < MIN_QUERY_LENGTH or mode not in SEARCH_MODES:
+            abort(400)
+        # names in the index are utf-8 byte strings
+        query = query.encode('utf-8')
+        limit = max(1, min(limit, MAX_SEARCH_LIMIT))
+
+        registry = data_folder.runner_registry
+        matches = runner_index.search(query, limit, mode)
+        return jsonify({
+            'query': query,
+            'mode': mode,
+            'matches': [{'runner': name, 'id': registry.get(name),
+                         'races': races, 'score': score,
+                         'url': url_for('hello', name=name)}
+                        for name, races, score in matches]
+        })
+
     @app.route('/api/races/<race_id>')
     def races(race_id):
         # race_id = request.args.get('id')
         assert race_id
+        _, race_to_result = data_folder.result_to_race_index
+        data = race_json(race_id, data_folder.raceinfo, race_to_result)
+        if data is None:
+            abort(404)
+        return jsonify(data)
+
+    @app.route('/api/races', methods=['GET', 'POST'])
+    def races_batch():
+        """
+        ?id=<race_id>&id=<race_id>... or POST {"ids": [...]}
+        """
         rinfo_table = data_folder.raceinfo
-        rinfo = rinfo_table[race_id]
-        data = rinfo.to_json()
-        data['id'] = race_id
+        _, race_to_result = data_folder.result_to_race_index
+        found, missing = [], []
+        for race_id in requested_list('id'):
+            data = race_json(race_id.encode('utf-8'), rinfo_table,
+                             race_to_result)
+            if data is None:
+                missing.append(race_id)
+            else:
+                found.append(data)
+        return jsonify({'races': found, 'missing': missing})
 
-        if race_id in race_to_result:
-            result_id = race_to_result[race_id]
-            result_url = '/api/results/' + result_id
-            data['result_id'] = result_id
-            data['result_url'] = result_url
+    @app.route('/api/races/<race_id>/results')
+    def race_results(race_id):
+        """
+        The race, and a page of its finishers with their scores.
+        ?offset=<n>&limit=<n>
+
+        The finishers come from the compiled store the runner index was
+        built from, so they're only parsed once per rebuild and agree with
+        the runner pages.
+        """
+        _, race_to_result = data_folder.result_to_race_index
+        data = race_json(race_id, data_folder.raceinfo, race_to_result)
+        if data is None or race_id not in race_to_result:
+            abort(404)
+        result_id = race_to_result[race_id]
+        store = runner_index.store
+        if result_id not in store:
+            abort(404)
+        sl = store.file_slice(result_id)
+        times = store.times[sl]
+        num_finishers = len(times)
+        if not num_finishers:
+            abort(404)
+
+        race_theta = data_folder.read_race_theta().get(result_id)
+        std_time = (int(times.min()) * race_theta
+                    if race_theta is not None else None)
+        registry = data_folder.runner_registry
+        offset, limit = requested_page()
+        page = slice(offset, offset + limit)
+        finishers = []
+        for i, (name_id, time) in enumerate(zip(
+                store.name_ids[sl][page].tolist(), times[page].tolist())):
+            name = store.names[name_id]
+            finishers.append({
+                'position': offset + i,
+                'runner': name,
+                'id': registry.get(name),
+                'time': time,
+                'score': 1.0 * time / std_time if std_time else None,
+            })
+
+        data['finishers'] = num_finishers
+        data['offset'] = offset
+        data['limit'] = limit
+        data['results'] = finishers
+        data['next'] = None
+        if offset + limit < num_finishers:
+            data['next'] = url_for('race_results', race_id=race_id,
+                                   offset=offset + limit, limit=limit)
         return jsonify(data)
 
     @app.route('/api/results/<result_id>')
     def results(result_id):
         # result_id = request.args.get('id')
         assert result_id
-        csv_sio = result_folder[result_id].raw_csv()
-        output = make_response(csv_sio.getvalue())
-        output.headers["Content-Disposition"] = "attachment; filename=%s.csv" % result_id
-        output.headers["Content-type"] = "text/csv"
+        if result_id not in result_folder:
+            abort(404)
+        # send_file serves the file itself (by sendfile where the server
+        # supports it) and, being conditional, answers If-None-Match,
+        # If-Modified-Since and Range requests
+        f = result_folder[result_id].path
+        gzip_f = None
+        if request.accept_encodings['gzip']:
+            gzip_f = result_folder.gzip_path(result_id)
+        output = send_file(os.path.abspath(gzip_f or f), mimetype='text/csv',
+                           as_attachment=True,
+                           attachment_filename=result_id + '.csv',
+                           conditional=True)
+        if gzip_f:
+            output.headers['Content-Encoding'] = 'gzip'
+        output.vary.add('Accept-Encoding')
         return output
 
+    @app.route('/api/status')
+    def status():
+        return jsonify({'runner_index': runner_index.status()})
+
+    @app.route('/api/cache')
+    def cache_info():
+        return jsonify({'data_folder': data_folder.cache_info(),
+                        'parse_cache': PARSE_CACHE.stats()})
+
     return app
 
 
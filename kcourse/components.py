@@ -0,0 +1,74 @@
+"""
+Splits the race/runner graph in to connected components.
+
+Races are linked whenever they share a runner. Races in different
+components have no runners in common, so their thetas can be fitted
+independently, but their scales can't be compared with each other.
+"""
+from itertools import izip
+
+import numpy
+
+# Components with fewer races than this can't be put on the same scale as
+# the rest of the data with any confidence
+MIN_COMPONENT_RACES = 5
+
+
+class UnionFind(object):
+
+    def __init__(self, n):
+        self._parent = range(n)
+        self._size = [1] * n
+
+    def find(self, x):
+        parent = self._parent
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    def union(self, a, b):
+        a = self.find(a)
+        b = self.find(b)
+        if a == b:
+            return
+        if self._size[a] < self._size[b]:
+            a, b = b, a
+        self._parent[b] = a
+        self._size[a] += self._size[b]
+
+
+def connected_components(race_idx, runner_idx, n_races, n_runners):
+    """
+    Labels every race and runner with the connected component it belongs
+    to. Components are numbered from 0 in decreasing order of their number
+    of races, so the main body of the data is always component 0.
+
+    Returns:
+        Tuple[numpy.ndarray, numpy.ndarray, int]: race labels, runner labels
+            and the number of components
+    """
+    uf = UnionFind(n_races + n_runners)
+    for race_id, runner_id in izip(race_idx.tolist(), runner_idx.tolist()):
+        uf.union(race_id, n_races + runner_id)
+
+    roots = numpy.array([uf.find(i) for i in xrange(n_races + n_runners)])
+    uniq_roots, labels = numpy.unique(roots, return_inverse=True)
+
+    race_counts = numpy.bincount(labels[:n_races], minlength=len(uniq_roots))
+    order = numpy.argsort(-race_counts, kind='mergesort')
+    relabel = numpy.empty_like(order)
+    relabel[order] = numpy.arange(len(order))
+    labels = relabel[labels]
+    return labels[:n_races], labels[n_races:], len(uniq_roots)
+
+
+def group_by_label(labels, n_labels):
+    """
+    Returns:
+        List[numpy.ndarray]: for each label, the (sorted) indices that
+            carry it
+    """
+    order = numpy.argsort(labels, kind='mergesort')
+    counts = numpy.bincount(labels, minlength=n_labels)
+    return numpy.split(order, numpy.cumsum(counts)[:-1])
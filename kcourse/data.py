@@ -1,13 +1,38 @@
+import bisect
+import gzip
 import os
+import shutil
 from itertools import izip
-import cStringIO as StringIO
 
-from kcourse.domain import RaceInfo, ResultItem, RaceResultSet, RetiredRunner, BadName
-from kcourse.file_tools import read_result_to_race_index, munge_line, read_results_file
+import numpy
+
+from kcourse.domain import RaceInfo, RaceResultSet, EmptyResultSet
+from kcourse.file_tools import read_result_to_race_index, iter_results_rows
+from kcourse.parse_cache import PARSE_CACHE
+from kcourse.registry import RunnerRegistry
+from kcourse.snapshot import Snapshot, write_snapshot
+from kcourse.store import ResultsStore
+
+
+FIT_SNAPSHOT = 'fit.snap'
+# files smaller than this aren't worth precompressing
+GZIP_MIN_SIZE = 1024
+
+
+def file_stat(f):
+    """
+    Returns:
+        Tuple[float, int]: modification time and size of the file, which
+            change whenever the file is written to
+    """
+    st = os.stat(f)
+    return st.st_mtime, st.st_size
 
 
 class RaceInfoTable(object):
 
+    _cache = {}
+
     def __init__(self, f):
         if not os.path.exists(f):
             with open(f, 'w') as f_out:
@@ -18,22 +43,95 @@ class RaceInfoTable(object):
         with open(f) as f_in:
             next(f_in) # throw away header
             for line in f_in:
-                try:
-                    idx, name, datestr, dist_km, climb_m = line.strip().split('\t')
-                    datestr = normalise_date(datestr)
+                self._add_line(line)
+        self._stat = file_stat(f)
+        self._by_date = None
+        self._by_name = None
 
-                except ValueError:
-                    raise ValueError('Bad line: %s' % line)
-                self._data[idx] = idx, name, datestr, dist_km, climb_m
+    @classmethod
+    def cached(cls, f):
+        """
+        The table for `f`, only re-reading the file if its mtime or size
+        have changed since it was last read.
+        """
+        key = os.path.abspath(f)
+        table = cls._cache.get(key)
+        if table is None or not os.path.exists(f) or \
+                table._stat != file_stat(f):
+            table = cls._cache[key] = cls(f)
+        return table
+
+    def _add_line(self, line):
+        try:
+            idx, name, datestr, dist_km, climb_m = line.strip().split('\t')
+            datestr = normalise_date(datestr)
+
+        except ValueError:
+            raise ValueError('Bad line: %s' % line)
+        self._data[idx] = idx, name, datestr, dist_km, climb_m
+        return idx
 
     def __contains__(self, idx):
-        return idx in self._indices
+        return idx in self._data
+
+    def __len__(self):
+        return len(self._data)
 
     def add(self, idx, race_info):
-        with open(self._f, 'a') as f_a:
+        self.add_many([(idx, race_info)])
+
+    def add_many(self, race_infos):
+        """
+        Appends many races to the table file in one write, and adds them to
+        the in-memory table and its indexes.
+
+        Args:
+            race_infos (Iterable[Tuple[str, RaceInfo]]): race id and info
+        """
+        lines = []
+        for idx, race_info in race_infos:
             date_str = '-'.join(map(str, race_info.date))
-            f_a.write('%s\t%s\t%s\t%s\t%s\n' % (idx, race_info.name.encode('utf8'), date_str,
-                                                race_info.distance_km, race_info.climb_m))
+            lines.append('%s\t%s\t%s\t%s\t%s\n' % (idx, race_info.name.encode('utf8'), date_str,
+                                                   race_info.distance_km, race_info.climb_m))
+        with open(self._f, 'a') as f_a:
+            f_a.write(''.join(lines))
+        self._stat = file_stat(self._f)
+
+        for line in lines:
+            idx = self._add_line(line)
+            _, name, datestr, _, _ = self._data[idx]
+            if self._by_date is not None:
+                bisect.insort(self._by_date, (datestr, idx))
+            if self._by_name is not None:
+                self._by_name.setdefault(name.lower(), []).append(idx)
+
+    def races_between(self, start_date, end_date):
+        """
+        Args:
+            start_date (str): YYYY-MM-DD
+            end_date (str): YYYY-MM-DD
+
+        Returns:
+            List[str]: ids of the races run between the two dates
+                (inclusive), in date order
+        """
+        if self._by_date is None:
+            self._by_date = sorted((datestr, idx) for idx, _, datestr, _, _
+                                   in self._data.itervalues())
+        lo = bisect.bisect_left(self._by_date, (start_date,))
+        hi = bisect.bisect_left(self._by_date, (end_date + '\xff',))
+        return [idx for _, idx in self._by_date[lo:hi]]
+
+    def races_named(self, name):
+        """
+        Returns:
+            List[str]: ids of every race with this name (ignoring case)
+        """
+        if self._by_name is None:
+            self._by_name = {}
+            for idx, race_name, _, _, _ in sorted(self._data.itervalues()):
+                self._by_name.setdefault(race_name.lower(), []).append(idx)
+        return list(self._by_name.get(name.lower(), []))
 
     def __iter__(self):
         with open(self._f, 'r') as f_in:
@@ -43,7 +141,7 @@ class RaceInfoTable(object):
                 yield idx, name, datestr, dist_km, climb_m
 
     def race_ids(self):
-        return iter(self.data)
+        return iter(self._data)
 
     def __getitem__(self, idx):
         race_id, name, datestr, dist_km, climb_m = self._data[idx]
@@ -54,30 +152,157 @@ class RaceInfoTable(object):
 class DataFolder(object):
     """
     Provides an easy interface for working with the course analysis data folder
+
+    The tables read from the folder are cached, and only read again once
+    their file's mtime or size changes. The returned tables are shared
+    between callers, so shouldn't be modified.
     """
 
     def __init__(self, f):
         self._f = f
+        self._cache = {}
+        self._cache_counts = {}
+
+    def path(self, fname=''):
+        return os.path.join(self._f, fname)
+
+    def _cached(self, fname, load, key=None):
+        """
+        Returns load(path of fname), reusing the previous result if the
+        file hasn't changed since it was loaded. `key` names the cache entry
+        when more than one table is derived from the same file.
+        """
+        f = os.path.join(self._f, fname)
+        key = key or fname
+        counts = self._cache_counts.setdefault(
+            key, {'hits': 0, 'misses': 0, 'reloads': 0})
+        try:
+            stat = file_stat(f)
+        except OSError:
+            self._cache.pop(key, None)
+            counts['misses'] += 1
+            return load(f)
+
+        entry = self._cache.get(key)
+        if entry is not None and entry[0] == stat:
+            counts['hits'] += 1
+            return entry[1]
+
+        counts['reloads' if entry is not None else 'misses'] += 1
+        value = load(f)
+        self._cache[key] = (stat, value)
+        return value
+
+    def cache_info(self):
+        """
+        Returns:
+            Dict[str, Dict[str, int]]: number of cache hits, first time
+                loads (misses) and re-loads after the file changed, for
+                every file read through the cache
+        """
+        return dict((fname, dict(counts))
+                    for fname, counts in self._cache_counts.iteritems())
 
     @property
     def raceinfo(self):
-        f = os.path.join(self._f, 'rinfo.dat')
-        return RaceInfoTable(f)
+        return self._cached('rinfo.dat', RaceInfoTable.cached)
 
     @property
     def result_to_race_index(self):
-        f = os.path.join(self._f, 'result_to_race_index.dat')
-        return read_result_to_race_index(f)
+        return self._cached('result_to_race_index.dat',
+                            read_result_to_race_index)
+
+    @property
+    def runner_registry(self):
+        return self._cached('runner_registry.dat', RunnerRegistry)
+
+    def has_fit(self):
+        return os.path.exists(os.path.join(self._f, FIT_SNAPSHOT))
+
+    def read_fit(self):
+        """
+        Returns:
+            Snapshot: the outputs of the last fit, see write_fit
+        """
+        return self._cached(FIT_SNAPSHOT, lambda f: Snapshot(f, 'fit'))
+
+    def _read_fit_column(self, ids_name, column):
+        def load(f):
+            fit = self.read_fit()
+            return dict(izip(fit.strings(ids_name).strings(),
+                             fit[column].tolist()))
+        return self._cached(FIT_SNAPSHOT, load, key=FIT_SNAPSHOT + ':' + column)
 
     def read_race_theta(self):
-        f = os.path.join(self._f, 'race_theta.out')
-        rtheta = {}
-        with open(f) as f_in:
-            next(f_in)
-            for line in f_in:
-                rid, strtheta = line.strip().split('\t')
-                rtheta[rid] = float(strtheta)
-        return rtheta
+        if self.has_fit():
+            return self._read_fit_column('race_ids', 'race_theta')
+        return self._cached('race_theta.out', read_theta_file)
+
+    def read_runner_theta(self):
+        if self.has_fit():
+            return self._read_fit_column('runners', 'runner_theta')
+        return self._cached('runner_theta.out', read_theta_file)
+
+    def read_winning_times(self):
+        if self.has_fit():
+            return self._read_fit_column('race_ids', 'winning_times')
+        return self._cached('winning_times.out', read_theta_file)
+
+    def write_fit(self, race_ids, runner_names, race_theta, runner_theta,
+                  winning_times, race_errors, runner_mean_err2,
+                  runner_num_races, meta=None):
+        """
+        Writes the outputs of a fit to a single binary snapshot, keeping
+        full precision. Runners are also stored with their registry ids.
+        write_fit_tsvs writes the human readable .out files from it.
+
+        Args:
+            race_ids (List[str])
+            runner_names (List[str])
+            race_theta (Sequence[float])
+            runner_theta (Sequence[float])
+            winning_times (Sequence[float])
+            race_errors (Sequence[float]): mean error of each race
+            runner_mean_err2 (Sequence[float]): mean squared error of each
+                runner
+            runner_num_races (Sequence[int]): number of races each runner
+                has run
+            meta (Dict): anything else to record about the fit
+        """
+        assert len(race_ids) == len(race_theta) == len(winning_times) == \
+            len(race_errors)
+        assert len(runner_names) == len(runner_theta) == \
+            len(runner_mean_err2) == len(runner_num_races)
+        registry = self.runner_registry
+        runner_ids = [registry.get(name, -1) for name in runner_names]
+
+        f = os.path.join(self._f, FIT_SNAPSHOT)
+        write_snapshot(f, 'fit', {
+            'race_theta': numpy.asarray(race_theta, dtype=numpy.float64),
+            'winning_times': numpy.asarray(winning_times, dtype=numpy.float64),
+            'race_errors': numpy.asarray(race_errors, dtype=numpy.float64),
+            'runner_ids': numpy.asarray(runner_ids, dtype=numpy.int64),
+            'runner_theta': numpy.asarray(runner_theta, dtype=numpy.float64),
+            'runner_mean_err2': numpy.asarray(runner_mean_err2,
+                                              dtype=numpy.float64),
+            'runner_num_races': numpy.asarray(runner_num_races,
+                                              dtype=numpy.int64),
+        }, strings={'race_ids': race_ids, 'runners': runner_names}, meta=meta)
+
+    def write_fit_tsvs(self):
+        """
+        Writes the .out files for the last fit from its snapshot.
+        """
+        fit = self.read_fit()
+        race_ids = fit.strings('race_ids').strings()
+        runners = fit.strings('runners').strings()
+        self.write_winning_times(race_ids, fit['winning_times'])
+        self.write_runner_theta(runners, fit['runner_theta'])
+        self.write_sorted_runner_theta(runners, fit['runner_theta'])
+        self.write_race_theta(race_ids, fit['race_theta'])
+        self.write_race_errors(race_ids, fit['race_errors'])
+        self.write_runner_error_summary(runners, fit['runner_mean_err2'],
+                                        fit['runner_num_races'])
 
     def write_winning_times(self, race_ids, winning_times):
         assert len(race_ids) == len(winning_times)
@@ -120,6 +345,39 @@ class DataFolder(object):
             for race_id, theta in izip(race_ids, race_theta):
                 f_out.write('%s\t%f\n' % (race_id, theta))
 
+    def write_seasonal_race_theta(self, race_ids, race_theta):
+        assert len(race_ids) == len(race_theta)
+        f = os.path.join(self._f, 'seasonal_race_theta.out')
+        with open(f, 'w') as f_out:
+            f_out.write('result_id\trace_theta\n')
+            for race_id, theta in izip(race_ids, race_theta):
+                f_out.write('%s\t%f\n' % (race_id, theta))
+
+    def write_runner_season_theta(self, runner_names, seasons, runner_theta):
+        assert len(runner_names) == len(seasons) == len(runner_theta)
+        f = os.path.join(self._f, 'runner_season_theta.out')
+        with open(f, 'w') as f_out:
+            f_out.write('name\tseason\trunner_score\n')
+            for name, season, theta in izip(runner_names, seasons,
+                                            runner_theta):
+                f_out.write('%s\t%i\t%f\n' % (name, season, theta))
+
+    def write_race_theta_stderr(self, race_ids, race_theta, stderrs):
+        assert len(race_ids) == len(race_theta) == len(stderrs)
+        f = os.path.join(self._f, 'race_theta_stderr.out')
+        with open(f, 'w') as f_out:
+            f_out.write('result_id\trace_theta\tstderr\n')
+            for race_id, theta, err in izip(race_ids, race_theta, stderrs):
+                f_out.write('%s\t%f\t%f\n' % (race_id, theta, err))
+
+    def write_runner_theta_stderr(self, runner_names, runner_theta, stderrs):
+        assert len(runner_names) == len(runner_theta) == len(stderrs)
+        f = os.path.join(self._f, 'runner_theta_stderr.out')
+        with open(f, 'w') as f_out:
+            f_out.write('name\trunner_score\tstderr\n')
+            for name, theta, err in izip(runner_names, runner_theta, stderrs):
+                f_out.write('%s\t%f\t%f\n' % (name, theta, err))
+
     def write_race_errors(self, race_ids, race_errors):
         lines = ['result_id\tmean_err2']
         for r_id, err in sorted(izip(race_ids, race_errors), reverse=True):
@@ -136,6 +394,15 @@ class DataFolder(object):
         """
         avg_errs = [sum([e**2 for e in x.values()]) / len(x) for x in runner_errs]
         num_races = [len(x) for x in runner_errs]
+        self.write_runner_error_summary(runner_names, avg_errs, num_races)
+
+    def write_runner_error_summary(self, runner_names, avg_errs, num_races):
+        """
+        Args:
+            runner_names (List[str])
+            avg_errs (List[float]): mean squared error of each runner
+            num_races (List[int]): number of races each runner has run
+        """
         srtd = sorted(zip(avg_errs, runner_names, num_races), reverse=True)
 
         lines = ['name\tmean_err2\tnum_points']
@@ -146,11 +413,109 @@ class DataFolder(object):
         with open(f, 'w') as f_out:
             f_out.write('\n'.join(lines))
 
+    def write_components(self, race_ids, race_labels, sizes, trusted):
+        """
+        Args:
+            race_ids (List[str])
+            race_labels (List[int]): connected component of each race
+            sizes (List[Tuple[int, int]]): number of races and runners in
+                each component
+            trusted (List[bool]): whether each component is big enough to
+                trust its scale
+        """
+        lines = ['result_id\tcomponent\tnum_races\tnum_runners\ttrusted']
+        for r_id, label in sorted(izip(race_ids, race_labels),
+                                  key=lambda x: (x[1], x[0])):
+            n_races, n_runners = sizes[label]
+            lines.append('%s\t%i\t%i\t%i\t%i' % (r_id, label, n_races,
+                                                    n_runners, trusted[label]))
+
+        f = os.path.join(self._f, 'components.out')
+        with open(f, 'w') as f_out:
+            f_out.write('\n'.join(lines))
+
 
 class ResultsFolder(object):
 
-    def __init__(self, f):
+    def __init__(self, f, parse_cache=None, gzip_fpath=None):
+        """
+        Args:
+            f (str): path of the results folder
+            parse_cache (ParseCache): where RaceCsvs from this folder cache
+                their parsed rows. Defaults to the shared PARSE_CACHE.
+            gzip_fpath (str): folder of gzipped copies of the results files,
+                see precompress. Defaults to `f` + '.gz'.
+        """
         self._f = f
+        self.store = None
+        self._parse_cache = parse_cache
+        if gzip_fpath is None:
+            gzip_fpath = f.rstrip(os.sep) + '.gz'
+        self._gzip_f = gzip_fpath
+
+    def path(self):
+        return self._f
+
+    def _gzip_path(self, result_id):
+        return os.path.join(self._gzip_f, result_id + '.csv.gz')
+
+    def gzip_path(self, result_id):
+        """
+        Returns:
+            str: path of the gzipped copy of the results file, or None if
+                there isn't one or it's older than the file
+        """
+        f = self._gzip_path(result_id)
+        try:
+            gz_mtime = os.stat(f).st_mtime
+        except OSError:
+            return None
+        if gz_mtime < os.stat(self[result_id].path).st_mtime:
+            return None
+        return f
+
+    def precompress(self, min_size=GZIP_MIN_SIZE):
+        """
+        Writes a gzipped copy of every results file of at least `min_size`
+        bytes that doesn't have an up to date one, so that they can be
+        served to clients that accept gzip without compressing them on
+        each request.
+
+        Returns:
+            int: number of files compressed
+        """
+        if not os.path.isdir(self._gzip_f):
+            os.makedirs(self._gzip_f)
+        n = 0
+        for result_id in self:
+            f = self[result_id].path
+            if os.path.getsize(f) < min_size or self.gzip_path(result_id):
+                continue
+            gz_f = self._gzip_path(result_id)
+            with open(f, 'rb') as f_in:
+                gz_out = gzip.GzipFile(gz_f + '.tmp', 'wb', mtime=0)
+                try:
+                    shutil.copyfileobj(f_in, gz_out)
+                finally:
+                    gz_out.close()
+            os.rename(gz_f + '.tmp', gz_f)
+            n += 1
+        return n
+
+    def compile(self, store_fpath=None, processes=None):
+        """
+        Builds (or brings up to date) the compiled ResultsStore for this
+        folder, parsing any new or changed files on a pool of `processes`
+        worker processes. After this, RaceCsvs from the folder read their
+        rows from the store instead of re-parsing the csv.
+
+        Returns:
+            ResultsFolder: self
+        """
+        store = ResultsStore(self._f, store_fpath)
+        store.update(processes)
+        self.store = store
+        return self
 
     def list_csvs(self):
         for fname in os.listdir(self._f):
@@ -163,7 +528,7 @@ class ResultsFolder(object):
 
     def values(self):
         for csv in self.list_csvs():
-            yield RaceCsv(csv)
+            yield RaceCsv(csv, self.store, self._parse_cache)
 
     def __contains__(self, race_id):
         fname = os.path.join(self._f, race_id + '.csv')
@@ -171,70 +536,104 @@ class ResultsFolder(object):
 
     def __getitem__(self, race_id):
         fname = os.path.join(self._f, race_id + '.csv')
-        return RaceCsv(fname)
+        return RaceCsv(fname, self.store, self._parse_cache)
 
     def get_resultset(self, result_id):
-        fname = os.path.join(self._f, result_id + '.csv')
-        csv = RaceCsv(fname)
-
-        items = []
-        for i, (name, club, category, time) in enumerate(csv.data_rows()):
-            try:
-                new_item = ResultItem(result_id, i, name, club, category, time)
-                items.append(new_item)
-            except (RetiredRunner, BadName):
-                continue
-        return RaceResultSet(result_id, items)
+        return RaceResultSet.from_columns(result_id, *self[result_id].columns())
 
 
 class RaceCsv(object):
 
-    def __init__(self, f):
+    def __init__(self, f, store=None, parse_cache=None):
         self._f = f
         self._blacklist = None
-        self._lines = None
+        self._store = store
+        if parse_cache is None:
+            parse_cache = PARSE_CACHE
+        self._parse_cache = parse_cache
+
+    def _compiled(self):
+        return self._store is not None and self.race_id in self._store
 
-    def raw_csv(self):
-        with open(self._f) as f:
-            s = f.read()
-        return StringIO.StringIO(s)
+    def _parsed(self):
+        return self._parse_cache.get(self._f)
+
+    @property
+    def path(self):
+        return self._f
 
     @property
     def race_id(self):
         fname = os.path.split(self._f)[1]
         return os.path.splitext(fname)[0]
 
-    def __read(self):
-        self._lines = open(self._f).readlines()
-
     def header(self):
-        return self._lines[0]
+        with open(self._f) as f_in:
+            return next(f_in)
 
     def data_lines(self):
-        if self._lines is None:
-            self.__read()
-        it = iter(self._lines)
-        next(it)
-        for line in it:
-            yield line
+        with open(self._f) as f_in:
+            next(f_in)
+            for line in f_in:
+                yield line
 
     def runner_names(self):
-        for line in self.data_lines():
-            words = [w.strip() for w in line.split(',')]
-            if len(words) == 5:
-                words = [words[1] + ' ' + words[0]] + words[2:]
-            name, club, category, time = words
+        for name in self._parsed().raw_names:
             yield name
 
+    def iter_rows(self):
+        """
+        Streams the parsed (name, club, category, time) rows from the file
+        without reading all of it in to memory (or from the store, when the
+        file has been compiled).
+        """
+        if self._compiled():
+            for row in self._store.rows(self.race_id):
+                yield row
+            return
+        with open(self._f) as f_in:
+            for row in iter_results_rows(f_in):
+                yield row
+
     def data_rows(self):
-        for line in self.data_lines():
-            try:
-                name, club, category, time = munge_line(line)
-            except RetiredRunner:
-                continue
-            except BadName:
-                continue
-            yield name, club, category, time
+        if self._compiled():
+            for row in self._store.rows(self.race_id):
+                yield row
+            return
+        parsed = self._parsed()
+        names, clubs, categories = parsed.names, parsed.clubs, parsed.categories
+        for name_id, club_id, category_id, time in zip(
+                parsed.name_ids.tolist(), parsed.club_ids.tolist(),
+                parsed.category_ids.tolist(), parsed.times.tolist()):
+            yield names[name_id], clubs[club_id], categories[category_id], time
+
+    def rejected(self):
+        """
+        Returns:
+            Dict[str, int]: number of rows rejected by the parser for each
+                reason, see parse_results
+        """
+        return dict(self._parsed().rejected)
+
+    def columns(self):
+        """
+        The parsed rows of the file as columns, with the names, clubs and
+        categories as ids in to string tables. The tables are shared with
+        the results store when there is one.
+
+        Returns:
+            Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray, numpy.ndarray,
+                  List[str], List[str], List[str]]: times, name ids, club ids,
+                category ids, and the name, club and category tables
+        """
+        if self._compiled():
+            store = self._store
+            sl = store.file_slice(self.race_id)
+            return (store.times[sl], store.name_ids[sl], store.club_ids[sl],
+                    store.category_ids[sl], store.names.strings(),
+                    store.clubs.strings(), store.categories.strings())
+
+        return self._parsed().columns()
 
     def process(self):
         """
@@ -243,9 +642,13 @@ class RaceCsv(object):
         Returns:
             Dict[str, int]: mapping of runner name -> finish time (in seconds)
         """
-        runners = {}
-        for name, club, category, time in read_results_file(self._f):
-            runners[name] = time
+        if self._compiled():
+            runners = self._store.process(self.race_id)
+        else:
+            parsed = self._parsed()
+            names = parsed.names
+            runners = dict((names[n], t) for n, t in
+                           zip(parsed.name_ids.tolist(), parsed.times.tolist()))
 
         if not runners:
             raise EmptyResultSet
@@ -253,6 +656,22 @@ class RaceCsv(object):
         return runners
 
 
+def read_theta_file(f):
+    """
+    Reads a two column output file (e.g. race_theta.out) of ids and floats.
+
+    Returns:
+        Dict[str, float]
+    """
+    values = {}
+    with open(f) as f_in:
+        next(f_in)
+        for line in f_in:
+            key, strvalue = line.rstrip('\n').split('\t')
+            values[key] = float(strvalue)
+    return values
+
+
 def normalise_date(s):
     """
     Format the fellrunner.org.uk format D-M-YYYY in to the ISO8601
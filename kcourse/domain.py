@@ -1,3 +1,6 @@
+import numpy
+
+
 class RetiredRunner(ValueError):
     pass
 
@@ -11,6 +14,8 @@ class BadName(ValueError):
 
 
 class ResultItem(object):
+    __slots__ = ('result_id', 'position', 'name', 'club', 'category', 'time')
+
     def __init__(self, result_id, position, name, club, category, time):
         self.result_id = result_id
         self.position = position
@@ -46,39 +51,153 @@ class RunnerRacePerformance(object):
         return self.__dict__
 
 
+def intern_column(values):
+    """
+    Returns:
+        Tuple[numpy.ndarray, List[str]]: id of each value, and the table of
+            distinct values the ids index in to
+    """
+    index = {}
+    table = []
+    ids = numpy.empty(len(values), dtype=numpy.int32)
+    for i, value in enumerate(values):
+        if value not in index:
+            index[value] = len(table)
+            table.append(value)
+        ids[i] = index[value]
+    return ids, table
+
+
 class RaceResultSet(object):
+    """
+    The results of a single race, held as columns: finish times and
+    positions as int arrays, and names, clubs and categories as ids in to
+    string tables (which can be shared between many result sets).
+    ResultItems are only created on demand, when iterating.
+    """
+
     def __init__(self, race_id, result_items):
-        if not result_items:
+        times = [ritem.time for ritem in result_items]
+        positions = [ritem.position for ritem in result_items]
+        name_ids, names = intern_column([r.name for r in result_items])
+        club_ids, clubs = intern_column([r.club for r in result_items])
+        category_ids, categories = intern_column(
+            [r.category for r in result_items])
+        self._init(race_id, times, positions, name_ids, club_ids, category_ids,
+                   names, clubs, categories)
+
+    @classmethod
+    def from_columns(cls, race_id, times, name_ids, club_ids, category_ids,
+                     names, clubs, categories, positions=None):
+        """
+        Args:
+            times (Sequence[int]): finish time (in seconds) of each result
+            name_ids, club_ids, category_ids (Sequence[int]): ids of each
+                result's name, club and category in the `names`, `clubs`
+                and `categories` tables
+            positions (Sequence[int]): position of each result in the
+                results file. Defaults to 0, 1, 2, ...
+        """
+        resultset = cls.__new__(cls)
+        if positions is None:
+            positions = numpy.arange(len(times))
+        resultset._init(race_id, times, positions, name_ids, club_ids,
+                        category_ids, names, clubs, categories)
+        return resultset
+
+    def _init(self, race_id, times, positions, name_ids, club_ids,
+              category_ids, names, clubs, categories):
+        if not len(times):
             raise EmptyResultSet(race_id)
 
         self.race_id = race_id
-        self.result_items = result_items
-        self._winning_time = None
-        self._avg_time = None
+        self.times = numpy.asarray(times, dtype=numpy.int64)
+        self.positions = numpy.asarray(positions, dtype=numpy.int64)
+        self.name_ids = numpy.asarray(name_ids, dtype=numpy.int32)
+        self.club_ids = numpy.asarray(club_ids, dtype=numpy.int32)
+        self.category_ids = numpy.asarray(category_ids, dtype=numpy.int32)
+        self._names = names
+        self._clubs = clubs
+        self._categories = categories
+        self._sorted_times = None
+        self._name_index = None
+
+    @property
+    def result_items(self):
+        return list(self)
 
     @property
     def winning_time(self):
-        if self._winning_time is None:
-            self._winning_time = min(ritem.time for ritem in self.result_items)
-        return self._winning_time
+        return int(self.times.min())
 
     @property
     def avg_time(self):
-        if self._avg_time is None:
-            tot_time = sum(ritem.time for ritem in self.result_items)
-            self._avg_time = tot_time / self.num_finishers
-        return self._avg_time
+        return int(self.times.sum()) / self.num_finishers
 
     @property
     def num_finishers(self):
-        return len(self.result_items)
+        return len(self.times)
+
+    @property
+    def names(self):
+        """
+        Returns:
+            List[str]: runner name of each result
+        """
+        return [self._names[i] for i in self.name_ids.tolist()]
+
+    def percentile(self, q):
+        """
+        Returns:
+            float: the q-th percentile (0 - 100) of the finish times. q can
+                also be a sequence of percentiles.
+        """
+        return numpy.percentile(self.times, q)
+
+    def rank(self, time):
+        """
+        Returns:
+            int: finishing place (1 = first) a runner with finish time `time`
+                would have had, with ties sharing the better place. `time`
+                can also be an array of times.
+        """
+        if self._sorted_times is None:
+            self._sorted_times = numpy.sort(self.times)
+        return numpy.searchsorted(self._sorted_times, time, side='left') + 1
+
+    def position_of(self, name):
+        """
+        Returns:
+            int: position in the results file of the (first) result for the
+                runner called `name`
+
+        Raises:
+            KeyError: if the runner isn't in the results
+        """
+        matches = numpy.flatnonzero(self.name_ids == self._name_id(name))
+        if not len(matches):
+            raise KeyError(name)
+        return int(self.positions[matches[0]])
+
+    def _name_id(self, name):
+        if self._name_index is None:
+            self._name_index = dict(
+                (self._names[i], i) for i in numpy.unique(self.name_ids).tolist())
+        return self._name_index.get(name, -1)
 
     def iteritems(self):
-        for ritem in self.ritems:
-            yield ritem.name, ritem.time
+        names = self._names
+        for name_id, time in zip(self.name_ids.tolist(), self.times.tolist()):
+            yield names[name_id], time
 
     def __iter__(self):
-        return iter(self.result_items)
+        names, clubs, categories = self._names, self._clubs, self._categories
+        for position, name_id, club_id, category_id, time in zip(
+                self.positions.tolist(), self.name_ids.tolist(),
+                self.club_ids.tolist(), self.category_ids.tolist(),
+                self.times.tolist()):
+            yield ResultItem(self.race_id, position, names[name_id],
+                             clubs[club_id], categories[category_id], time)
 
 
 class RaceInfo(object):
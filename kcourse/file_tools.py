@@ -1,4 +1,6 @@
 import re
+import string
+from itertools import islice
 
 from kcourse.domain import RetiredRunner, BadName
 
@@ -37,16 +39,9 @@ def read_results_file(f):
     Steps through a results file and processes and yields each
     line in turn.
     """
-    with open(f) as f_in:
-        next(f_in)  # throw away header
-        for line in f_in:
-            try:
-                name, club, category, time = munge_line(line)
-            except RetiredRunner:
-                continue
-            except BadName:
-                continue
-            yield name, club, category, time
+    names, clubs, categories, times, _ = parse_results_file(f)
+    for row in zip(names, clubs, categories, times):
+        yield row
 
 
 def read_winning_times(f):
@@ -84,6 +79,98 @@ def munge_line(s):
     return name, club, category, time
 
 
+_TIME_INTS = re.compile('[0-9]+')
+_DOTS_TO_SPACES = string.maketrans('.', ' ')
+
+
+def parse_results(data):
+    """
+    Parses a whole results csv in one pass, giving the same rows as calling
+    munge_line on every line after the header.
+
+    Args:
+        data (str): contents of the results file
+
+    Returns:
+        Tuple[List[str], List[str], List[str], List[int], Dict[str, int]]:
+            the name, club, category and time (in seconds) columns of the
+            accepted rows, and the number of rows rejected for each reason
+            ('retired', 'bad_name' or 'malformed', for a wrong number of
+            columns)
+    """
+    names = []
+    clubs = []
+    categories = []
+    times = []
+    rejected = {'retired': 0, 'bad_name': 0, 'malformed': 0}
+
+    lines = data.lower().split('\n')
+    if lines and not lines[-1]:
+        lines.pop()
+    _parse_lines(lines[1:], names, clubs, categories, times, rejected)
+    return names, clubs, categories, times, rejected
+
+
+def _parse_lines(lines, names, clubs, categories, times, rejected):
+    """
+    Parses lowercased results lines on to the end of the column lists.
+    """
+    for line in lines:
+        words = line.split(',')
+        if len(words) == 5:
+            words = [words[1].strip() + ' ' + words[0].strip()] + words[2:]
+        elif len(words) != 4:
+            rejected['malformed'] += 1
+            continue
+        name, club, category, timestr = words
+
+        name = name.replace('facebook', '').replace('strava', '')
+        name = ' '.join(name.translate(_DOTS_TO_SPACES).split())
+        if not name:
+            rejected['bad_name'] += 1
+            continue
+
+        ints = _TIME_INTS.findall(timestr)
+        if len(ints) == 3:
+            time = 3600 * int(ints[0]) + 60 * int(ints[1]) + int(ints[2])
+        elif len(ints) == 2:
+            time = 60 * int(ints[0]) + int(ints[1])
+        else:
+            rejected['retired'] += 1
+            continue
+
+        names.append(name)
+        clubs.append(club.strip())
+        categories.append(category.strip())
+        times.append(time)
+
+
+def parse_results_file(f):
+    """
+    parse_results for the results file at path `f`.
+    """
+    with open(f) as f_in:
+        return parse_results(f_in.read())
+
+
+def iter_results_rows(f_in, chunk_lines=1024):
+    """
+    Streams the (name, club, category, time) rows of an open results file,
+    parsing `chunk_lines` lines at a time, so memory use doesn't grow with
+    the size of the file. Gives the same rows as parse_results.
+    """
+    next(f_in, None)  # throw away header
+    rejected = {'retired': 0, 'bad_name': 0, 'malformed': 0}
+    while True:
+        lines = [line.lower() for line in islice(f_in, chunk_lines)]
+        if not lines:
+            break
+        names, clubs, categories, times = [], [], [], []
+        _parse_lines(lines, names, clubs, categories, times, rejected)
+        for row in zip(names, clubs, categories, times):
+            yield row
+
+
 def ends_2_decimals(s):
     pattern = '.*[0-9][0-9]$'
     return re.match(pattern, s)
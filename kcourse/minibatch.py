@@ -0,0 +1,211 @@
+"""
+Mini-batch stochastic gradient fitting of the standard runner model.
+
+Rather than holding every race dict in memory (as Scorer does), the races
+are streamed from the results folder in batches on every epoch. Only the
+runner name index, the winning times and the theta vectors are kept
+between batches.
+"""
+import random
+
+import numpy
+
+from kcourse.analysis import ArrayScorer, iter_race_results
+from kcourse.data import ResultsFolder
+from kcourse.optimize import grad_norm, make_reporter
+from kcourse.telemetry import maybe_phase
+
+
+def inverse_decay(learning_rate, decay):
+    """
+    Learning rate schedule: learning_rate / (1 + decay * epoch)
+    """
+    return lambda epoch: learning_rate / (1. + decay * epoch)
+
+
+class RaceStream(object):
+    """
+    Re-readable stream of the races in a fit, in batches.
+
+    The first pass over the results (on construction) registers every
+    runner in the data folder's RunnerRegistry, numbering them in registry
+    id order like process_results_collection, and records each race's
+    winning time and the number of results for every race and runner.
+    After that the race data is read back from the results files on
+    demand.
+    """
+
+    def __init__(self, data_folder, results_fpath):
+        self._result_folder = ResultsFolder(results_fpath).compile()
+        self.race_ids = []
+        self.winning_times = []
+        self.race_counts = []
+        runner_counts = {}
+        seen = []
+
+        for result_id, race_data in iter_race_results(
+                data_folder, results_fpath,
+                result_folder=self._result_folder):
+            for runner_name in race_data:
+                if runner_name not in runner_counts:
+                    runner_counts[runner_name] = 0
+                    seen.append(runner_name)
+                runner_counts[runner_name] += 1
+            self.race_ids.append(result_id)
+            self.winning_times.append(min(race_data.itervalues()))
+            self.race_counts.append(len(race_data))
+
+        # register in first seen (i.e. result id) order, so new runners get
+        # the same ids as they would from get_races_and_runners
+        self.runners = data_folder.runner_registry.order(seen)
+        self.runner_index = dict((name, i)
+                                 for i, name in enumerate(self.runners))
+
+        self.winning_times = numpy.array(self.winning_times, dtype=float)
+        self.race_counts = numpy.array(self.race_counts, dtype=float)
+        self.runner_counts = numpy.array(
+            [runner_counts[name] for name in self.runners], dtype=float)
+        self.n_obs = int(self.race_counts.sum())
+
+    @property
+    def n_races(self):
+        return len(self.race_ids)
+
+    @property
+    def n_runners(self):
+        return len(self.runners)
+
+    def batches(self, batch_size, order=None):
+        """
+        Yields:
+            Tuple[numpy.ndarray, numpy.ndarray, ArrayScorer]: the global race
+                indices and global runner indices in the batch, and a scorer
+                over just those races and runners
+        """
+        if order is None:
+            order = range(self.n_races)
+
+        for start in xrange(0, len(order), batch_size):
+            batch = numpy.array(order[start:start + batch_size],
+                                dtype=numpy.intp)
+            race_idx = []
+            runner_idx = []
+            times = []
+            for i_local, i_race in enumerate(batch):
+                result_id = self.race_ids[i_race]
+                race_data = self._result_folder[result_id].process()
+                race_idx.extend([i_local] * len(race_data))
+                runner_idx.extend(self.runner_index[name] for name in race_data)
+                times.extend(race_data.itervalues())
+
+            batch_runners, local_runner_idx = numpy.unique(
+                runner_idx, return_inverse=True)
+            scorer = ArrayScorer.from_arrays(
+                race_idx, local_runner_idx, times,
+                self.winning_times[batch], len(batch), len(batch_runners))
+            yield batch, batch_runners, scorer
+
+
+def minibatch_fit(stream, n_epochs, batch_size=50, learning_rate=0.5,
+                  schedule=None, J_logger_fn=None, seed=0, trace=None):
+    """
+    Fits the model with mini-batch stochastic gradient descent.
+
+    Each batch step moves the races in the batch, and the runners who ran
+    them, along that batch's contribution to the gradient, divided by the
+    total number of results each race or runner has. That per-parameter
+    scaling means a runner with 200 results doesn't take steps 200 times
+    bigger than one with a single result, and keeps the sensible learning
+    rates around 0.1 - 1 whatever the size of the data.
+
+    Args:
+        stream (RaceStream)
+        n_epochs (int)
+        batch_size (int): number of races per batch
+        learning_rate (float): used when no schedule is given
+        schedule (Callable[[int], float]): maps the epoch number to the
+            learning rate for that epoch
+        J_logger_fn (Callable[[float], None]): called once per epoch with
+            the J accumulated over the epoch
+        seed (int): seeds the shuffling of the race order between epochs
+        trace (FitTrace): gets a per-epoch telemetry record
+
+    Returns:
+        Tuple[numpy.ndarray, numpy.ndarray]: race and runner thetas
+    """
+    if schedule is None:
+        schedule = lambda epoch: learning_rate
+    report = make_reporter(J_logger_fn, trace)
+
+    rng = random.Random(seed)
+    race_theta = numpy.ones(stream.n_races)
+    runner_theta = numpy.ones(stream.n_runners)
+    order = range(stream.n_races)
+
+    for epoch in xrange(n_epochs):
+        alpha = schedule(epoch)
+        rng.shuffle(order)
+
+        J = 0.
+        race_grads = numpy.zeros(stream.n_races)
+        runner_grads = numpy.zeros(stream.n_runners)
+        for batch, batch_runners, scorer in stream.batches(batch_size, order):
+            J_b, race_g, runner_g = scorer.cost_function(
+                race_theta[batch], runner_theta[batch_runners])
+            weight = 1.0 * scorer.count / stream.n_obs
+            J += weight * J_b
+            race_grads[batch] += weight * race_g
+            runner_grads[batch_runners] += weight * runner_g
+
+            race_theta[batch] -= (alpha * scorer.count * race_g /
+                                  stream.race_counts[batch])
+            runner_theta[batch_runners] -= (
+                alpha * scorer.count * runner_g /
+                stream.runner_counts[batch_runners])
+
+        report(J, grad_norm(numpy.concatenate((race_grads, runner_grads))),
+               numpy.concatenate((race_theta, runner_theta)))
+
+    return race_theta, runner_theta
+
+
+def write_minibatch_outputs(data_folder, stream, race_theta, runner_theta,
+                            batch_size=50):
+    """
+    Writes the same fit snapshot as create_scorer, computing the race and
+    runner error summaries with one more streamed pass over the races.
+    """
+    race_errs = numpy.zeros(stream.n_races)
+    runner_err2 = numpy.zeros(stream.n_runners)
+    runner_counts = numpy.zeros(stream.n_runners, dtype=int)
+    for batch, batch_runners, scorer in stream.batches(batch_size):
+        race_errs[batch] = scorer.race_errors(race_theta[batch],
+                                              runner_theta[batch_runners])
+        _, _, err = scorer.errors(race_theta[batch],
+                                   runner_theta[batch_runners])
+        runner_err2[batch_runners] += numpy.bincount(
+            scorer.runner_idx, weights=err**2, minlength=len(batch_runners))
+        runner_counts[batch_runners] += numpy.bincount(
+            scorer.runner_idx, minlength=len(batch_runners))
+
+    data_folder.write_fit(stream.race_ids, stream.runners, race_theta,
+                          runner_theta, stream.winning_times, race_errs,
+                          runner_err2 / runner_counts, runner_counts)
+
+
+def create_minibatch_scorer(data_folder, n_epochs, batch_size=50,
+                            learning_rate=0.5, schedule=None,
+                            J_logger_fn=None, results_fpath='results',
+                            trace=None):
+    """
+    Streaming counterpart to analysis.create_scorer.
+    """
+    with maybe_phase(trace, 'ingest'):
+        stream = RaceStream(data_folder, results_fpath)
+    with maybe_phase(trace, 'fit'):
+        race_theta, runner_theta = minibatch_fit(stream, n_epochs, batch_size,
+                                                 learning_rate, schedule,
+                                                 J_logger_fn, trace=trace)
+    with maybe_phase(trace, 'output'):
+        write_minibatch_outputs(data_folder, stream, race_theta, runner_theta,
+                                batch_size)
@@ -0,0 +1,175 @@
+"""
+Optimizers for fitting the standard runner model.
+
+All of the optimizers share the same call signature so that create_scorer
+can switch between them:
+
+    optimizer(fun, initial_params, niters, J_logger_fn=None, tol=None)
+
+`fun` maps a parameter vector to a tuple of (J, grads). The optimizer
+stops after `niters` iterations, or earlier once the relative change in
+J drops below `tol`. `J_logger_fn` is called once per iteration with the
+current J, and `trace` (a kcourse.telemetry.FitTrace) gets the full
+per-iteration record, including the gradient norm. Each optimizer returns
+the final J and parameter vector, and the last J reported is always the
+one returned.
+"""
+import numpy
+import scipy.optimize
+
+
+def grad_norm(grads):
+    grads = numpy.asarray(grads, dtype=float)
+    return numpy.sqrt(numpy.dot(grads, grads))
+
+
+def make_reporter(J_logger_fn, trace):
+    """
+    Returns a report(J, grad_norm, params) function that passes the
+    iteration on to J_logger_fn and trace, whichever are set.
+    """
+    def report(J, g_norm, params):
+        if J_logger_fn is not None:
+            J_logger_fn(J)
+        if trace is not None:
+            trace.iteration(J, g_norm, params)
+    return report
+
+
+def has_converged(J, J0, tol):
+    if tol is None:
+        return False
+    return abs(J0 - J) <= tol * abs(J0)
+
+
+def kminimize(fun, initial_params, niters, J_logger_fn=None, tol=None,
+              alpha=1000., trace=None):
+    """
+    Plain gradient descent with a fixed learning rate.
+    """
+    report = make_reporter(J_logger_fn, trace)
+    if trace is not None:
+        trace.meta(optimizer='descent', n_params=len(initial_params),
+                   alpha=alpha)
+
+    params = numpy.array(initial_params, dtype=float)
+    i_iter = 0
+    J = 0
+    while True:
+        i_iter += 1
+        J0 = J
+        J, grads = fun(params)
+        grads = numpy.asarray(grads, dtype=float)
+        report(J, grad_norm(grads), params)
+        if i_iter > 1:
+            rel_change = (J - J0) / J0
+            if rel_change > 1.1:
+                raise Exception("Convergence is exploding - reduce learning rate: %f" % alpha)
+            if has_converged(J, J0, tol):
+                break
+        if i_iter > niters:
+            break
+
+        params -= alpha * grads
+
+    return J, params
+
+
+def linesearch_minimize(fun, initial_params, niters, J_logger_fn=None,
+                        tol=None, alpha=1000., shrink=0.5, c1=1e-4,
+                        trace=None):
+    """
+    Gradient descent with a backtracking (Armijo) line search.
+
+    Each iteration starts from double the previously accepted step and
+    shrinks it until the sufficient decrease condition is met, so the
+    initial `alpha` only needs to be the right order of magnitude.
+    """
+    report = make_reporter(J_logger_fn, trace)
+
+    params = numpy.array(initial_params, dtype=float)
+    J, grads = fun(params)
+    grads = numpy.asarray(grads, dtype=float)
+    g_norm = grad_norm(grads)
+    report(J, g_norm, params)
+    step = alpha
+
+    for _ in xrange(niters):
+        if g_norm == 0:
+            break
+
+        while True:
+            new_params = params - step * grads
+            new_J, new_grads = fun(new_params)
+            if new_J <= J - c1 * step * g_norm**2:
+                break
+            step *= shrink
+            if step < 1e-12 * alpha:
+                return J, params
+
+        J0 = J
+        params = new_params
+        J, grads = new_J, numpy.asarray(new_grads, dtype=float)
+        g_norm = grad_norm(grads)
+        report(J, g_norm, params)
+        step *= 2.
+        if has_converged(J, J0, tol):
+            break
+
+    return J, params
+
+
+class _Converged(Exception):
+    pass
+
+
+def lbfgs_minimize(fun, initial_params, niters, J_logger_fn=None, tol=None,
+                   trace=None):
+    """
+    Quasi-Newton minimisation using scipy's L-BFGS-B implementation.
+
+    scipy's own stopping tests are switched off: its gradient test (gtol)
+    is absolute, and our gradients are tiny once divided by the number of
+    results, so it would end every fit early. Instead, like the other
+    optimizers, the fit stops when the change in J relative to the current
+    J drops below `tol`.
+    """
+    report = make_reporter(J_logger_fn, trace)
+
+    last = {}
+    previous = {}
+
+    def wrapped_fun(params):
+        J, grads = fun(params)
+        grads = numpy.asarray(grads, dtype=float)
+        last['params'] = params.copy()
+        last['J'] = J
+        last['grads'] = grads
+        return J, grads
+
+    def callback(params):
+        if not numpy.array_equal(params, last['params']):
+            wrapped_fun(params)
+        J = last['J']
+        report(J, grad_norm(last['grads']), params)
+        if 'J' in previous and has_converged(J, previous['J'], tol):
+            raise _Converged()
+        previous['J'] = J
+
+    x0 = numpy.array(initial_params, dtype=float)
+    # ftol=0 still stops the fit if an iteration fails to lower J at all
+    options = {'maxiter': niters, 'gtol': 0., 'ftol': 0.}
+    try:
+        result = scipy.optimize.minimize(wrapped_fun, x0, jac=True,
+                                         method='L-BFGS-B', callback=callback,
+                                         options=options)
+    except _Converged:
+        return last['J'], last['params']
+    return result.fun, result.x
+
+
+OPTIMIZERS = {
+    'descent': kminimize,
+    'linesearch': linesearch_minimize,
+    'lbfgs': lbfgs_minimize,
+}
@@ -0,0 +1,146 @@
+"""
+In-process LRU cache of parsed results files.
+
+RaceCsv.process, data_rows, columns and runner_names all draw on the one
+ParsedFile per results file held here, so a process that touches a file
+several times only parses it once. Entries are keyed by the file's path,
+mtime and size, so an edited file is parsed again, and the least recently
+used entries are evicted once the (estimated) memory used goes over the
+budget.
+
+The cache is shared by the threads of the API server, so its bookkeeping is
+done under a lock. Files are parsed outside the lock, so two threads that
+miss on the same file at once may both parse it, but only one copy is kept.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+import numpy
+
+from kcourse.domain import intern_column
+from kcourse.file_tools import parse_results
+
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+# rough per-object overhead of a short Python string
+_STR_OVERHEAD = 40
+
+
+def split_runner_names(data):
+    """
+    The raw (un-munged) runner name on every data line of a results file,
+    as the results site gave them. Lines with the wrong number of columns
+    are skipped.
+    """
+    names = []
+    for line in data.split('\n')[1:]:
+        words = [w.strip() for w in line.split(',')]
+        if len(words) == 5:
+            names.append(words[1] + ' ' + words[0])
+        elif len(words) == 4:
+            names.append(words[0])
+    return names
+
+
+class ParsedFile(object):
+    """
+    One results file, parsed in to columns. See RaceCsv.columns.
+    """
+    __slots__ = ('times', 'name_ids', 'club_ids', 'category_ids', 'names',
+                 'clubs', 'categories', 'rejected', 'raw_names')
+
+    def __init__(self, data):
+        names, clubs, categories, times, self.rejected = parse_results(data)
+        self.times = numpy.array(times, dtype=numpy.int64)
+        self.name_ids, self.names = intern_column(names)
+        self.club_ids, self.clubs = intern_column(clubs)
+        self.category_ids, self.categories = intern_column(categories)
+        self.raw_names = split_runner_names(data)
+
+    @property
+    def nbytes(self):
+        n = (self.times.nbytes + self.name_ids.nbytes + self.club_ids.nbytes +
+             self.category_ids.nbytes)
+        for table in (self.names, self.clubs, self.categories, self.raw_names):
+            n += sum(len(s) + _STR_OVERHEAD for s in table)
+        return n
+
+    def columns(self):
+        return (self.times, self.name_ids, self.club_ids, self.category_ids,
+                self.names, self.clubs, self.categories)
+
+
+class ParseCache(object):
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        Args:
+            max_bytes (int): memory budget for the cached files
+        """
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, f):
+        """
+        Returns:
+            ParsedFile: the parsed contents of the results file `f`
+        """
+        st = os.stat(f)
+        key = (os.path.abspath(f), st.st_mtime, st.st_size)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.hits += 1
+                self._entries[key] = entry  # most recently used go last
+                return entry[0]
+            self.misses += 1
+
+        with open(f) as f_in:
+            parsed = ParsedFile(f_in.read())
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                entry = parsed, parsed.nbytes
+                self.nbytes += entry[1]
+            self._entries[key] = entry
+            self._evict()
+            return entry[0]
+
+    def _evict(self):
+        # only called with the lock held
+        # always keep the most recent entry, even if it's over budget alone
+        while self.nbytes > self.max_bytes and len(self._entries) > 1:
+            _, (_, nbytes) = self._entries.popitem(last=False)
+            self.nbytes -= nbytes
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """
+        Returns:
+            Dict[str, int]: hits, misses, evictions, number of cached files
+                and their estimated size in bytes
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'files': len(self._entries),
+                    'bytes': self.nbytes, 'max_bytes': self.max_bytes}
+
+
+# shared by every RaceCsv that isn't given a cache of its own
+PARSE_CACHE = ParseCache()
@@ -1,15 +1,14 @@
 """
 Print out a table of race information, including our new 'duration' parameter
 """
-from kcourse.file_tools import RaceInfoTable, read_race_scores, read_result_to_race_index, read_winning_times
+from kcourse.data import DataFolder
 
 
-def print_race_table():
-    race_duration_scores = read_race_scores('race_theta.out')
-    results_folder = 'results'
-    raceinfo_table = RaceInfoTable('rinfo.dat')
-    _, course_to_results = read_result_to_race_index('result_to_race_index.dat')
-    winning_times = read_winning_times('winning_times.out')
+def print_race_table(data_folder):
+    race_duration_scores = data_folder.read_race_theta()
+    raceinfo_table = data_folder.raceinfo
+    _, course_to_results = data_folder.result_to_race_index
+    winning_times = data_folder.read_winning_times()
 
     lines = ['course_id\tresult_id\tname\tdate\tdist(km)\tclimb(m)\twinning_time(s)\tscore']
 
@@ -29,4 +28,4 @@ def print_race_table():
 
 
 if __name__ == '__main__':
-    print_race_table()
+    print_race_table(DataFolder('data'))
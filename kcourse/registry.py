@@ -0,0 +1,194 @@
+"""
+Persistent registry of runner ids.
+
+Every runner name that has ever been seen is given a stable integer id, so
+that the fit, the runner index and the API agree on ids between runs and
+adding a results file never renumbers existing runners.
+
+On disk the registry is an append-only string table (one name per line,
+line number = id) and an open addressing hash table of ids. Names are only
+ever appended, so the string table is the source of truth; the hash table
+is rebuilt from it if the two don't agree.
+
+Several processes can add runners to the same registry (e.g. a fit and the
+API's background index rebuild). Writers take an exclusive lock on the
+string table while saving and first merge in any names that other
+processes have appended since, so the ids of runners added since the last
+save are only final once save() has returned.
+"""
+import fcntl
+import os
+import zlib
+
+import numpy
+
+
+EMPTY = -1
+MAX_LOAD = 0.5
+
+
+def name_hash(name):
+    """
+    Hash of a runner name that is the same in every process and every run,
+    unlike the builtin hash().
+    """
+    return zlib.crc32(name) & 0xffffffff
+
+
+class RunnerRegistry(object):
+
+    def __init__(self, f):
+        """
+        Args:
+            f (str): path of the string table. The hash table is kept
+                alongside it in `f` + '.idx.npy'.
+        """
+        self._f = f
+        self._idx_f = f + '.idx.npy'
+        self._names = []
+        self._n_saved = 0
+        self._n_bytes = 0  # how much of the string table has been read
+        if os.path.exists(f):
+            with open(f) as f_in:
+                fcntl.flock(f_in, fcntl.LOCK_SH)
+                self._names = self._read_names(f_in)
+            self._n_saved = len(self._names)
+
+        self._table = None
+        if os.path.exists(self._idx_f):
+            table = numpy.load(self._idx_f)
+            # the last slot records how many names the table covers
+            if table[-1] == len(self._names):
+                self._table = table[:-1].copy()
+        if self._table is None:
+            self._rebuild(len(self._names))
+
+    def _read_names(self, f_in):
+        """
+        Reads the names from the current position of the (locked) string
+        table to the end.
+        """
+        start = f_in.tell()
+        data = f_in.read()
+        self._n_bytes = start + len(data)
+        lines = data.split('\n')
+        if not lines[-1]:
+            lines.pop()
+        return [intern(line) for line in lines]
+
+    def _rebuild(self, n_names):
+        size = 16
+        while size * MAX_LOAD < n_names + 1:
+            size *= 2
+        self._table = numpy.empty(size, dtype=numpy.int32)
+        self._table.fill(EMPTY)
+        for runner_id in xrange(len(self._names)):
+            self._insert(runner_id)
+
+    def _slot(self, name):
+        """
+        Returns:
+            int: slot holding `name`'s id, or the empty slot it would go in
+        """
+        mask = len(self._table) - 1
+        slot = name_hash(name) & mask
+        while True:
+            runner_id = self._table[slot]
+            if runner_id == EMPTY or self._names[runner_id] == name:
+                return slot
+            slot = (slot + 1) & mask
+
+    def _insert(self, runner_id):
+        self._table[self._slot(self._names[runner_id])] = runner_id
+
+    def __len__(self):
+        return len(self._names)
+
+    def __getitem__(self, runner_id):
+        return self._names[runner_id]
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    @property
+    def names(self):
+        return self._names
+
+    def get(self, name, default=None):
+        """
+        Returns:
+            int: id of the runner called `name`, or `default` if they
+                haven't been registered
+        """
+        runner_id = self._table[self._slot(name)]
+        if runner_id == EMPTY:
+            return default
+        return int(runner_id)
+
+    def add(self, name):
+        """
+        Returns:
+            int: id of the runner called `name`, registering them if they
+                are new. The id of a new runner can still change when the
+                registry is saved, if another process has registered
+                runners in the meantime.
+        """
+        slot = self._slot(name)
+        runner_id = self._table[slot]
+        if runner_id != EMPTY:
+            return int(runner_id)
+
+        runner_id = len(self._names)
+        self._names.append(intern(name))
+        if len(self._names) > len(self._table) * MAX_LOAD:
+            self._rebuild(len(self._names))
+        else:
+            self._table[slot] = runner_id
+        return runner_id
+
+    def order(self, names):
+        """
+        Registers any new runners in `names`, in the order given, and saves
+        the registry so that their ids are final.
+
+        Returns:
+            List[str]: `names` sorted by runner id
+        """
+        for name in names:
+            self.add(name)
+        self.save()
+        return sorted(names, key=self.get)
+
+    def save(self):
+        """
+        Appends the newly registered names to the string table and writes
+        out the hash table. Names other processes have saved since this
+        registry was loaded are merged in first, and new names they already
+        registered take the ids they were given there.
+        """
+        if self._n_saved == len(self._names) and os.path.exists(self._idx_f):
+            return
+        with open(self._f, 'a+') as f_out:
+            fcntl.flock(f_out, fcntl.LOCK_EX)
+            f_out.seek(self._n_bytes)
+            others = self._read_names(f_out)
+            new_names = self._names[self._n_saved:]
+            if others:
+                seen = set(others)
+                self._names = self._names[:self._n_saved] + others
+                for name in new_names:
+                    if name not in seen:
+                        seen.add(name)
+                        self._names.append(name)
+                new_names = self._names[self._n_saved + len(others):]
+                self._rebuild(len(self._names))
+
+            f_out.write(''.join(name + '\n' for name in new_names))
+            f_out.flush()
+            self._n_bytes = f_out.tell()
+            self._n_saved = len(self._names)
+
+            table = numpy.append(self._table, numpy.int32(len(self._names)))
+            tmp_f = '%s.%i.tmp.npy' % (self._idx_f, os.getpid())
+            numpy.save(tmp_f, table)
+            os.rename(tmp_f, self._idx_f)
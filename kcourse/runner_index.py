@@ -0,0 +1,513 @@
+"""
+On-disk snapshot of the runner index served by the API.
+
+The index maps every runner name to their race performances. In the
+snapshot the runner names are a sorted string table, and each runner's
+performances are a contiguous range (given by `offsets`) of typed arrays:
+which result it was, the finish time and the score. The results
+themselves (result id, race id, race name and date) are string tables
+indexed by the performances.
+
+Opening the snapshot only maps the file, so a server starts in
+milliseconds, and any number of worker processes share the same pages.
+Runners are looked up by binary search on the sorted names.
+
+For searching, the snapshot also holds a trigram index of the names: the
+sorted distinct trigrams, and for each one the (sorted) list of names it
+appears in. Prefix searches are a range of the sorted names; fuzzy
+searches count the trigrams each name shares with the query.
+
+LiveRunnerIndex keeps a server's index up to date: it serves the last
+snapshot straight away, and rebuilds it in a background thread whenever
+the data or results change, swapping the new index in once it's built.
+The compiled ResultsStore the index was built from is swapped in with it,
+so a server can read a race's rows without parsing its results file.
+"""
+import bisect
+import os
+import threading
+import time
+
+import numpy
+
+from kcourse.data import DataFolder, ResultsFolder
+from kcourse.domain import RunnerRacePerformance
+from kcourse.snapshot import Snapshot, SnapshotError, write_snapshot
+from kcourse.store import ResultsStore
+
+
+RUNNER_INDEX_SNAPSHOT = 'runner_index.snap'
+# bumped when the snapshot gains arrays, so that older ones are rebuilt
+INDEX_VERSION = 2
+
+DEFAULT_SEARCH_LIMIT = 10
+# fraction of trigrams a fuzzy match must share with the query
+MIN_SIMILARITY = 0.3
+
+
+class _TableView(object):
+    """
+    Sequence over a StringTable that bisect can search.
+    """
+
+    def __init__(self, table):
+        self._table = table
+
+    def __len__(self):
+        return len(self._table)
+
+    def __getitem__(self, i):
+        return self._table[i]
+
+
+def name_trigrams(name):
+    """
+    Returns:
+        Set[str]: the distinct trigrams of a name, padded so that the start
+            and end of the name count for more
+    """
+    padded = '  ' + name + ' '
+    return set(padded[i:i + 3] for i in xrange(len(padded) - 2))
+
+
+def build_trigram_index(names):
+    """
+    Args:
+        names (List[str])
+
+    Returns:
+        Tuple[List[str], numpy.ndarray, numpy.ndarray, numpy.ndarray]: the
+            sorted trigrams, offsets in to the postings for each trigram,
+            the postings (indexes in to `names`) and the number of
+            trigrams in each name
+    """
+    postings = {}
+    n_trigrams = numpy.zeros(len(names), dtype=numpy.int32)
+    for i, name in enumerate(names):
+        trigrams = name_trigrams(name)
+        n_trigrams[i] = len(trigrams)
+        for trigram in trigrams:
+            postings.setdefault(trigram, []).append(i)
+
+    trigrams = sorted(postings)
+    offsets = [0]
+    for trigram in trigrams:
+        offsets.append(offsets[-1] + len(postings[trigram]))
+    flat = numpy.empty(offsets[-1], dtype=numpy.int32)
+    for trigram, start in zip(trigrams, offsets):
+        flat[start:start + len(postings[trigram])] = postings[trigram]
+    return (trigrams, numpy.array(offsets, dtype=numpy.int64), flat,
+            n_trigrams)
+
+
+def write_runner_index(f, runner_index, sources=None, meta=None):
+    """
+    Args:
+        f (str): path of the snapshot to write
+        runner_index (Dict[str, List[RunnerRacePerformance]]): as built by
+            scripts.runner_lookup.build_runner_index
+        sources (Dict[str, List]): signature of the files the index was
+            built from, see RunnerIndex.is_fresh
+        meta (Dict): any other JSON serialisable information about the build
+    """
+    names = sorted(name for name, perfs in runner_index.iteritems() if perfs)
+
+    result_index = {}
+    result_ids, race_ids, race_names, dates = [], [], [], []
+    offsets = [0]
+    perf_results, perf_times, perf_scores = [], [], []
+    for name in names:
+        for perf in runner_index[name]:
+            if perf.result_id not in result_index:
+                result_index[perf.result_id] = len(result_ids)
+                result_ids.append(perf.result_id)
+                race_ids.append(perf.race_id)
+                race_names.append(perf.race_name)
+                dates.append(perf.date)
+            perf_results.append(result_index[perf.result_id])
+            perf_times.append(perf.time)
+            # NaN stands in for a missing (None) score
+            perf_scores.append(perf.score if perf.score is not None
+                               else numpy.nan)
+        offsets.append(len(perf_results))
+    trigrams, trigram_offsets, trigram_postings, n_trigrams = \
+        build_trigram_index(names)
+
+    write_snapshot(f, 'runner_index', {
+        'offsets': numpy.array(offsets, dtype=numpy.int64),
+        'perf_results': numpy.array(perf_results, dtype=numpy.int32),
+        'perf_times': numpy.array(perf_times, dtype=numpy.int64),
+        'perf_scores': numpy.array(perf_scores, dtype=numpy.float64),
+        'trigram_offsets': trigram_offsets,
+        'trigram_postings': trigram_postings,
+        'n_trigrams': n_trigrams,
+    }, strings={
+        'names': names,
+        'result_ids': result_ids,
+        'race_ids': race_ids,
+        'race_names': race_names,
+        'dates': dates,
+        'trigrams': trigrams,
+    }, meta=dict(meta or {}, sources=sources or {}, version=INDEX_VERSION))
+
+
+class RunnerIndex(object):
+    """
+    Read-only runner index backed by a snapshot file. Behaves like a dict
+    of runner name -> List[RunnerRacePerformance].
+    """
+
+    def __init__(self, f):
+        self._snapshot = Snapshot(f, 'runner_index')
+        self.meta = self._snapshot.meta
+        if self.meta.get('version') != INDEX_VERSION:
+            raise SnapshotError('Runner index version %s, expected %i: %s'
+                                % (self.meta.get('version'), INDEX_VERSION, f))
+        self.sources = self.meta['sources']
+        self._names = self._snapshot.strings('names')
+        self._offsets = self._snapshot['offsets']
+        self._perf_results = self._snapshot['perf_results']
+        self._perf_times = self._snapshot['perf_times']
+        self._perf_scores = self._snapshot['perf_scores']
+        self._results = [self._snapshot.strings(name) for name in
+                         ('result_ids', 'race_ids', 'race_names', 'dates')]
+        self._race_counts = numpy.diff(self._offsets)
+        self._trigrams = self._snapshot.strings('trigrams')
+        self._trigram_offsets = self._snapshot['trigram_offsets']
+        self._trigram_postings = self._snapshot['trigram_postings']
+        self._n_trigrams = self._snapshot['n_trigrams']
+
+    def _find(self, name):
+        i = bisect.bisect_left(_TableView(self._names), name)
+        if i < len(self._names) and self._names[i] == name:
+            return i
+        return None
+
+    def _trigram_postings_of(self, trigram):
+        i = bisect.bisect_left(_TableView(self._trigrams), trigram)
+        if i < len(self._trigrams) and self._trigrams[i] == trigram:
+            return self._trigram_postings[self._trigram_offsets[i]:
+                                          self._trigram_offsets[i + 1]]
+        return None
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, name):
+        return self._find(name) is not None
+
+    def __iter__(self):
+        for i in xrange(len(self._names)):
+            yield self._names[i]
+
+    def performances(self, i):
+        """
+        Returns:
+            List[RunnerRacePerformance]: the performances of the i-th runner
+                (in name order)
+        """
+        start, stop = self._offsets[i], self._offsets[i + 1]
+        result_ids, race_ids, race_names, dates = self._results
+        perfs = []
+        for r, time, score in zip(self._perf_results[start:stop].tolist(),
+                                  self._perf_times[start:stop].tolist(),
+                                  self._perf_scores[start:stop].tolist()):
+            if score != score:  # NaN
+                score = None
+            perfs.append(RunnerRacePerformance(result_ids[r], race_ids[r],
+                                               race_names[r], dates[r],
+                                               time, score))
+        return perfs
+
+    def __getitem__(self, name):
+        i = self._find(name)
+        if i is None:
+            raise KeyError(name)
+        return self.performances(i)
+
+    def get(self, name, default=None):
+        i = self._find(name)
+        if i is None:
+            return default
+        return self.performances(i)
+
+    def is_fresh(self, sources):
+        return self.sources == sources
+
+    def race_count(self, i):
+        return int(self._race_counts[i])
+
+    def prefix_search(self, prefix, limit=DEFAULT_SEARCH_LIMIT):
+        """
+        Returns:
+            List[Tuple[str, int, float]]: (name, race count, score) of the
+                runners whose name starts with `prefix`, those with the
+                most races first. The score is always 1.
+        """
+        names = _TableView(self._names)
+        start = bisect.bisect_left(names, prefix)
+        stop = bisect.bisect_left(names, prefix + '\xff', lo=start)
+        counts = self._race_counts[start:stop]
+        # stable, so ties stay in name order
+        order = numpy.argsort(-counts, kind='mergesort')[:limit]
+        return [(self._names[start + i], int(counts[i]), 1.)
+                for i in order.tolist()]
+
+    def fuzzy_search(self, query, limit=DEFAULT_SEARCH_LIMIT,
+                     min_similarity=MIN_SIMILARITY):
+        """
+        Returns:
+            List[Tuple[str, int, float]]: (name, race count, similarity) of
+                the runners whose names are most like `query`, best first.
+                The similarity is the Jaccard index of the two names'
+                trigrams.
+        """
+        query_trigrams = name_trigrams(query)
+        postings = [self._trigram_postings_of(t) for t in query_trigrams]
+        postings = [p for p in postings if p is not None]
+        if not postings:
+            return []
+        shared = numpy.bincount(numpy.concatenate(postings),
+                                minlength=len(self._names))
+        candidates = numpy.flatnonzero(shared)
+        shared = shared[candidates]
+        similarity = shared / (len(query_trigrams) +
+                               self._n_trigrams[candidates] - shared + 0.)
+        keep = similarity >= min_similarity
+        candidates, similarity = candidates[keep], similarity[keep]
+        counts = self._race_counts[candidates]
+        # best similarity, then most races, then name order
+        order = numpy.lexsort((-counts, -similarity))[:limit]
+        return [(self._names[int(candidates[i])], int(counts[i]),
+                 float(similarity[i])) for i in order.tolist()]
+
+    def search(self, query, limit=DEFAULT_SEARCH_LIMIT):
+        """
+        Prefix matches of `query`, topped up with fuzzy matches if there
+        are fewer than `limit`.
+
+        Returns:
+            List[Tuple[str, int, float]]: (name, race count, score)
+        """
+        matches = self.prefix_search(query, limit)
+        if len(matches) < limit:
+            seen = set(name for name, _, _ in matches)
+            for match in self.fuzzy_search(query, limit + len(matches)):
+                if match[0] not in seen:
+                    matches.append(match)
+                    if len(matches) == limit:
+                        break
+        return matches
+
+
+def source_signature(data_folder_fpath, results_fpath):
+    """
+    The mtimes and sizes of everything the runner index is built from, so
+    that a stale snapshot can be spotted.
+
+    Returns:
+        Dict[str, List[float]]: as floats, the way they come back from the
+            snapshot's JSON meta
+    """
+    sources = {}
+    for fname in ('rinfo.dat', 'result_to_race_index.dat', 'fit.snap',
+                  'race_theta.out'):
+        f = os.path.join(data_folder_fpath, fname)
+        if os.path.exists(f):
+            st = os.stat(f)
+            sources[fname] = [float(st.st_mtime), float(st.st_size)]
+
+    latest = 0.
+    n_files = 0
+    for fname in os.listdir(results_fpath):
+        latest = max(latest, os.stat(os.path.join(results_fpath, fname)).st_mtime)
+        n_files += 1
+    sources['results'] = [float(latest), float(n_files)]
+    return sources
+
+
+def _open_snapshot(f):
+    try:
+        return RunnerIndex(f)
+    except (IOError, SnapshotError):
+        return None
+
+
+def _build_snapshot(f, data_folder, result_folder, build_fn):
+    """
+    Builds the index with build_fn and writes it to the snapshot `f`.
+    The sources are read before building, so a change made during the
+    build leaves the new snapshot stale rather than missed.
+    """
+    sources = source_signature(data_folder.path(), result_folder.path())
+    start = time.time()
+    runner_index = build_fn(data_folder, result_folder)
+    build_time = time.time() - start
+    write_runner_index(f, runner_index, sources,
+                       meta={'built_at': time.time(), 'build_time': build_time})
+    return RunnerIndex(f)
+
+
+def open_runner_index(data_folder, result_folder, build_fn):
+    """
+    Opens the runner index snapshot in the data folder, first rebuilding it
+    with build_fn(data_folder, result_folder) if it is missing or any of
+    its sources have changed.
+
+    Returns:
+        RunnerIndex
+    """
+    f = data_folder.path(RUNNER_INDEX_SNAPSHOT)
+    runner_index = _open_snapshot(f)
+    sources = source_signature(data_folder.path(), result_folder.path())
+    if runner_index is not None and runner_index.is_fresh(sources):
+        return runner_index
+    return _build_snapshot(f, data_folder, result_folder, build_fn)
+
+
+class LiveRunnerIndex(object):
+    """
+    Runner index that is rebuilt when its sources change.
+
+    Lookups go to the current RunnerIndex, which is replaced as a whole
+    once a rebuild has finished, so a request never sees a half built
+    index. Until the first snapshot has been built there's no index and
+    every lookup misses.
+    """
+
+    def __init__(self, data_fpath, results_fpath, build_fn, check_interval=30.):
+        """
+        Args:
+            data_fpath (str): data folder, where the snapshot is kept
+            results_fpath (str): results folder
+            build_fn (Callable[[DataFolder, ResultsFolder], Dict]): e.g.
+                scripts.runner_lookup.build_runner_index
+            check_interval (float): seconds between checks for changed
+                sources in the background thread
+        """
+        self._data_fpath = data_fpath
+        self._results_fpath = results_fpath
+        self._build_fn = build_fn
+        self.check_interval = check_interval
+        self._f = os.path.join(data_fpath, RUNNER_INDEX_SNAPSHOT)
+        self._build_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.index = _open_snapshot(self._f)
+        # the store as it was compiled for the last build, if there is one
+        self.store = ResultsStore(results_fpath)
+        self.version = 0 if self.index is None else 1
+        self.building = False
+        self.last_error = None
+
+    def get(self, name, default=None):
+        index = self.index
+        if index is None:
+            return default
+        return index.get(name, default)
+
+    def __contains__(self, name):
+        index = self.index
+        return index is not None and name in index
+
+    def search(self, query, limit=DEFAULT_SEARCH_LIMIT, mode='search'):
+        """
+        Args:
+            mode (str): 'prefix', 'fuzzy' or 'search' (both), see the
+                RunnerIndex methods of the same names
+
+        Returns:
+            List[Tuple[str, int, float]]: (name, race count, score)
+        """
+        index = self.index
+        if index is None:
+            return []
+        if mode == 'prefix':
+            return index.prefix_search(query, limit)
+        if mode == 'fuzzy':
+            return index.fuzzy_search(query, limit)
+        return index.search(query, limit)
+
+    def is_stale(self):
+        index = self.index
+        if index is None:
+            return True
+        return not index.is_fresh(source_signature(self._data_fpath,
+                                                   self._results_fpath))
+
+    def refresh(self):
+        """
+        Rebuilds the index if it's stale. Does nothing if a rebuild is
+        already running in another thread.
+
+        Returns:
+            bool: True if a new index was swapped in
+        """
+        if not self._build_lock.acquire(False):
+            return False
+        try:
+            if not self.is_stale():
+                return False
+            self.building = True
+            # fresh folders, so the build doesn't share cached tables with
+            # the ones serving requests
+            data_folder = DataFolder(self._data_fpath)
+            # parse in this thread: forking a pool from a thread of a
+            # threaded server isn't safe
+            result_folder = ResultsFolder(self._results_fpath).compile(
+                processes=1)
+            index = _build_snapshot(self._f, data_folder, result_folder,
+                                    self._build_fn)
+            self.store = result_folder.store
+            self.index = index
+            self.version += 1
+            self.last_error = None
+            return True
+        finally:
+            self.building = False
+            self._build_lock.release()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+            except Exception as e:
+                self.last_error = '%s: %s' % (type(e).__name__, e)
+            self._stop.wait(self.check_interval)
+
+    def start(self):
+        """
+        Starts checking for changes, and rebuilding, in a daemon thread.
+        """
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='runner-index-refresh')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def status(self):
+        """
+        Returns:
+            Dict: version of the index being served (0 = none yet), when it
+                was built and how long that took, whether its sources have
+                changed since, whether a rebuild is running and the error
+                from the last failed rebuild
+        """
+        index = self.index
+        meta = index.meta if index is not None else {}
+        return {'version': self.version,
+                'runners': len(index) if index is not None else 0,
+                'built_at': meta.get('built_at'),
+                'build_time': meta.get('build_time'),
+                'stale': self.is_stale(),
+                'building': self.building,
+                'last_error': self.last_error}
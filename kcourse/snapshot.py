@@ -0,0 +1,145 @@
+"""
+Versioned binary snapshot files of named, typed arrays.
+
+A snapshot is a single file: a short fixed header, a JSON table of
+contents, then the raw bytes of every array, each aligned so that they can
+be viewed in place. Opening a snapshot memory-maps the file, so loading
+costs next to nothing, the arrays are only paged in as they are used, and
+several processes reading the same snapshot share its pages.
+
+Lists of strings are stored as a StringTable, i.e. a byte blob and an
+array of offsets.
+
+Snapshots are written to a temporary file and renamed in to place, so a
+reader never sees a half written file and readers holding the old
+snapshot open keep a consistent view of it.
+"""
+import json
+import mmap
+import os
+import struct
+import tempfile
+
+import numpy
+
+from kcourse.store import StringTable
+
+
+MAGIC = 'KCSNAP'
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+_HEADER = struct.Struct('<6sHQ')  # magic, format version, TOC length
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+def _padding(offset):
+    return -offset % ALIGNMENT
+
+
+def write_snapshot(f, kind, arrays, strings=None, meta=None):
+    """
+    Args:
+        f (str): path of the snapshot file
+        kind (str): what the snapshot holds (e.g. 'fit'), checked on load
+        arrays (Dict[str, numpy.ndarray])
+        strings (Dict[str, List[str]]): string lists to store as tables
+        meta (Dict): any other JSON serialisable information
+    """
+    arrays = dict((name, numpy.ascontiguousarray(a))
+                  for name, a in arrays.iteritems())
+    for name, values in (strings or {}).iteritems():
+        blob, offsets = StringTable.from_strings(values).arrays()
+        arrays[name + '_blob'] = blob
+        arrays[name + '_offsets'] = offsets
+
+    toc = {'kind': kind, 'meta': meta or {}, 'arrays': {},
+           'strings': sorted(strings or {})}
+    offset = 0
+    for name in sorted(arrays):
+        a = arrays[name]
+        toc['arrays'][name] = {'dtype': a.dtype.str, 'shape': list(a.shape),
+                               'offset': offset}
+        offset += a.nbytes + _padding(a.nbytes)
+    toc_bytes = json.dumps(toc, sort_keys=True)
+    data_start = _HEADER.size + len(toc_bytes)
+    data_start += _padding(data_start)
+
+    # a temporary name of its own, so concurrent writers don't clash
+    fd, tmp_f = tempfile.mkstemp(prefix=os.path.basename(f) + '.',
+                                 suffix='.tmp', dir=os.path.dirname(f) or '.')
+    with os.fdopen(fd, 'wb') as f_out:
+        f_out.write(_HEADER.pack(MAGIC, FORMAT_VERSION, len(toc_bytes)))
+        f_out.write(toc_bytes)
+        f_out.write('\0' * (data_start - _HEADER.size - len(toc_bytes)))
+        for name in sorted(arrays):
+            a = arrays[name]
+            f_out.write(a.tostring())
+            f_out.write('\0' * _padding(a.nbytes))
+    os.chmod(tmp_f, 0644)  # mkstemp files are private to the owner
+    os.rename(tmp_f, f)
+
+
+class Snapshot(object):
+    """
+    Read-only, memory-mapped view of a snapshot file.
+    """
+
+    def __init__(self, f, kind=None):
+        self._f = f
+        with open(f, 'rb') as f_in:
+            header = f_in.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                raise SnapshotError('Truncated snapshot: %s' % f)
+            magic, version, toc_len = _HEADER.unpack(header)
+            if magic != MAGIC:
+                raise SnapshotError('Not a snapshot file: %s' % f)
+            if version != FORMAT_VERSION:
+                raise SnapshotError('Unsupported snapshot version %i: %s'
+                                    % (version, f))
+            toc = json.loads(f_in.read(toc_len))
+            if kind is not None and toc['kind'] != kind:
+                raise SnapshotError('Expected a %s snapshot, got %s: %s'
+                                    % (kind, toc['kind'], f))
+            size = os.fstat(f_in.fileno()).st_size
+            self._mmap = mmap.mmap(f_in.fileno(), size,
+                                   access=mmap.ACCESS_READ) if size else None
+
+        self.kind = toc['kind']
+        self.meta = toc['meta']
+        self._toc = toc['arrays']
+        self._string_names = set(toc['strings'])
+        self._data_start = _HEADER.size + toc_len
+        self._data_start += _padding(self._data_start)
+        self._tables = {}
+
+    def __contains__(self, name):
+        return name in self._toc or name in self._string_names
+
+    def __getitem__(self, name):
+        """
+        Returns:
+            numpy.ndarray: read-only view of the array in the mapped file
+        """
+        entry = self._toc[name]
+        dtype = numpy.dtype(str(entry['dtype']))
+        count = int(numpy.prod(entry['shape'])) if entry['shape'] else 1
+        if not count:
+            return numpy.zeros(entry['shape'], dtype=dtype)
+        a = numpy.frombuffer(self._mmap, dtype=dtype, count=count,
+                             offset=self._data_start + entry['offset'])
+        return a.reshape(entry['shape'])
+
+    def strings(self, name):
+        """
+        Returns:
+            StringTable
+        """
+        if name not in self._tables:
+            if name not in self._string_names:
+                raise KeyError(name)
+            self._tables[name] = StringTable(self[name + '_blob'],
+                                             self[name + '_offsets'])
+        return self._tables[name]
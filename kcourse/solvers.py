@@ -0,0 +1,150 @@
+"""
+Direct (non gradient based) solvers for the standard runner model.
+
+The solvers work on the flat observation arrays held by an ArrayScorer:
+`race_idx`, `runner_idx`, `times` and `obs_winning_times`, plus the
+`n_races` and `n_runners` counts.
+"""
+import numpy
+import scipy.sparse
+import scipy.sparse.linalg
+
+from kcourse.optimize import grad_norm, has_converged, make_reporter
+
+
+def logspace_system(scorer, gauge_weight=1.0):
+    """
+    Builds the sparse linear least squares system for the log of the model.
+
+    t = d * h * t_win becomes log(t / t_win) = log(d) + log(h), so every
+    result contributes one row with a 1 in its race column and a 1 in its
+    runner column. The model is only defined up to a scale factor shared
+    between races and runners, so a final gauge row pins the mean log
+    runner score to zero.
+
+    Returns:
+        Tuple[scipy.sparse.csr_matrix, numpy.ndarray]: design matrix and
+            right hand side
+    """
+    n_obs = len(scorer.times)
+    n_races = scorer.n_races
+    n_runners = scorer.n_runners
+
+    obs_rows = numpy.arange(n_obs)
+    rows = numpy.concatenate((obs_rows, obs_rows,
+                              numpy.repeat(n_obs, n_runners)))
+    cols = numpy.concatenate((scorer.race_idx,
+                              n_races + scorer.runner_idx,
+                              n_races + numpy.arange(n_runners)))
+    data = numpy.concatenate((numpy.ones(2 * n_obs),
+                              numpy.repeat(gauge_weight / n_runners, n_runners)))
+    A = scipy.sparse.csr_matrix((data, (rows, cols)),
+                                shape=(n_obs + 1, n_races + n_runners))
+
+    b = numpy.zeros(n_obs + 1)
+    b[:n_obs] = numpy.log(scorer.times / scorer.obs_winning_times)
+    return A, b
+
+
+def logspace_solve(scorer, tol=1e-8, iter_lim=None):
+    """
+    Solves the log-space standard runner model directly with sparse LSQR.
+
+    The least squares error in log space only matches the relative error
+    used by Scorer.cost_function to first order, and the two optima are far
+    apart: on the full results the solution scores J=0.00935 against the
+    0.001785 of the relative-error fit, worse than 50 plain descent steps.
+    LSQR also takes several seconds on the full results. Use it as a warm
+    start for the iterative optimizers, not as a fit.
+
+    Returns:
+        Tuple[numpy.ndarray, numpy.ndarray]: race thetas and runner thetas
+    """
+    A, b = logspace_system(scorer)
+    x = scipy.sparse.linalg.lsqr(A, b, atol=tol, btol=tol,
+                                 iter_lim=iter_lim)[0]
+    thetas = numpy.exp(x)
+    return thetas[:scorer.n_races], thetas[scorer.n_races:]
+
+
+def _block_update(idx, coef, n, old):
+    """
+    Closed-form minimiser of sum((1 - x[idx] * coef)**2) for every x.
+    Parameters with no observations keep their old value.
+    """
+    num = numpy.bincount(idx, weights=coef, minlength=n)
+    den = numpy.bincount(idx, weights=coef * coef, minlength=n)
+    new = old.copy()
+    has_obs = den > 0
+    new[has_obs] = num[has_obs] / den[has_obs]
+    return new
+
+
+def als_minimize(scorer, initial_params, niters, J_logger_fn=None, tol=None,
+                 trace=None):
+    """
+    Fits the model by alternating closed-form updates of the race and
+    runner thetas (block coordinate descent).
+
+    With the runner thetas h fixed, each observation's relative error is
+    1 - d * a with a = h * t_win / t, so the best race theta is
+    sum(a) / sum(a**2) over that race's results, and likewise for the
+    runners given the races. Every sweep costs O(number of results) and J
+    can never increase, so there is no learning rate to tune.
+
+    Takes and returns the same arguments as the kcourse.optimize optimizers,
+    but needs the scorer itself rather than its cost function.
+    """
+    report = make_reporter(J_logger_fn, trace)
+
+    params = numpy.array(initial_params, dtype=float)
+    race_theta = params[:scorer.n_races]
+    runner_theta = params[scorer.n_races:]
+    ratio = scorer.obs_winning_times / scorer.times
+
+    J, _ = scorer.unrolled_cost_function(params)
+    for _ in xrange(niters):
+        coef = runner_theta[scorer.runner_idx] * ratio
+        race_theta = _block_update(scorer.race_idx, coef,
+                                   scorer.n_races, race_theta)
+        coef = race_theta[scorer.race_idx] * ratio
+        runner_theta = _block_update(scorer.runner_idx, coef,
+                                     scorer.n_runners, runner_theta)
+
+        J0 = J
+        params = numpy.concatenate((race_theta, runner_theta))
+        J, grads = scorer.unrolled_cost_function(params)
+        report(J, grad_norm(grads), params)
+        if has_converged(J, J0, tol):
+            break
+
+    return J, params
+
+
+def fill_new_params(scorer, race_theta0, runner_theta0):
+    """
+    Initialises the races and runners marked with NaN in a warm start.
+
+    New races get their closed-form best fit given the known runners, then
+    new runners get theirs given the races. Anything still without a value
+    (e.g. a new race where every runner is also new) starts at 1.0.
+    """
+    race_theta = numpy.array(race_theta0, dtype=float)
+    runner_theta = numpy.array(runner_theta0, dtype=float)
+    new_races = numpy.isnan(race_theta)
+    new_runners = numpy.isnan(runner_theta)
+    ratio = scorer.obs_winning_times / scorer.times
+
+    known = ~new_runners[scorer.runner_idx]
+    coef = runner_theta[scorer.runner_idx[known]] * ratio[known]
+    fitted = _block_update(scorer.race_idx[known], coef, scorer.n_races,
+                           race_theta)
+    race_theta[new_races] = fitted[new_races]
+    race_theta[numpy.isnan(race_theta)] = 1.0
+
+    coef = race_theta[scorer.race_idx] * ratio
+    fitted = _block_update(scorer.runner_idx, coef, scorer.n_runners,
+                           runner_theta)
+    runner_theta[new_runners] = fitted[new_runners]
+    runner_theta[numpy.isnan(runner_theta)] = 1.0
+    return race_theta, runner_theta
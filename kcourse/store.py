@@ -0,0 +1,365 @@
+"""
+Compiled columnar copy of a results folder.
+
+Parsing every results csv is slow, and almost every tool
+does it again from scratch. A ResultsStore holds the parsed rows of every
+file in a folder as flat numpy arrays (finish times plus interned name,
+club and category ids), with each file's rows stored contiguously in its
+original order. The arrays and string tables are saved as .npy files and
+memory-mapped on load.
+
+The store remembers the mtime and size of every file it was built from.
+update() re-parses only the files that have changed, been added or been
+removed since then, spread over a process pool.
+
+Each version of the store is written to its own data directory, and
+manifest.json names the current one. Replacing the manifest is the only
+step that changes what readers see, so several processes can update
+and read the same store at once: a reader gets either the old or the new
+version, never a mix, and one that has the old version mapped keeps it.
+"""
+import errno
+import fcntl
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+import numpy
+
+from kcourse.file_tools import parse_results_file
+
+
+STORE_VERSION = 2
+DATA_PREFIX = 'data-'
+TMP_PREFIX = 'tmp-'
+INGEST_CHUNKSIZE = 16
+
+
+def iter_parsed_files(fpaths, processes=None, chunksize=INGEST_CHUNKSIZE):
+    """
+    parse_results_file over many files, on a pool of `processes` worker
+    processes. Files are handed to the workers `chunksize` at a time, and
+    the parsed files come back in the same order as `fpaths` whatever
+    order the workers finish in.
+
+    Args:
+        processes (int): size of the process pool. None uses every core, 1
+            parses the files in this process.
+
+    Yields:
+        Tuple[List[str], List[str], List[str], List[int], Dict[str, int]]:
+            parse_results_file output for each file
+    """
+    if processes == 1 or len(fpaths) <= chunksize:
+        for fpath in fpaths:
+            yield parse_results_file(fpath)
+        return
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        for parsed in pool.imap(parse_results_file, fpaths, chunksize):
+            yield parsed
+    finally:
+        pool.close()
+        pool.join()
+
+
+class StringTable(object):
+    """
+    Immutable table of strings, stored as one byte blob plus offsets so that
+    it can be saved and memory-mapped like the other arrays.
+    """
+
+    def __init__(self, blob, offsets):
+        self._blob = blob
+        self._offsets = offsets
+        self._strings = None
+        self._index = None
+
+    @classmethod
+    def from_strings(cls, strings):
+        offsets = numpy.zeros(len(strings) + 1, dtype=numpy.int64)
+        offsets[1:] = numpy.cumsum([len(s) for s in strings])
+        blob = numpy.frombuffer(''.join(strings), dtype=numpy.uint8)
+        return cls(blob, offsets)
+
+    @classmethod
+    def load(cls, prefix, mmap_mode='r'):
+        blob = numpy.load(prefix + '_blob.npy', mmap_mode=mmap_mode)
+        offsets = numpy.load(prefix + '_offsets.npy', mmap_mode=mmap_mode)
+        return cls(blob, offsets)
+
+    def save(self, prefix):
+        numpy.save(prefix + '_blob.npy', self._blob)
+        numpy.save(prefix + '_offsets.npy', self._offsets)
+
+    def arrays(self):
+        """
+        Returns:
+            Tuple[numpy.ndarray, numpy.ndarray]: the byte blob and offsets
+        """
+        return self._blob, self._offsets
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        if self._strings is not None:
+            return self._strings[i]
+        return self._blob[self._offsets[i]:self._offsets[i + 1]].tostring()
+
+    def strings(self):
+        """
+        Returns:
+            List[str]: every string in the table, in id order
+        """
+        if self._strings is None:
+            data = self._blob.tostring()
+            offsets = self._offsets.tolist()
+            self._strings = [intern(data[offsets[i]:offsets[i + 1]])
+                             for i in xrange(len(offsets) - 1)]
+        return self._strings
+
+    def index(self):
+        """
+        Returns:
+            Dict[str, int]: mapping of string -> id
+        """
+        if self._index is None:
+            self._index = dict((s, i) for i, s in enumerate(self.strings()))
+        return self._index
+
+
+class _Interner(object):
+
+    def __init__(self):
+        self.index = {}
+        self.strings = []
+
+    def __call__(self, s):
+        try:
+            return self.index[s]
+        except KeyError:
+            idx = self.index[s] = len(self.strings)
+            self.strings.append(s)
+            return idx
+
+
+class ResultsStore(object):
+    """
+    Columnar copy of the parsed rows of every csv file in a results folder.
+    """
+
+    COLUMNS = ('times', 'name_ids', 'club_ids', 'category_ids')
+    TABLES = ('names', 'clubs', 'categories')
+
+    def __init__(self, results_fpath, store_fpath=None):
+        if store_fpath is None:
+            store_fpath = results_fpath.rstrip(os.sep) + '.store'
+        self._results_fpath = results_fpath
+        self._f = store_fpath
+        self._files = {}
+        self._order = []
+        self.times = numpy.zeros(0, dtype=numpy.int32)
+        self.name_ids = numpy.zeros(0, dtype=numpy.int32)
+        self.club_ids = numpy.zeros(0, dtype=numpy.int32)
+        self.category_ids = numpy.zeros(0, dtype=numpy.int32)
+        self.names = StringTable.from_strings([])
+        self.clubs = StringTable.from_strings([])
+        self.categories = StringTable.from_strings([])
+        self._load()
+
+    def _path(self, name):
+        return os.path.join(self._f, name)
+
+    def _read_manifest(self):
+        try:
+            with open(self._path('manifest.json')) as f_in:
+                manifest = json.load(f_in)
+        except (IOError, ValueError):
+            return None
+        if manifest.get('version') != STORE_VERSION:
+            return None
+        return manifest
+
+    def _load(self):
+        # an update in another process can replace (and delete) the data
+        # between reading the manifest and opening the arrays, in which case
+        # the new manifest is read
+        for _ in xrange(3):
+            manifest = self._read_manifest()
+            if manifest is None:
+                return
+            data_f = self._path(manifest['data'])
+            try:
+                columns = dict((column, numpy.load(
+                    os.path.join(data_f, column + '.npy'), mmap_mode='r'))
+                    for column in self.COLUMNS)
+                tables = dict((table, StringTable.load(
+                    os.path.join(data_f, table))) for table in self.TABLES)
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            break
+        else:
+            return
+
+        for column in self.COLUMNS:
+            setattr(self, column, columns[column])
+        for table in self.TABLES:
+            setattr(self, table, tables[table])
+        self._order = []
+        self._files = {}
+        for result_id, mtime, size, start, stop in manifest['files']:
+            result_id = str(result_id)
+            self._order.append(result_id)
+            self._files[result_id] = (mtime, size, start, stop)
+
+    def _save(self):
+        """
+        Writes this version of the store to a new data directory, then
+        switches manifest.json over to it and deletes the old versions.
+        """
+        if not os.path.isdir(self._f):
+            os.makedirs(self._f)
+        # mkdtemp and mkstemp give every process its own temporary names
+        tmp_data_f = tempfile.mkdtemp(prefix=TMP_PREFIX, dir=self._f)
+        os.chmod(tmp_data_f, 0755)  # mkdtemp directories are private
+        for column in self.COLUMNS:
+            numpy.save(os.path.join(tmp_data_f, column + '.npy'),
+                       getattr(self, column))
+        for table in self.TABLES:
+            getattr(self, table).save(os.path.join(tmp_data_f, table))
+
+        data_fname = DATA_PREFIX + os.path.basename(tmp_data_f)[len(TMP_PREFIX):]
+        files = [[result_id] + list(self._files[result_id])
+                 for result_id in self._order]
+        fd, tmp_manifest_f = tempfile.mkstemp(prefix='manifest.', suffix='.tmp',
+                                              dir=self._f)
+        with os.fdopen(fd, 'w') as f_out:
+            json.dump({'version': STORE_VERSION, 'data': data_fname,
+                       'files': files}, f_out)
+        os.chmod(tmp_manifest_f, 0644)
+
+        # the lock stops another writer deleting this version's data between
+        # it being renamed in to place and the manifest pointing at it
+        with open(self._path('.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            os.rename(tmp_data_f, self._path(data_fname))
+            os.rename(tmp_manifest_f, self._path('manifest.json'))
+            for fname in os.listdir(self._f):
+                if fname.startswith(DATA_PREFIX) and fname != data_fname:
+                    shutil.rmtree(self._path(fname), ignore_errors=True)
+                elif fname.endswith('.npy'):  # left by version 1 stores
+                    os.remove(self._path(fname))
+
+    def _csv_stats(self):
+        stats = {}
+        for fname in os.listdir(self._results_fpath):
+            result_id, ext = os.path.splitext(fname)
+            if ext != '.csv':
+                continue
+            st = os.stat(os.path.join(self._results_fpath, fname))
+            stats[result_id] = (st.st_mtime, st.st_size)
+        return stats
+
+    def is_stale(self):
+        stats = self._csv_stats()
+        if set(stats) != set(self._files):
+            return True
+        return any(stats[r] != tuple(self._files[r][:2]) for r in stats)
+
+    def update(self, processes=None):
+        """
+        Brings the store up to date with the results folder, re-parsing only
+        the files that have changed since the store was built, and saves it.
+        Files are stored in result id order, so the store's contents don't
+        depend on the order the files were parsed or listed in.
+
+        Args:
+            processes (int): see iter_parsed_files
+
+        Returns:
+            int: number of files that had to be parsed
+        """
+        stats = self._csv_stats()
+        order = sorted(stats)
+        stale = [result_id for result_id in order
+                 if result_id not in self._files or
+                 tuple(self._files[result_id][:2]) != stats[result_id]]
+        if not stale and len(order) == len(self._order):
+            return 0
+
+        stale_fpaths = [os.path.join(self._results_fpath, result_id + '.csv')
+                        for result_id in stale]
+        parsed = iter_parsed_files(stale_fpaths, processes)
+        stale = set(stale)
+
+        names, clubs, categories = _Interner(), _Interner(), _Interner()
+        columns = dict((column, []) for column in self.COLUMNS)
+        files = {}
+        for result_id in order:
+            start = len(columns['times'])
+            if result_id in stale:
+                rows = zip(*next(parsed)[:4])
+            else:
+                rows = self.rows(result_id)
+            for name, club, category, time in rows:
+                columns['times'].append(time)
+                columns['name_ids'].append(names(name))
+                columns['club_ids'].append(clubs(club))
+                columns['category_ids'].append(categories(category))
+            files[result_id] = stats[result_id] + (start,
+                                                   len(columns['times']))
+
+        for column in self.COLUMNS:
+            setattr(self, column, numpy.array(columns[column],
+                                              dtype=numpy.int32))
+        self.names = StringTable.from_strings(names.strings)
+        self.clubs = StringTable.from_strings(clubs.strings)
+        self.categories = StringTable.from_strings(categories.strings)
+        self._files = files
+        self._order = order
+        self._save()
+        return len(stale)
+
+    def __contains__(self, result_id):
+        return result_id in self._files
+
+    def __iter__(self):
+        return iter(self._order)
+
+    def __len__(self):
+        return len(self._order)
+
+    def file_slice(self, result_id):
+        _, _, start, stop = self._files[result_id]
+        return slice(start, stop)
+
+    def rows(self, result_id):
+        """
+        Returns:
+            List[Tuple[str, str, str, int]]: the same (name, club, category,
+                time) rows that read_results_file gives for the file
+        """
+        sl = self.file_slice(result_id)
+        names = self.names.strings()
+        clubs = self.clubs.strings()
+        categories = self.categories.strings()
+        return [(names[n], clubs[c], categories[k], t) for n, c, k, t in
+                zip(self.name_ids[sl].tolist(), self.club_ids[sl].tolist(),
+                    self.category_ids[sl].tolist(), self.times[sl].tolist())]
+
+    def process(self, result_id):
+        """
+        Returns:
+            Dict[str, int]: mapping of runner name -> finish time (in
+                seconds), as RaceCsv.process
+        """
+        sl = self.file_slice(result_id)
+        names = self.names.strings()
+        return dict((names[n], t) for n, t in
+                    zip(self.name_ids[sl].tolist(), self.times[sl].tolist()))
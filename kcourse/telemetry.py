@@ -0,0 +1,135 @@
+"""
+Structured telemetry for model fits.
+
+A FitTrace records a line of JSON for every optimizer iteration (wall time,
+J, relative change in J, gradient norm and parameter update norm) and for
+every timed phase of a fit (ingest, index build, fit, output writing), so
+that solver modes can be compared and regressions spotted in production
+runs.
+"""
+import json
+import time
+from contextlib import contextmanager
+
+import numpy
+
+
+class FitTrace(object):
+
+    def __init__(self, f=None):
+        """
+        Args:
+            f (str): path of the JSONL trace file to write, or None to only
+                keep the records in memory
+        """
+        self._f_out = open(f, 'w') if f is not None else None
+        self.records = []
+        self._start_time = time.time()
+        self._last_time = self._start_time
+        self._last_J = None
+        self._last_params = None
+        self._n_iter = 0
+
+    def _write(self, record):
+        self.records.append(record)
+        if self._f_out is not None:
+            self._f_out.write(json.dumps(record, sort_keys=True) + '\n')
+            self._f_out.flush()
+
+    def iteration(self, J, grad_norm, params=None):
+        """
+        Records a single optimizer iteration. `params` is the parameter
+        vector that J was evaluated at and is used to work out how far the
+        optimizer moved since the previous iteration.
+        """
+        now = time.time()
+        rel_change = None
+        if self._last_J:
+            rel_change = (J - self._last_J) / self._last_J
+
+        step_norm = None
+        if params is not None:
+            params = numpy.array(params, dtype=float)
+            if self._last_params is not None:
+                step = params - self._last_params
+                step_norm = float(numpy.sqrt(numpy.dot(step, step)))
+            self._last_params = params
+
+        self._write({
+            'event': 'iteration',
+            'iteration': self._n_iter,
+            'elapsed': now - self._start_time,
+            'iter_time': now - self._last_time,
+            'J': float(J),
+            'rel_change': rel_change,
+            'grad_norm': float(grad_norm),
+            'step_norm': step_norm,
+        })
+        self._n_iter += 1
+        self._last_time = now
+        self._last_J = J
+
+    def meta(self, **values):
+        """
+        Records the settings a fit was run with, e.g. an optimizer's step
+        size, so that traces of different runs can be told apart.
+        """
+        record = {'event': 'meta'}
+        record.update(values)
+        self._write(record)
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Times the body of a with block as a named phase of the fit.
+        """
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            now = time.time()
+            self._write({
+                'event': 'phase',
+                'phase': name,
+                'time': now - start_time,
+                'elapsed': now - self._start_time,
+            })
+            # don't count the phase in the next iteration's time
+            self._last_time = now
+
+    def iterations(self):
+        return [r for r in self.records if r['event'] == 'iteration']
+
+    def phase_times(self):
+        """
+        Returns:
+            Dict[str, float]: total time spent in each phase
+        """
+        times = {}
+        for r in self.records:
+            if r['event'] == 'phase':
+                times[r['phase']] = times.get(r['phase'], 0.) + r['time']
+        return times
+
+    def close(self):
+        if self._f_out is not None:
+            self._f_out.close()
+            self._f_out = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+@contextmanager
+def maybe_phase(trace, name):
+    """
+    trace.phase(name) when there is a trace, otherwise a no-op.
+    """
+    if trace is None:
+        yield
+    else:
+        with trace.phase(name):
+            yield
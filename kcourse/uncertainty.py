@@ -0,0 +1,149 @@
+"""
+Approximate standard errors for the fitted race and runner thetas.
+
+The errors come from the curvature of the Scorer cost function at the fit,
+using the Gauss-Newton approximation to the Hessian, H = J^T J, where J is
+the Jacobian of the relative errors with respect to the thetas.
+
+Every runner theta only interacts with the races that runner has run, so
+the runner-runner block of H is diagonal. Eliminating it leaves a sparse
+Schur complement over the races alone, which is factorised once with a
+sparse LU. The runner variances then follow from the race covariances
+without ever forming a dense matrix over the runners.
+
+The model is only defined up to a scale shared between races and runners
+(within each connected component), so the errors are quoted with the
+overall scale of each component's race thetas held fixed. A component with
+a single race has nothing to fix that race's theta against, and a small
+component's scale isn't comparable with the rest, so both get an infinite
+error rather than one that looks precise.
+"""
+import numpy
+import scipy.sparse
+import scipy.sparse.linalg
+
+from kcourse.components import (connected_components, group_by_label,
+                                MIN_COMPONENT_RACES)
+
+
+def gauss_newton_blocks(scorer, race_theta, runner_theta):
+    """
+    Returns:
+        Tuple[numpy.ndarray, numpy.ndarray, scipy.sparse.csr_matrix]: the
+            diagonal race-race and runner-runner blocks of the Gauss-Newton
+            Hessian, and the (n_runners x n_races) runner-race block
+    """
+    race_theta = numpy.asarray(race_theta, dtype=float)
+    runner_theta = numpy.asarray(runner_theta, dtype=float)
+    d = race_theta[scorer.race_idx]
+    h = runner_theta[scorer.runner_idx]
+    c = scorer.obs_winning_times / scorer.times
+
+    H_dd = numpy.bincount(scorer.race_idx, weights=(h * c)**2,
+                          minlength=scorer.n_races)
+    H_hh = numpy.bincount(scorer.runner_idx, weights=(d * c)**2,
+                          minlength=scorer.n_runners)
+    H_hd = scipy.sparse.csr_matrix((d * h * c**2,
+                                    (scorer.runner_idx, scorer.race_idx)),
+                                   shape=(scorer.n_runners, scorer.n_races))
+    return H_dd, H_hh, H_hd
+
+
+def theta_stderrs(scorer, race_theta, runner_theta, block_size=64,
+                  min_component_races=MIN_COMPONENT_RACES):
+    """
+    Args:
+        scorer (ArrayScorer)
+        race_theta (Sequence[float])
+        runner_theta (Sequence[float])
+        block_size (int): number of race covariance columns worked out at
+            once, which bounds the memory used to O(block_size * n_runners)
+        min_component_races (int): races and runners in components with
+            fewer races than this (and always in single race components)
+            get an infinite error
+
+    Returns:
+        Tuple[numpy.ndarray, numpy.ndarray]: standard error of each race and
+            runner theta. Runners without any results get NaN.
+    """
+    race_theta = numpy.asarray(race_theta, dtype=float)
+    runner_theta = numpy.asarray(runner_theta, dtype=float)
+    n_races = scorer.n_races
+
+    _, _, err = scorer.errors(race_theta, runner_theta)
+    race_labels, runner_labels, n_components = connected_components(
+        scorer.race_idx, scorer.runner_idx, n_races, scorer.n_runners)
+    dof = len(err) - (n_races + scorer.n_runners - n_components)
+    sigma2 = numpy.dot(err, err) / max(dof, 1)
+
+    H_dd, H_hh, H_hd = gauss_newton_blocks(scorer, race_theta, runner_theta)
+    has_obs = H_hh > 0
+    inv_H_hh = numpy.zeros_like(H_hh)
+    inv_H_hh[has_obs] = 1. / H_hh[has_obs]
+
+    # Schur complement of the runner block, S = H_dd - H_dh H_hh^-1 H_hd
+    S = (scipy.sparse.diags(H_dd) -
+         H_hd.T.dot(scipy.sparse.diags(inv_H_hh)).dot(H_hd)).tocsc()
+
+    # S is singular along the gauge direction of each component, which
+    # moves that component's race thetas in proportion to themselves. Pin
+    # one anchor race per component to factorise it, then project the
+    # result so that the covariance is orthogonal to the gauge directions.
+    race_groups = group_by_label(race_labels, n_components)
+    null = numpy.zeros(n_races)
+    anchors = []
+    for races_c in race_groups:
+        if not len(races_c):  # a runner without any results
+            continue
+        null[races_c] = race_theta[races_c] / numpy.sqrt(
+            numpy.dot(race_theta[races_c], race_theta[races_c]))
+        anchors.append(races_c[numpy.argmax(H_dd[races_c])])
+    free = numpy.ones(n_races, dtype=bool)
+    free[anchors] = False
+    free_idx = numpy.flatnonzero(free)
+    if len(free_idx):
+        lu = scipy.sparse.linalg.splu(S[free_idx][:, free_idx])
+
+    def project(X):
+        # P X with P = I - sum_c n_c n_c^T
+        n_cols = X.shape[1]
+        idx = race_labels[:, None] * n_cols + numpy.arange(n_cols)
+        NtX = numpy.bincount(idx.ravel(), weights=(null[:, None] * X).ravel(),
+                             minlength=n_components * n_cols)
+        NtX = NtX.reshape(n_components, n_cols)
+        return X - null[:, None] * NtX[race_labels]
+
+    race_var = numpy.zeros(n_races)
+    runner_extra = numpy.zeros(scorer.n_runners)
+    H_hd_csc = H_hd.tocsc()
+    for start in xrange(0, n_races, block_size):
+        block = numpy.arange(start, min(start + block_size, n_races))
+        X = numpy.zeros((n_races, len(block)))
+        X[block, numpy.arange(len(block))] = 1.
+        X = project(X)
+        Y = numpy.zeros_like(X)
+        if len(free_idx):
+            Y[free_idx] = lu.solve(X[free_idx])
+        C_block = project(Y)  # columns `block` of the race covariance
+
+        race_var[block] = C_block[block, numpy.arange(len(block))]
+        # runner variance picks up w_u^T C w_u with w_u = H_hd[u, :]
+        WC = H_hd.dot(C_block)
+        W_block = H_hd_csc[:, block].tocoo()
+        runner_extra += numpy.bincount(
+            W_block.row, weights=W_block.data * WC[W_block.row, W_block.col],
+            minlength=scorer.n_runners)
+
+    runner_var = numpy.empty(scorer.n_runners)
+    runner_var.fill(numpy.nan)
+    runner_var[has_obs] = (inv_H_hh[has_obs] +
+                           inv_H_hh[has_obs]**2 * runner_extra[has_obs])
+
+    race_stderr = numpy.sqrt(sigma2 * numpy.maximum(race_var, 0.))
+    runner_stderr = numpy.sqrt(sigma2 * numpy.maximum(runner_var, 0.))
+
+    sizes = numpy.array([len(races_c) for races_c in race_groups])
+    unidentified = sizes < max(min_component_races, 2)
+    race_stderr[unidentified[race_labels]] = numpy.inf
+    runner_stderr[has_obs & unidentified[runner_labels]] = numpy.inf
+    return race_stderr, runner_stderr
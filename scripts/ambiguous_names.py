@@ -1,19 +1,18 @@
-import os
 from collections import defaultdict
-from kcourse.file_tools import read_result_to_race_index, read_results_file
+from kcourse.data import ResultsFolder
+from kcourse.file_tools import read_result_to_race_index
 
 
 def find_ambiguous_names():
     runner_clubs = defaultdict(set)
 
-    result_folder = 'results'
+    store = ResultsFolder('results').compile().store
     fname = 'result_to_race_index.dat'
     result_to_race, _ = read_result_to_race_index(fname)
     for race_id in result_to_race:
-        f = os.path.join(result_folder, race_id + '.csv')
-        if not os.path.exists(f):
+        if race_id not in store:
             continue
-        for name, club, category, time in read_results_file(f):
+        for name, club, category, time in store.rows(race_id):
             runner_clubs[name].add(club)
 
     ordered_names = sorted(runner_clubs.iteritems(),
@@ -27,12 +26,8 @@ def find_ambiguous_names():
 
 
 def print_all_clubs():
-    clubs = set()
-    result_folder = 'results'
-    for f in os.listdir(result_folder):
-        fpath = os.path.join(result_folder, f)
-        for name, club, category, time in read_results_file(fpath):
-            clubs.add(club)
+    store = ResultsFolder('results').compile().store
+    clubs = set(store.clubs.strings())
 
     print '\n'.join(sorted(clubs))
 
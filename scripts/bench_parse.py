@@ -0,0 +1,63 @@
+"""
+Times the per-line munge_line parser against the batch parse_results parser
+over every file in the results folder, and checks they agree.
+"""
+import os
+import time
+
+from kcourse.domain import RetiredRunner, BadName
+from kcourse.file_tools import munge_line, parse_results
+
+
+def parse_per_line(data):
+    rows = []
+    for line in data.split('\n')[1:]:
+        if not line:
+            continue
+        try:
+            rows.append(munge_line(line))
+        except (RetiredRunner, BadName):
+            continue
+    return rows
+
+
+def parse_batch(data):
+    names, clubs, categories, times, _ = parse_results(data)
+    return zip(names, clubs, categories, times)
+
+
+def bench(folder='results', repeats=3):
+    files = []
+    for fname in sorted(os.listdir(folder)):
+        with open(os.path.join(folder, fname)) as f_in:
+            files.append((fname, f_in.read()))
+
+    timings = {}
+    for label, parse in (('per-line', parse_per_line), ('batch', parse_batch)):
+        best = None
+        for _ in xrange(repeats):
+            start_time = time.time()
+            for _, data in files:
+                parse(data)
+            elapsed = time.time() - start_time
+            best = elapsed if best is None else min(best, elapsed)
+        timings[label] = best
+
+    mismatches = [fname for fname, data in files
+                  if parse_per_line(data) != parse_batch(data)]
+    rejected = {}
+    for _, data in files:
+        for reason, count in parse_results(data)[4].iteritems():
+            rejected[reason] = rejected.get(reason, 0) + count
+
+    print 'files: %d' % len(files)
+    print 'per-line: %.3fs' % timings['per-line']
+    print 'batch: %.3fs (%.1fx)' % (timings['batch'],
+                                    timings['per-line'] / timings['batch'])
+    print 'rejected: %s' % ', '.join('%s %d' % item
+                                     for item in sorted(rejected.iteritems()))
+    print 'mismatched files: %d %s' % (len(mismatches), ' '.join(mismatches))
+
+
+if __name__ == '__main__':
+    bench()
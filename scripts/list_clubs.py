@@ -1,5 +1,4 @@
-import os
-from kcourse.file_tools import read_results_file
+from kcourse.data import ResultsFolder
 
 
 def normalise_club1(s):
@@ -20,11 +19,8 @@ def normalise_club1(s):
 
 def list_clubs():
     folder = 'results'
-    clubs = set()
-    for f in os.listdir(folder):
-        fpath = os.path.join(folder, f)
-        for _, club, _, _ in read_results_file(fpath):
-            clubs.add(normalise_club1(club))
+    store = ResultsFolder(folder).compile().store
+    clubs = set(normalise_club1(club) for club in store.clubs.strings())
 
     print '\n'.join(sorted(clubs))
 
@@ -0,0 +1,12 @@
+from kcourse.data import ResultsFolder
+
+
+def precompress_results():
+    folder = 'results'
+    n = ResultsFolder(folder).precompress()
+    print 'Compressed %i results files' % n
+
+
+if __name__ == '__main__':
+
+    precompress_results()
@@ -10,12 +10,12 @@ def build_runner_index(data_folder, result_folder):
 
     runners = defaultdict(list)
 
+    registry = data_folder.runner_registry
     rinfo_table = data_folder.raceinfo
     result_to_race, _ = data_folder.result_to_race_index
     race_theta = data_folder.read_race_theta()
 
-    result_folder.get_resultset('552')
-    for result_id, race_id in result_to_race.iteritems():
+    for result_id, race_id in sorted(result_to_race.iteritems()):
         if result_id not in result_folder:
             continue
 
@@ -25,24 +25,29 @@ def build_runner_index(data_folder, result_folder):
             continue
         rinfo = rinfo_table[race_id]
 
-        std_time = resultset.winning_time * race_theta[result_id]
+        # results added since the last fit have no race theta yet, so
+        # their runners are indexed without a score
+        theta = race_theta.get(result_id)
+        std_time = resultset.winning_time * theta if theta else None
         race_name = rinfo.name
         date = rinfo.date
         for result_item in resultset:
             name = result_item.name
             time = result_item.time
+            registry.add(name)
 
-            score = 1.0 * time / std_time
+            score = 1.0 * time / std_time if std_time else None
             runner_perf = RunnerRacePerformance(result_id, race_id, race_name,
                                                 date, time, score)
             runners[name].append(runner_perf)
+    registry.save()
     return runners
 
 
 if __name__ == '__main__':
-    from kcourse.file_tools import DataFolder, ResultsFolder
+    from kcourse.data import DataFolder, ResultsFolder
     data_folder = DataFolder('data')
-    result_folder = ResultsFolder('results')
+    result_folder = ResultsFolder('results').compile()
     runner_index = build_runner_index(data_folder, result_folder)
 
     while True:
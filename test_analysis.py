@@ -1,6 +1,29 @@
+import gzip
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import numpy
 import kcourse.analysis as analysis
+import kcourse.components as components
+import kcourse.data as data
+import kcourse.minibatch as minibatch
 import kcourse.file_tools as ft
+import kcourse.optimize as optimize
+import kcourse.parse_cache as parse_cache
+import kcourse.registry as registry
+import kcourse.snapshot as snapshot
+import kcourse.solvers as solvers
+import kcourse.store as store
+import kcourse.telemetry as telemetry
+import kcourse.uncertainty as uncertainty
+from kcourse.data import DataFolder, RaceCsv, RaceInfoTable, ResultsFolder
+from kcourse.domain import EmptyResultSet, RaceInfo, RaceResultSet, ResultItem
 
 from os.path import join, dirname, abspath
 
@@ -39,6 +62,23 @@ class TestStringMunging(unittest.TestCase):
         self.assertEquals(expected_cat, cat)
         self.assertEquals(expected_time, time)
 
+    def test_parse_results(self):
+        lines = ['Daniel Miller,Endurance Store,M,00:34:04',
+                 'Miller,Daniel,Endurance Store,M,34:04',
+                 'D. Miller (Strava), ,M40,52\xe2\x80\x9904\xe2\x80\x9d',
+                 'Facebook,,,00:34:04',
+                 'Fred Smith,,,DNF',
+                 'Too,Few,Columns']
+        data = 'name,club,category,time\n' + '\n'.join(lines) + '\n'
+        names, clubs, categories, times, rejected = ft.parse_results(data)
+
+        expected = [ft.munge_line(line) for line in lines[:3]]
+        self.assertEquals(zip(names, clubs, categories, times), expected)
+        self.assertEquals(names, ['daniel miller', 'daniel miller',
+                                  'd miller ()'])
+        self.assertEquals(rejected, {'retired': 1, 'bad_name': 1,
+                                     'malformed': 1})
+
     def test_process_file(self):
         f = join(TEST_PAGES, '100.csv')
         runners = analysis.process_results_file(f)
@@ -93,4 +133,893 @@ class TestStringMunging(unittest.TestCase):
         self.assertEquals(race_grads[0], grad_d0)
 
         J, all_grads = scorer.unrolled_cost_function(d + h)
-        self.assertEquals(race_grads[0], all_grads[0])
\ No newline at end of file
+        self.assertEquals(race_grads[0], all_grads[0])
+
+class TestArrayScorer(unittest.TestCase):
+
+    def setUp(self):
+        rng = random.Random(1234)
+        n_races = 6
+        n_runners = 15
+        self.races = []
+        for _ in xrange(n_races):
+            runner_ids = rng.sample(xrange(n_runners), 8)
+            self.races.append(dict((r, rng.uniform(1000., 5000.))
+                                   for r in runner_ids))
+        self.winning_times = [min(r.values()) for r in self.races]
+        self.race_scores = [rng.uniform(0.8, 1.5) for _ in xrange(n_races)]
+        self.runner_scores = [rng.uniform(0.8, 2.0) for _ in xrange(n_runners)]
+        self.py_scorer = analysis.Scorer(self.races, n_races, n_runners,
+                                         self.winning_times)
+        self.np_scorer = analysis.ArrayScorer(self.races, n_races, n_runners,
+                                              self.winning_times)
+
+    def test_cost_function_parity(self):
+        J1, race_grads1, runner_grads1 = self.py_scorer.cost_function(
+            self.race_scores, self.runner_scores)
+        J2, race_grads2, runner_grads2 = self.np_scorer.cost_function(
+            self.race_scores, self.runner_scores)
+
+        self.assertAlmostEqual(J1, J2, places=12)
+        for g1, g2 in zip(race_grads1 + runner_grads1,
+                          list(race_grads2) + list(runner_grads2)):
+            self.assertAlmostEqual(g1, g2, places=12)
+
+    def test_unrolled_cost_function_parity(self):
+        params = self.race_scores + self.runner_scores
+        J1, grads1 = self.py_scorer.unrolled_cost_function(params)
+        J2, grads2 = self.np_scorer.unrolled_cost_function(params)
+        self.assertAlmostEqual(J1, J2, places=12)
+        self.assertEquals(len(grads1), len(grads2))
+        for g1, g2 in zip(grads1, grads2):
+            self.assertAlmostEqual(g1, g2, places=12)
+
+    def test_error_summaries_parity(self):
+        errs1 = list(self.py_scorer.race_errors(self.race_scores,
+                                                self.runner_scores))
+        errs2 = self.np_scorer.race_errors(self.race_scores,
+                                           self.runner_scores)
+        for e1, e2 in zip(errs1, errs2):
+            self.assertAlmostEqual(e1, e2, places=12)
+
+        runner_errs1 = self.py_scorer.runner_errors(self.race_scores,
+                                                    self.runner_scores)
+        runner_errs2 = self.np_scorer.runner_errors(self.race_scores,
+                                                    self.runner_scores)
+        self.assertEquals(len(runner_errs1), len(runner_errs2))
+        for d1, d2 in zip(runner_errs1, runner_errs2):
+            self.assertEquals(sorted(d1), sorted(d2))
+            for race_id in d1:
+                self.assertAlmostEqual(d1[race_id], d2[race_id], places=12)
+
+    def test_create_scorer2_engine(self):
+        scorer = analysis.create_scorer2(self.races, range(15),
+                                         self.winning_times, engine='numpy')
+        self.assertTrue(isinstance(scorer, analysis.ArrayScorer))
+
+
+class TestOptimizers(unittest.TestCase):
+
+    def setUp(self):
+        race_data = [
+            {0: 1.0, 1: 2.0},
+            {0: 2.0, 1: 4.0}
+        ]
+        winning_times = [1.0, 2.0]
+        self.scorer = analysis.ArrayScorer(race_data, 2, 2, winning_times)
+        self.params0 = [1.0, 1.0, 1.0, 1.0]
+        self.J0, _ = self.scorer.unrolled_cost_function(self.params0)
+
+    def check_optimizer(self, name, niters, **kwargs):
+        J_vals = []
+        trace = telemetry.FitTrace()
+
+        def J_logger(J):
+            J_vals.append(J)
+
+        minimize = optimize.OPTIMIZERS[name]
+        J, params = minimize(self.scorer.unrolled_cost_function,
+                             self.params0, niters, J_logger, trace=trace,
+                             **kwargs)
+        self.assertTrue(J_vals)
+        self.assertEquals(J_vals, [r['J'] for r in trace.iterations()])
+        self.assertEquals(J, J_vals[-1])
+        self.assertTrue(J < self.J0)
+        J2, _ = self.scorer.unrolled_cost_function(params)
+        self.assertAlmostEqual(J, J2)
+        return J, J_vals
+
+    def test_descent(self):
+        self.check_optimizer('descent', 20, alpha=1.)
+
+    def test_descent_settings_traced(self):
+        trace = telemetry.FitTrace()
+        optimize.kminimize(self.scorer.unrolled_cost_function, self.params0,
+                           5, alpha=1., trace=trace)
+        self.assertEquals(trace.records[0], {'event': 'meta',
+                                             'optimizer': 'descent',
+                                             'n_params': 4, 'alpha': 1.})
+
+    def test_descent_stops_at_tolerance(self):
+        _, J_vals = self.check_optimizer('descent', 1000, alpha=1., tol=1e-3)
+        self.assertTrue(len(J_vals) < 1000)
+
+    def test_linesearch(self):
+        J, _ = self.check_optimizer('linesearch', 200, tol=1e-12)
+        self.assertTrue(J < 1e-8)
+
+    def test_lbfgs(self):
+        J, _ = self.check_optimizer('lbfgs', 50)
+        self.assertTrue(J < 1e-8)
+
+    def test_kminimize_importable_from_analysis(self):
+        self.assertTrue(analysis.kminimize is optimize.kminimize)
+
+    def test_lbfgs_tolerance_at_scale(self):
+        # gradients this small used to trip scipy's own gtol test, so
+        # every tolerance stopped at the same J
+        rng = random.Random(42)
+        n_races, n_runners = 200, 2000
+        runner_theta = [rng.uniform(1.0, 2.5) for _ in xrange(n_runners)]
+        races = []
+        for _ in xrange(n_races):
+            d = rng.uniform(0.8, 1.5)
+            races.append(dict(
+                (r, 1000. * d * runner_theta[r] * rng.lognormvariate(0, 0.05))
+                for r in rng.sample(xrange(n_runners), 80)))
+        winning_times = [min(r.values()) for r in races]
+        scorer = analysis.ArrayScorer(races, n_races, n_runners,
+                                      winning_times)
+        params0 = [1.0] * (n_races + n_runners)
+
+        J_loose, _ = optimize.lbfgs_minimize(scorer.unrolled_cost_function,
+                                             params0, 2000, tol=1e-3)
+        J_tight, _ = optimize.lbfgs_minimize(scorer.unrolled_cost_function,
+                                             params0, 2000, tol=1e-9)
+        self.assertTrue(J_tight < J_loose * (1 - 1e-4))
+
+
+class TestLogspaceSolve(unittest.TestCase):
+
+    def test_recovers_exact_model(self):
+        race_theta = [1.2, 1.5, 1.1]
+        runner_theta = [1.0, 1.3, 0.9, 1.6]
+        winning_time = 1000.
+        races = []
+        for d in race_theta:
+            races.append(dict((runner_id, d * h * winning_time)
+                              for runner_id, h in enumerate(runner_theta)))
+        winning_times = [winning_time] * len(races)
+        scorer = analysis.ArrayScorer(races, len(races), len(runner_theta),
+                                      winning_times)
+
+        race_fit, runner_fit = solvers.logspace_solve(scorer)
+
+        # the fit is only defined up to a scale shared between races and
+        # runners, and the gauge puts the geometric mean runner at 1.0
+        scale = numpy.exp(numpy.mean(numpy.log(runner_theta)))
+        for expected, returned in zip(race_theta, race_fit):
+            self.assertAlmostEqual(expected * scale, returned, places=6)
+        for expected, returned in zip(runner_theta, runner_fit):
+            self.assertAlmostEqual(expected / scale, returned, places=6)
+
+        J, _, _ = scorer.cost_function(race_fit, runner_fit)
+        self.assertAlmostEqual(J, 0.0, places=10)
+
+
+class TestAlternatingSolve(unittest.TestCase):
+
+    def test_monotone_decrease(self):
+        rng = random.Random(42)
+        races = []
+        for _ in xrange(5):
+            runner_ids = rng.sample(xrange(12), 7)
+            races.append(dict((r, rng.uniform(1000., 3000.))
+                              for r in runner_ids))
+        winning_times = [min(r.values()) for r in races]
+        scorer = analysis.ArrayScorer(races, 5, 12, winning_times)
+
+        J_vals = []
+        J, params = solvers.als_minimize(scorer, [1.0] * 17, 50,
+                                         J_vals.append,
+                                         tol=1e-12)
+        J0, _ = scorer.unrolled_cost_function([1.0] * 17)
+        self.assertTrue(J_vals[0] <= J0)
+        for J_prev, J_next in zip(J_vals, J_vals[1:]):
+            self.assertTrue(J_next <= J_prev + 1e-15)
+        self.assertEquals(J, J_vals[-1])
+
+    def test_fits_exact_model(self):
+        race_data = [
+            {0: 1.0, 1: 2.0},
+            {0: 2.0, 1: 4.0}
+        ]
+        scorer = analysis.ArrayScorer(race_data, 2, 2, [1.0, 2.0])
+        J, params = solvers.als_minimize(scorer, [1.0] * 4, 100, tol=1e-15)
+        self.assertAlmostEqual(J, 0.0, places=10)
+
+
+class TestWarmStart(unittest.TestCase):
+
+    def test_fill_new_params(self):
+        race_theta = [1.2, 1.5, 1.1]
+        runner_theta = [1.0, 1.3, 0.9, 1.6]
+        races = []
+        for d in race_theta:
+            races.append(dict((runner_id, d * h * 1000.)
+                              for runner_id, h in enumerate(runner_theta)))
+        scorer = analysis.ArrayScorer(races, 3, 4, [1000.] * 3)
+
+        nan = float('nan')
+        race_theta0 = [1.2, nan, 1.1]
+        runner_theta0 = [1.0, 1.3, 0.9, nan]
+        race_fit, runner_fit = solvers.fill_new_params(scorer, race_theta0,
+                                                       runner_theta0)
+        for expected, returned in zip(race_theta, race_fit):
+            self.assertAlmostEqual(expected, returned)
+        for expected, returned in zip(runner_theta, runner_fit):
+            self.assertAlmostEqual(expected, returned)
+
+    def test_previous_theta0(self):
+        folder = tempfile.mkdtemp()
+        try:
+            data_folder = DataFolder(folder)
+            data_folder.write_race_theta(['11', '22'], [1.25, 1.5])
+            data_folder.write_runner_theta(['bob graham', 'joss naylor'],
+                                           [1.125, 0.875])
+
+            race_theta0, runner_theta0 = analysis.previous_theta0(
+                data_folder, ['22', '33'], ['joss naylor', 'new runner'])
+            self.assertEquals(race_theta0[0], 1.5)
+            self.assertTrue(numpy.isnan(race_theta0[1]))
+            self.assertEquals(runner_theta0[0], 0.875)
+            self.assertTrue(numpy.isnan(runner_theta0[1]))
+        finally:
+            shutil.rmtree(folder)
+
+
+class TestComponents(unittest.TestCase):
+
+    def setUp(self):
+        # races 0 and 2 share runner 1, race 1 is an island of its own
+        self.races = [
+            {0: 100., 1: 120.},
+            {2: 200., 3: 260.},
+            {1: 300., 4: 330.},
+        ]
+        self.scorer = analysis.ArrayScorer(self.races, 3, 5,
+                                           [100., 200., 300.])
+
+    def test_connected_components(self):
+        race_labels, runner_labels, n = components.connected_components(
+            self.scorer.race_idx, self.scorer.runner_idx, 3, 5)
+        self.assertEquals(n, 2)
+        self.assertEquals(list(race_labels), [0, 1, 0])
+        self.assertEquals(list(runner_labels), [0, 0, 1, 1, 0])
+
+    def test_fit_by_component(self):
+        params, race_labels, sizes = analysis.fit_by_component(
+            self.scorer, [1.0] * 8, 200, optimizer='als', tol=1e-15,
+            processes=1)
+        self.assertEquals([list(s) for s in sizes], [[2, 3], [1, 2]])
+        J, _ = self.scorer.unrolled_cost_function(params)
+        self.assertAlmostEqual(J, 0.0, places=10)
+
+
+def make_data_folder():
+    """
+    Sets up a temporary data folder for the test_pages results so that
+    fits can write their outputs without touching the repo.
+    """
+    folder = tempfile.mkdtemp()
+    shutil.copy(join(TEST_PAGES, 'result_to_event_index.dat'),
+                join(folder, 'result_to_race_index.dat'))
+    with open(join(folder, 'rinfo.dat'), 'w') as f_out:
+        f_out.write('index\tname\tdate\tdistance_km\tclimb_m\n'
+                    'AAA\tRace A\t1-1-2017\t1.0\t1.0\n'
+                    'BBB\tRace B\t2-2-2017\t2.0\t2.0\n'
+                    'CCC\tRace C\t3-3-2017\t3.0\t3.0\n')
+    return folder
+
+
+class TestMinibatch(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = make_data_folder()
+        self.data_folder = DataFolder(self.folder)
+        # a copy, so the compiled store isn't written in to test_pages
+        self.results = join(self.folder, 'results')
+        shutil.copytree(join(TEST_PAGES, 'results'), self.results)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_race_stream(self):
+        stream = minibatch.RaceStream(self.data_folder, self.results)
+        self.assertEquals(sorted(stream.race_ids), ['111', '222', '333'])
+        self.assertEquals(sorted(stream.runners), ['dave', 'geoff'])
+        self.assertEquals(stream.n_obs, 6)
+
+        batches = list(stream.batches(2))
+        self.assertEquals(len(batches), 2)
+        self.assertEquals(sum(scorer.count for _, _, scorer in batches), 6)
+
+    def test_create_minibatch_scorer(self):
+        J_vals = []
+        minibatch.create_minibatch_scorer(
+            self.data_folder, 20, batch_size=2,
+            J_logger_fn=J_vals.append,
+            results_fpath=self.results)
+        self.assertEquals(len(J_vals), 20)
+        self.assertAlmostEqual(J_vals[-1], 0.0)
+
+        race_theta = self.data_folder.read_race_theta()
+        self.assertEquals(sorted(race_theta), ['111', '222', '333'])
+        runner_theta = self.data_folder.read_runner_theta()
+        self.assertAlmostEqual(race_theta['111'] * runner_theta['dave'], 1.0,
+                               places=3)
+
+        # every runner in the fit has a registry id
+        registry = self.data_folder.runner_registry
+        fit = self.data_folder.read_fit()
+        runners = fit.strings('runners').strings()
+        self.assertEquals(fit['runner_ids'].tolist(),
+                          [registry.get(name) for name in runners])
+        self.assertTrue((fit['runner_ids'] >= 0).all())
+
+
+class TestFitTrace(unittest.TestCase):
+
+    def test_iteration_records(self):
+        race_data = [
+            {0: 1.0, 1: 2.0},
+            {0: 2.0, 1: 4.0}
+        ]
+        scorer = analysis.ArrayScorer(race_data, 2, 2, [1.0, 2.0])
+        folder = tempfile.mkdtemp()
+        try:
+            fpath = join(folder, 'trace.jsonl')
+            with telemetry.FitTrace(fpath) as trace:
+                with trace.phase('fit'):
+                    optimize.kminimize(scorer.unrolled_cost_function,
+                                       [1.0] * 4, 5, alpha=1., trace=trace)
+            with open(fpath) as f_in:
+                records = [json.loads(line) for line in f_in]
+        finally:
+            shutil.rmtree(folder)
+
+        self.assertEquals(records, trace.records)
+        iterations = trace.iterations()
+        self.assertEquals(len(iterations), 6)
+        self.assertEquals(iterations[0]['step_norm'], None)
+        self.assertEquals(iterations[0]['rel_change'], None)
+        for record in iterations[1:]:
+            self.assertTrue(record['step_norm'] > 0)
+            self.assertTrue(record['rel_change'] < 0)
+        self.assertEquals(trace.phase_times().keys(), ['fit'])
+
+
+class TestUncertainty(unittest.TestCase):
+
+    def test_matches_dense_covariance(self):
+        rng = random.Random(3)
+        races = []
+        for _ in xrange(6):
+            runner_ids = rng.sample(xrange(10), 5)
+            races.append(dict((r, rng.uniform(1000., 2000.))
+                              for r in runner_ids))
+        races.append({10: 500., 11: 650.})  # an island
+        n_races, n_runners = len(races), 12
+        n = n_races + n_runners
+        winning_times = [min(r.values()) for r in races]
+        scorer = analysis.ArrayScorer(races, n_races, n_runners,
+                                      winning_times)
+        _, params = solvers.als_minimize(scorer, [1.0] * n, 500, tol=1e-14)
+        race_theta, runner_theta = params[:n_races], params[n_races:]
+
+        race_stderr, runner_stderr = uncertainty.theta_stderrs(
+            scorer, race_theta, runner_theta, block_size=3,
+            min_component_races=1)
+
+        # dense Gauss-Newton covariance, with the scale of each component's
+        # race thetas held fixed
+        jac = numpy.zeros((scorer.count, n))
+        c = scorer.obs_winning_times / scorer.times
+        for i, (r, u) in enumerate(zip(scorer.race_idx, scorer.runner_idx)):
+            jac[i, r] = -runner_theta[u] * c[i]
+            jac[i, n_races + u] = -race_theta[r] * c[i]
+        H = jac.T.dot(jac)
+        race_labels, _, k = components.connected_components(
+            scorer.race_idx, scorer.runner_idx, n_races, n_runners)
+        gauge = numpy.zeros((n, k))
+        gauge[numpy.arange(n_races), race_labels] = race_theta
+        q, _ = numpy.linalg.qr(numpy.hstack([gauge, numpy.eye(n)]))
+        Z = q[:, k:]
+        cov = Z.dot(numpy.linalg.inv(Z.T.dot(H).dot(Z))).dot(Z.T)
+        _, _, err = scorer.errors(race_theta, runner_theta)
+        sigma2 = numpy.dot(err, err) / (scorer.count - (n - k))
+        expected = numpy.sqrt(sigma2 * numpy.diag(cov))
+
+        # the island's single race can't be identified
+        self.assertEquals(race_stderr[6], numpy.inf)
+        self.assertEquals(list(runner_stderr[10:]), [numpy.inf] * 2)
+        expected = list(expected[:6]) + list(expected[n_races:n_races + 10])
+        returned = list(race_stderr[:6]) + list(runner_stderr[:10])
+        for e, r in zip(expected, returned):
+            self.assertAlmostEqual(e, r, places=8)
+
+    def test_small_components(self):
+        races = [{0: 1000., 1: 1100.}, {0: 1200., 1: 1290.},
+                 {1: 1500., 2: 1400.}, {2: 900., 3: 1000.},
+                 {3: 1800., 0: 1700.}, {0: 1000., 2: 1050.},
+                 {4: 500., 5: 550.}, {4: 600., 5: 700.}]
+        n_races, n_runners = len(races), 7  # runner 6 has no results
+        scorer = analysis.ArrayScorer(races, n_races, n_runners,
+                                      [min(r.values()) for r in races])
+        n = n_races + n_runners
+        _, params = solvers.als_minimize(scorer, [1.0] * n, 500, tol=1e-14)
+        race_stderr, runner_stderr = uncertainty.theta_stderrs(
+            scorer, params[:n_races], params[n_races:],
+            min_component_races=5)
+
+        self.assertTrue(numpy.all(numpy.isfinite(race_stderr[:6])))
+        self.assertTrue(numpy.all(race_stderr[:6] > 0))
+        self.assertEquals(list(race_stderr[6:]), [numpy.inf] * 2)
+        self.assertTrue(numpy.all(numpy.isfinite(runner_stderr[:4])))
+        self.assertEquals(list(runner_stderr[4:6]), [numpy.inf] * 2)
+        self.assertTrue(numpy.isnan(runner_stderr[6]))
+
+
+class TestSeasonalModel(unittest.TestCase):
+
+    def setUp(self):
+        # two runners race three times a season for two seasons, and
+        # runner 1 gets 20% slower in the second season
+        self.form = {(0, 2016): 1.0, (0, 2017): 1.0,
+                     (1, 2016): 1.1, (1, 2017): 1.32}
+        race_theta = [1.0, 1.2, 1.4]
+        races = []
+        self.seasons = []
+        for season in (2016, 2017):
+            for d in race_theta:
+                races.append(dict((runner_id, d * self.form[runner_id, season] * 1000.)
+                                  for runner_id in (0, 1)))
+                self.seasons.append(season)
+        self.scorer = analysis.ArrayScorer(races, len(races), 2,
+                                           [1000.] * len(races))
+
+    def fitted_form(self, smoothness):
+        _, pair_runner, pair_season, pair_theta = \
+            analysis.fit_seasonal_runner_model(self.scorer, self.seasons,
+                                               smoothness)
+        self.assertEquals(list(pair_runner), [0, 0, 1, 1])
+        self.assertEquals(list(pair_season), [2016, 2017, 2016, 2017])
+        return dict(((r, s), theta) for r, s, theta
+                    in zip(pair_runner, pair_season, pair_theta))
+
+    def test_tracks_change_in_form(self):
+        fitted = self.fitted_form(smoothness=1e-6)
+        for season in (2016, 2017):
+            expected = self.form[1, season] / self.form[0, season]
+            returned = fitted[1, season] / fitted[0, season]
+            self.assertAlmostEqual(expected, returned, places=4)
+
+    def test_smoothness_ties_seasons_together(self):
+        fitted = self.fitted_form(smoothness=1e6)
+        self.assertAlmostEqual(fitted[1, 2016], fitted[1, 2017], places=4)
+
+    def test_no_worse_than_single_score_fit(self):
+        rng = random.Random(7)
+        n_races, n_runners = 60, 300
+        runner_theta = [rng.uniform(1.0, 2.5) for _ in xrange(n_runners)]
+        races = []
+        seasons = []
+        for i in xrange(n_races):
+            d = rng.uniform(0.8, 1.5)
+            races.append(dict(
+                (r, 1000. * d * runner_theta[r] * rng.lognormvariate(0, 0.05))
+                for r in rng.sample(xrange(n_runners), 40)))
+            seasons.append(2015 + i % 3)
+        scorer = analysis.ArrayScorer(races, n_races, n_runners,
+                                      [min(r.values()) for r in races])
+        J_single, _ = optimize.lbfgs_minimize(
+            scorer.unrolled_cost_function, [1.0] * (n_races + n_runners),
+            5000, tol=1e-10)
+
+        for smoothness in (1e-3, 1.0, 1e3):
+            race_fit, pair_runner, pair_season, pair_theta = \
+                analysis.fit_seasonal_runner_model(scorer, seasons, smoothness)
+            form = dict(((r, s), theta) for r, s, theta
+                        in zip(pair_runner, pair_season, pair_theta))
+            h = [form[r, seasons[i]] for r, i in zip(scorer.runner_idx,
+                                                     scorer.race_idx)]
+            err = ((scorer.times - race_fit[scorer.race_idx] * h *
+                    scorer.obs_winning_times) / scorer.times)
+            J = 0.5 * numpy.dot(err, err) / scorer.count
+            self.assertTrue(J <= J_single * (1 + 1e-6), (smoothness, J, J_single))
+
+
+class TestResultsStore(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.results = join(self.folder, 'results')
+        shutil.copytree(join(TEST_PAGES, 'results'), self.results)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_matches_csv_parsing(self):
+        results_folder = ResultsFolder(self.results).compile()
+        for result_id in ('111', '222', '333'):
+            fpath = join(self.results, result_id + '.csv')
+            self.assertEquals(list(results_folder[result_id].data_rows()),
+                              list(ft.read_results_file(fpath)))
+            self.assertEquals(results_folder[result_id].process(),
+                              RaceCsv(fpath).process())
+
+    def test_reparses_changed_files_only(self):
+        self.assertEquals(store.ResultsStore(self.results).update(), 3)
+        self.assertEquals(store.ResultsStore(self.results).update(), 0)
+
+        with open(join(self.results, '222.csv'), 'a') as f_out:
+            f_out.write('Fred,,,0:00:03\n')
+        results_store = store.ResultsStore(self.results)
+        self.assertEquals(results_store.update(), 1)
+        self.assertEquals(results_store.process('222')['fred'], 3)
+        self.assertEquals(len(results_store.names), 3)
+
+    def test_update_swaps_whole_store(self):
+        store.ResultsStore(self.results).update()
+        reader = store.ResultsStore(self.results)
+        expected = reader.process('222')
+
+        with open(join(self.results, '222.csv'), 'a') as f_out:
+            f_out.write('Fred,,,0:00:03\n')
+        self.assertEquals(store.ResultsStore(self.results).update(), 1)
+
+        # the old version stays readable, and unchanged, while mapped
+        self.assertEquals(reader.process('222'), expected)
+        self.assertEquals(store.ResultsStore(self.results).process('222')['fred'],
+                          3)
+        store_files = os.listdir(self.results + '.store')
+        self.assertEquals(len([f for f in store_files
+                               if f.startswith(store.DATA_PREFIX)]), 1)
+        self.assertFalse([f for f in store_files if f.endswith('.tmp') or
+                          f.startswith(store.TMP_PREFIX)])
+
+    def test_parallel_parse_keeps_file_order(self):
+        fpaths = [join(self.results, result_id + '.csv')
+                  for result_id in ('333', '111', '222')]
+        expected = [ft.parse_results_file(fpath) for fpath in fpaths]
+        returned = list(store.iter_parsed_files(fpaths, processes=2,
+                                                chunksize=1))
+        self.assertEquals(expected, returned)
+
+
+class TestRunnerRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.f = join(self.folder, 'runner_registry.dat')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_ids_are_stable(self):
+        names = ['runner %d' % i for i in xrange(100)]
+        reg = registry.RunnerRegistry(self.f)
+        ids = [reg.add(name) for name in names]
+        self.assertEquals(ids, range(100))
+        self.assertEquals(reg.add('runner 5'), 5)
+        reg.save()
+
+        reg = registry.RunnerRegistry(self.f)
+        self.assertEquals([reg.get(name) for name in names], ids)
+        self.assertEquals(reg.get('someone new'), None)
+        self.assertEquals(reg.add('someone new'), 100)
+        self.assertEquals(reg[100], 'someone new')
+        reg.save()
+        self.assertEquals(len(registry.RunnerRegistry(self.f)), 101)
+
+    def test_rebuilds_stale_hash_table(self):
+        reg = registry.RunnerRegistry(self.f)
+        reg.add('dave')
+        reg.save()
+        with open(self.f, 'a') as f_out:
+            f_out.write('geoff\n')
+
+        reg = registry.RunnerRegistry(self.f)
+        self.assertEquals(reg.get('geoff'), 1)
+        self.assertTrue('dave' in reg)
+
+    def test_two_writers(self):
+        reg1 = registry.RunnerRegistry(self.f)
+        reg2 = registry.RunnerRegistry(self.f)
+        reg1.add('alice')
+        reg1.add('bob')
+        reg2.add('carol')
+        reg2.add('bob')
+        reg1.save()
+        reg2.save()
+        # reg2's runners are numbered after the ones reg1 saved first
+        self.assertEquals([reg2.get(name) for name in ('alice', 'bob', 'carol')],
+                          [0, 1, 2])
+
+        reg1.add('dave')
+        reg1.save()
+        self.assertEquals(reg1.get('carol'), 2)
+        self.assertEquals(reg1.get('dave'), 3)
+
+        reg = registry.RunnerRegistry(self.f)
+        self.assertEquals(reg.names, ['alice', 'bob', 'carol', 'dave'])
+        self.assertEquals(reg.get('bob'), 1)
+
+    def test_order(self):
+        reg1 = registry.RunnerRegistry(self.f)
+        reg2 = registry.RunnerRegistry(self.f)
+        reg1.add('bob')
+        reg2.add('carol')
+        reg2.save()
+        # bob's id changes when reg1 saves, after carol's
+        self.assertEquals(reg1.order(['dave', 'carol', 'bob']),
+                          ['carol', 'bob', 'dave'])
+        self.assertEquals(registry.RunnerRegistry(self.f).names,
+                          ['carol', 'bob', 'dave'])
+
+    def test_process_results_collection(self):
+        reg = registry.RunnerRegistry(self.f)
+        reg.add('geoff')
+        reg.add('nobody')
+        races, runners = analysis.process_results_collection(
+            [{'dave': 10, 'geoff': 12}, {'dave': 11}], reg)
+        self.assertEquals(runners, ['geoff', 'dave'])
+        self.assertEquals(races, [{0: 12, 1: 10}, {1: 11}])
+
+
+class TestRaceResultSet(unittest.TestCase):
+
+    def setUp(self):
+        items = [ResultItem('1', 0, 'dave', 'kc', 'm', 100),
+                 ResultItem('1', 1, 'geoff', '', 'm40', 130),
+                 ResultItem('1', 2, 'fred', 'kc', 'm', 110),
+                 ResultItem('1', 3, 'jim', '', 'm', 130)]
+        self.resultset = RaceResultSet('1', items)
+
+    def test_summary_stats(self):
+        self.assertEquals(self.resultset.winning_time, 100)
+        self.assertEquals(self.resultset.avg_time, 117)
+        self.assertEquals(self.resultset.num_finishers, 4)
+        self.assertEquals(self.resultset.percentile(50), 120.)
+
+    def test_positions(self):
+        self.assertEquals(self.resultset.position_of('fred'), 2)
+        self.assertRaises(KeyError, self.resultset.position_of, 'bob')
+        self.assertEquals(list(self.resultset.rank([100, 110, 130, 999])),
+                          [1, 2, 3, 5])
+
+    def test_iteration(self):
+        self.assertEquals(list(self.resultset.iteritems())[1], ('geoff', 130))
+        item = list(self.resultset)[1]
+        self.assertEquals((item.position, item.name, item.club, item.time),
+                          (1, 'geoff', '', 130))
+        self.assertFalse(hasattr(item, '__dict__'))
+
+    def test_empty(self):
+        self.assertRaises(EmptyResultSet, RaceResultSet, '1', [])
+
+
+class TestRaceInfoTable(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.f = join(self.folder, 'rinfo.dat')
+        table = RaceInfoTable(self.f)
+        table.add_many([('1', RaceInfo(u'Slieve Donard', (3, 6, 2017), 4.8, 850)),
+                        ('2', RaceInfo(u'Chicken Run', (1, 4, 2017), 6.0, 300)),
+                        ('3', RaceInfo(u'Slieve Donard', (2, 6, 2016), 4.8, 850))])
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_cached_until_file_changes(self):
+        table = RaceInfoTable.cached(self.f)
+        self.assertTrue(RaceInfoTable.cached(self.f) is table)
+        self.assertTrue('2' in table)
+        self.assertFalse('4' in table)
+
+        # the table's own writes don't invalidate it
+        table.add('4', RaceInfo(u'Trunce', (5, 7, 2017), 5.0, 100))
+        self.assertTrue('4' in table)
+        self.assertTrue(RaceInfoTable.cached(self.f) is table)
+
+        with open(self.f, 'a') as f_out:
+            f_out.write('5\tNew Race\t1-8-2017\t5.0\t100\n')
+        reloaded = RaceInfoTable.cached(self.f)
+        self.assertFalse(reloaded is table)
+        self.assertEquals(reloaded['5'].date, '2017-08-01')
+
+    def test_secondary_indexes(self):
+        table = RaceInfoTable(self.f)
+        self.assertEquals(table.races_named('slieve donard'), ['1', '3'])
+        self.assertEquals(table.races_between('2017-01-01', '2017-06-03'),
+                          ['2', '1'])
+        table.add('4', RaceInfo(u'Slieve Donard', (1, 6, 2018), 4.8, 850))
+        self.assertEquals(table.races_named('Slieve Donard'), ['1', '3', '4'])
+        self.assertEquals(table.races_between('2017-06-01', '2018-12-31'),
+                          ['1', '4'])
+
+
+class TestDataFolderCache(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = make_data_folder()
+        self.data_folder = DataFolder(self.folder)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_tables_are_loaded_once(self):
+        index = self.data_folder.result_to_race_index
+        self.assertTrue(self.data_folder.result_to_race_index is index)
+        self.assertTrue(self.data_folder.raceinfo is self.data_folder.raceinfo)
+        self.assertEquals(
+            self.data_folder.cache_info()['result_to_race_index.dat'],
+            {'hits': 1, 'misses': 1, 'reloads': 0})
+
+    def test_reloads_changed_files(self):
+        self.data_folder.write_race_theta(['111', '222'], [1.0, 1.5])
+        self.assertEquals(self.data_folder.read_race_theta(),
+                          {'111': 1.0, '222': 1.5})
+        self.data_folder.read_race_theta()
+
+        self.data_folder.write_race_theta(['111', '222', '333'],
+                                          [1.0, 1.5, 2.0])
+        self.assertEquals(self.data_folder.read_race_theta()['333'], 2.0)
+        self.assertEquals(self.data_folder.cache_info()['race_theta.out'],
+                          {'hits': 1, 'misses': 1, 'reloads': 1})
+
+    def test_missing_file(self):
+        self.assertRaises(IOError, self.data_folder.read_runner_theta)
+
+
+class TestFitSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = make_data_folder()
+        self.data_folder = DataFolder(self.folder)
+        self.data_folder.write_fit(['111', '222'], ['dave', 'geoff'],
+                                   [1.0, 1.0 / 3], [0.1234567891, 2.0],
+                                   [600., 700.], [0.01, 0.02], [0.03, 0.0],
+                                   [2, 1], meta={'J': 0.5})
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_round_trip(self):
+        fit = self.data_folder.read_fit()
+        self.assertEquals(fit.meta, {'J': 0.5})
+        self.assertEquals(list(fit['runner_num_races']), [2, 1])
+        self.assertEquals(fit.strings('runners').strings(), ['dave', 'geoff'])
+        # no precision lost to %f formatting
+        self.assertEquals(self.data_folder.read_race_theta()['222'], 1.0 / 3)
+        self.assertEquals(self.data_folder.read_runner_theta()['dave'],
+                          0.1234567891)
+        self.assertEquals(self.data_folder.read_winning_times(),
+                          {'111': 600., '222': 700.})
+
+    def test_write_tsvs(self):
+        self.data_folder.write_fit_tsvs()
+        race_theta = data.read_theta_file(join(self.folder, 'race_theta.out'))
+        self.assertAlmostEqual(race_theta['222'], 1.0 / 3, places=6)
+        with open(join(self.folder, 'runner_errors.out')) as f_in:
+            self.assertEquals(next(f_in), 'name\tmean_err2\tnum_points\n')
+            self.assertEquals(next(f_in), 'dave\t0.030000\t2\n')
+
+    def test_rejects_other_files(self):
+        f = join(self.folder, 'rinfo.dat')
+        self.assertRaises(snapshot.SnapshotError, snapshot.Snapshot, f)
+
+
+class TestParseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.results = join(self.folder, 'results')
+        shutil.copytree(join(TEST_PAGES, 'results'), self.results)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_file_parsed_once(self):
+        cache = parse_cache.ParseCache()
+        results_folder = ResultsFolder(self.results, cache)
+        race_csv = results_folder['111']
+        self.assertEquals(race_csv.process(), {'geoff': 1, 'dave': 1})
+        self.assertEquals(list(race_csv.runner_names()), ['Geoff', 'Dave'])
+        self.assertEquals(results_folder.get_resultset('111').winning_time, 1)
+        self.assertEquals((cache.misses, cache.hits), (1, 2))
+
+        with open(join(self.results, '111.csv'), 'a') as f_out:
+            f_out.write('Fred,,,0:00:03\n')
+        self.assertEquals(race_csv.process()['fred'], 3)
+        self.assertEquals(cache.misses, 2)
+
+    def test_evicts_least_recently_used(self):
+        cache = parse_cache.ParseCache(max_bytes=1)
+        results_folder = ResultsFolder(self.results, cache)
+        for result_id in ('111', '222', '111'):
+            results_folder[result_id].process()
+        self.assertEquals(len(cache), 1)
+        self.assertEquals(cache.stats()['evictions'], 2)
+        self.assertEquals(cache.misses, 3)
+
+    def test_shared_between_threads(self):
+        cache = parse_cache.ParseCache()
+        fs = [join(self.results, name) for name in os.listdir(self.results)]
+        budget = sum(parse_cache.ParsedFile(open(f).read()).nbytes
+                     for f in fs[:2])
+        cache.max_bytes = budget
+        errors = []
+
+        def worker(seed):
+            rng = random.Random(seed)
+            try:
+                for _ in xrange(300):
+                    cache.get(rng.choice(fs))
+                    if rng.random() < 0.01:
+                        cache.clear()
+            except Exception as e:
+                errors.append(e)
+
+        # switch threads as often as possible to shake out races
+        check_interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        try:
+            threads = [threading.Thread(target=worker, args=(i,))
+                       for i in xrange(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setcheckinterval(check_interval)
+        self.assertEquals(errors, [])
+        stats = cache.stats()
+        self.assertEquals(stats['hits'] + stats['misses'], 8 * 300)
+        self.assertEquals(stats['bytes'],
+                          sum(nbytes for _, nbytes in cache._entries.values()))
+        self.assertTrue(stats['bytes'] <= budget)
+
+
+class TestStreamingRead(unittest.TestCase):
+
+    def test_iter_rows_matches_parse(self):
+        f = join(TEST_PAGES, '100.csv')
+        race_csv = RaceCsv(f)
+        self.assertEquals(list(race_csv.iter_rows()),
+                          list(race_csv.data_rows()))
+        with open(f) as f_in:
+            rows = list(ft.iter_results_rows(f_in, chunk_lines=7))
+        self.assertEquals(rows, list(ft.read_results_file(f)))
+
+    def test_precompress(self):
+        folder = tempfile.mkdtemp()
+        try:
+            results = join(folder, 'results')
+            shutil.copytree(join(TEST_PAGES, 'results'), results)
+            result_folder = ResultsFolder(results)
+            self.assertEquals(result_folder.gzip_path('111'), None)
+            self.assertEquals(result_folder.precompress(min_size=0), 3)
+            self.assertEquals(result_folder.precompress(min_size=0), 0)
+
+            gz_f = result_folder.gzip_path('111')
+            with open(join(results, '111.csv')) as f_in:
+                self.assertEquals(gzip.open(gz_f).read(), f_in.read())
+
+            # an edited file isn't served from its old copy
+            os.utime(join(results, '111.csv'), (0, 2e9))
+            self.assertEquals(result_folder.gzip_path('111'), None)
+            self.assertEquals(result_folder.precompress(min_size=0), 1)
+        finally:
+            shutil.rmtree(folder)
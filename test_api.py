@@ -0,0 +1,209 @@
+import gzip
+import json
+import os
+import StringIO
+import kcourse.parse_cache as parse_cache
+from kcourse.api import make_app
+from kcourse.data import ResultsFolder
+
+from os.path import join
+
+from test_runner_index import RunnerIndexTestCase
+
+
+class ApiTestCase(RunnerIndexTestCase):
+    """
+    An API test client over the test_pages fit.
+    """
+
+    def setUp(self):
+        super(ApiTestCase, self).setUp()
+        self.client = make_app(self.folder, self.results,
+                               background=False).test_client()
+
+    def get_json(self, url):
+        response = self.client.get(url)
+        self.assertEquals(response.status_code, 200)
+        return json.loads(response.data)
+
+
+class TestSearchApi(ApiTestCase):
+
+    def test_search(self):
+        data = self.get_json('/api/search?q=Geo')
+        self.assertEquals(data['query'], 'geo')
+        self.assertEquals(data['mode'], 'search')
+        self.assertEquals([m['runner'] for m in data['matches']], ['geoff'])
+        match = data['matches'][0]
+        self.assertEquals(match['races'], 3)
+        self.assertEquals(match['score'], 1.)
+        self.assertEquals(self.client.get(match['url']).status_code, 200)
+
+        data = self.get_json('/api/search?q=jeoff&mode=fuzzy')
+        self.assertEquals([m['runner'] for m in data['matches']], ['geoff'])
+
+    def test_bad_queries(self):
+        for url in ('/api/search', '/api/search?q=', '/api/search?q=%20%20',
+                    '/api/search?q=g', '/api/search?q=geoff&mode=exact'):
+            self.assertEquals(self.client.get(url).status_code, 400, url)
+
+    def test_limit(self):
+        data = self.get_json('/api/search?q=dave%20geoff&mode=fuzzy&limit=1')
+        self.assertEquals(len(data['matches']), 1)
+        data = self.get_json('/api/search?q=dave%20geoff&mode=fuzzy&limit=0')
+        self.assertEquals(len(data['matches']), 1)
+        data = self.get_json('/api/search?q=dave%20geoff&mode=fuzzy&limit=x')
+        self.assertEquals(len(data['matches']), 2)
+
+    def test_unicode(self):
+        data = self.get_json(u'/api/search?q=Geoff\xc9'.encode('utf-8'))
+        self.assertEquals(data['query'], u'geoff\xe9')
+        self.assertEquals([m['runner'] for m in data['matches']], ['geoff'])
+        data = self.get_json(u'/api/search?q=\u00e9\u00e9'.encode('utf-8'))
+        self.assertEquals(data['matches'], [])
+
+
+class TestResultsApi(ApiTestCase):
+
+    def setUp(self):
+        super(TestResultsApi, self).setUp()
+        self.url = '/api/results/111'
+        with open(join(self.results, '111.csv')) as f_in:
+            self.csv = f_in.read()
+
+    def test_download(self):
+        response = self.client.get(self.url)
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.data, self.csv)
+        self.assertEquals(response.mimetype, 'text/csv')
+        self.assertEquals(response.headers['Content-Disposition'],
+                          'attachment; filename=111.csv')
+        self.assertTrue(response.headers['ETag'])
+        self.assertTrue(response.headers['Last-Modified'])
+        self.assertEquals(response.headers.get('Content-Encoding'), None)
+        self.assertEquals(self.client.get('/api/results/999').status_code, 404)
+
+    def test_not_modified(self):
+        response = self.client.get(self.url)
+        for headers in ({'If-None-Match': response.headers['ETag']},
+                        {'If-Modified-Since': response.headers['Last-Modified']}):
+            cached = self.client.get(self.url, headers=headers)
+            self.assertEquals(cached.status_code, 304)
+            self.assertEquals(cached.data, '')
+
+        # an edited file is sent again
+        os.utime(join(self.results, '111.csv'), (0, 2e9))
+        response2 = self.client.get(
+            self.url, headers={'If-None-Match': response.headers['ETag']})
+        self.assertEquals(response2.status_code, 200)
+
+    def test_ranges(self):
+        response = self.client.get(self.url, headers={'Range': 'bytes=5-14'})
+        self.assertEquals(response.status_code, 206)
+        self.assertEquals(response.data, self.csv[5:15])
+        self.assertEquals(response.headers['Content-Range'],
+                          'bytes 5-14/%i' % len(self.csv))
+
+        response = self.client.get(
+            self.url, headers={'Range': 'bytes=%i-' % (len(self.csv) + 10)})
+        self.assertEquals(response.status_code, 416)
+
+    def test_gzip(self):
+        result_folder = ResultsFolder(self.results)
+        result_folder.precompress(min_size=0)
+        headers = {'Accept-Encoding': 'gzip'}
+        response = self.client.get(self.url, headers=headers)
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.headers['Content-Encoding'], 'gzip')
+        self.assertTrue('Accept-Encoding' in response.headers['Vary'])
+        self.assertEquals(gzip.GzipFile(fileobj=StringIO.StringIO(
+            response.data)).read(), self.csv)
+
+        plain = self.client.get(self.url)
+        self.assertEquals(plain.headers.get('Content-Encoding'), None)
+        self.assertNotEquals(plain.headers['ETag'], response.headers['ETag'])
+        refused = self.client.get(self.url,
+                                  headers={'Accept-Encoding': 'gzip;q=0'})
+        self.assertEquals(refused.headers.get('Content-Encoding'), None)
+
+        # a stale compressed copy isn't served
+        os.utime(join(self.results, '111.csv'), (0, 2e9))
+        response = self.client.get(self.url, headers=headers)
+        self.assertEquals(response.headers.get('Content-Encoding'), None)
+        self.assertEquals(response.data, self.csv)
+
+
+class TestBatchApi(ApiTestCase):
+
+    def test_runners(self):
+        data = self.get_json('/api/runners?name=Dave&name=nobody&name=geoff')
+        self.assertEquals([r['runner'] for r in data['runners']],
+                          ['Dave', 'geoff'])
+        self.assertEquals(data['missing'], ['nobody'])
+        self.assertEquals(len(data['runners'][0]['results']), 3)
+
+        response = self.client.post('/api/runners', content_type='application/json',
+                                    data=json.dumps({'names': ['dave']}))
+        self.assertEquals(len(json.loads(response.data)['runners']), 1)
+        self.assertEquals(self.client.get('/api/runners').status_code, 400)
+        self.assertEquals(self.client.get('/api/runners/nobody').status_code,
+                          404)
+
+    def test_races(self):
+        data = self.get_json('/api/races?id=AAA&id=CCC&id=ZZZ')
+        self.assertEquals([r['id'] for r in data['races']], ['AAA', 'CCC'])
+        self.assertEquals(data['races'][0]['result_id'], '111')
+        self.assertEquals(data['missing'], ['ZZZ'])
+
+    def test_race_results_pages(self):
+        data = self.get_json('/api/races/AAA/results?limit=1')
+        self.assertEquals(data['finishers'], 2)
+        self.assertEquals(data['results'][0]['runner'], 'geoff')
+        self.assertEquals(data['results'][0]['score'], 1.)
+        data = self.get_json(data['next'])
+        self.assertEquals(data['results'][0]['runner'], 'dave')
+        self.assertEquals(data['next'], None)
+        self.assertEquals(self.client.get('/api/races/ZZZ/results').status_code,
+                          404)
+
+    def test_race_results_served_from_store(self):
+        misses = parse_cache.PARSE_CACHE.misses
+        data = self.get_json('/api/races/AAA/results?offset=1')
+        self.assertEquals([(r['position'], r['runner'], r['time'])
+                           for r in data['results']], [(1, 'dave', 1)])
+        self.assertEquals(data['results'][0]['score'], 1.)
+        self.assertEquals(parse_cache.PARSE_CACHE.misses, misses)
+
+        # the page comes from the compiled rows, not the csv file
+        os.remove(join(self.results, '111.csv'))
+        data = self.get_json('/api/races/AAA/results')
+        self.assertEquals([r['runner'] for r in data['results']],
+                          ['geoff', 'dave'])
+
+
+class TestStatusApi(RunnerIndexTestCase):
+
+    def test_status_endpoint_and_hot_swap(self):
+        app = make_app(self.folder, self.results, background=False)
+        client = app.test_client()
+        status = json.loads(client.get('/api/status').data)['runner_index']
+        self.assertEquals(status['version'], 1)
+        self.assertEquals(status['runners'], 2)
+        self.assertFalse(status['stale'])
+        self.assertEquals(client.get('/api/runners/fred').status_code, 404)
+
+        with open(join(self.results, '222.csv'), 'a') as f_out:
+            f_out.write('Fred,,,0:00:03\n')
+        os.utime(join(self.results, '222.csv'), (0, 2e9))
+        status = json.loads(client.get('/api/status').data)['runner_index']
+        self.assertTrue(status['stale'])
+        # still served from the old index until the rebuild swaps in
+        self.assertEquals(client.get('/api/runners/fred').status_code, 404)
+
+        self.assertTrue(app.runner_index.refresh())
+        status = json.loads(client.get('/api/status').data)['runner_index']
+        self.assertEquals(status['version'], 2)
+        self.assertEquals(status['runners'], 3)
+        self.assertFalse(status['stale'])
+        data = json.loads(client.get('/api/runners/fred').data)
+        self.assertEquals(data['results'][0]['time'], 3)
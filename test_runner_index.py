@@ -0,0 +1,161 @@
+import os
+import shutil
+import time
+import unittest
+import kcourse.runner_index as runner_index
+from kcourse.data import DataFolder, ResultsFolder
+from kcourse.domain import RunnerRacePerformance
+from scripts.runner_lookup import build_runner_index
+
+from os.path import join
+
+from test_analysis import TEST_PAGES, make_data_folder
+
+
+class RunnerIndexTestCase(unittest.TestCase):
+    """
+    A fit of the test_pages results in a temporary data folder.
+    """
+
+    def setUp(self):
+        self.folder = make_data_folder()
+        self.data_folder = DataFolder(self.folder)
+        self.results = join(self.folder, 'results')
+        shutil.copytree(join(TEST_PAGES, 'results'), self.results)
+        self.data_folder.write_fit(['111', '222', '333'], ['dave', 'geoff'],
+                                   [1., 2., 3.], [1., 1.], [1., 1., 1.],
+                                   [0., 0., 0.], [0., 0.], [3, 3])
+        self.n_builds = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def build(self, data_folder, result_folder):
+        self.n_builds += 1
+        return build_runner_index(data_folder, result_folder)
+
+
+class TestRunnerIndexSnapshot(RunnerIndexTestCase):
+
+    def test_matches_built_index(self):
+        result_folder = ResultsFolder(self.results)
+        expected = build_runner_index(self.data_folder, result_folder)
+        index = runner_index.open_runner_index(self.data_folder,
+                                               result_folder, self.build)
+        self.assertEquals(sorted(index), sorted(expected))
+        for name in expected:
+            self.assertEquals([p.to_json() for p in index[name]],
+                              [p.to_json() for p in expected[name]])
+        self.assertFalse('nobody' in index)
+        self.assertEquals(index.get('nobody', []), [])
+
+    def test_rebuilt_when_sources_change(self):
+        result_folder = ResultsFolder(self.results)
+        runner_index.open_runner_index(self.data_folder, result_folder,
+                                       self.build)
+        runner_index.open_runner_index(self.data_folder, result_folder,
+                                       self.build)
+        self.assertEquals(self.n_builds, 1)
+
+        with open(join(self.results, '222.csv'), 'a') as f_out:
+            f_out.write('Fred,,,0:00:03\n')
+        os.utime(join(self.results, '222.csv'), (0, 2e9))
+        index = runner_index.open_runner_index(self.data_folder,
+                                               result_folder, self.build)
+        self.assertEquals(self.n_builds, 2)
+        self.assertEquals(index['fred'][0].time, 3)
+
+    def test_search(self):
+        perf = RunnerRacePerformance('1', 'AAA', 'Race A', '1-1-2017', 10, 1.)
+        f = join(self.folder, 'search.snap')
+        runner_index.write_runner_index(f, {
+            'john smith': [perf] * 3, 'jon smith': [perf],
+            'john smyth': [perf] * 2, 'jane doe': [perf]})
+        index = runner_index.RunnerIndex(f)
+
+        self.assertEquals(index.prefix_search('joh'),
+                          [('john smith', 3, 1.), ('john smyth', 2, 1.)])
+        self.assertEquals(index.prefix_search('joh', limit=1),
+                          [('john smith', 3, 1.)])
+        self.assertEquals(index.prefix_search('x'), [])
+
+        fuzzy = index.fuzzy_search('jon smyth')
+        self.assertEquals([m[0] for m in fuzzy[:2]],
+                          ['john smyth', 'jon smith'])
+        self.assertTrue(all(0 < m[2] < 1 for m in fuzzy))
+        self.assertFalse('jane doe' in [m[0] for m in fuzzy])
+        self.assertEquals(index.fuzzy_search('zzz'), [])
+
+        # prefix matches come first, then fuzzy ones
+        matches = index.search('jon smit', limit=3)
+        self.assertEquals(matches[0], ('jon smith', 1, 1.))
+        self.assertEquals([m[0] for m in matches], ['jon smith', 'john smith'])
+
+
+class TestLiveRunnerIndex(RunnerIndexTestCase):
+
+    def test_serves_stale_index_until_refreshed(self):
+        live = runner_index.LiveRunnerIndex(self.folder, self.results,
+                                            self.build)
+        self.assertEquals(live.version, 0)
+        self.assertEquals(live.get('fred', []), [])
+        self.assertTrue(live.refresh())
+        self.assertFalse(live.refresh())
+        self.assertEquals(self.n_builds, 1)
+        self.assertEquals(live.version, 1)
+
+        with open(join(self.results, '222.csv'), 'a') as f_out:
+            f_out.write('Fred,,,0:00:03\n')
+        os.utime(join(self.results, '222.csv'), (0, 2e9))
+        # a new server picks up the old snapshot straight away
+        live = runner_index.LiveRunnerIndex(self.folder, self.results,
+                                            self.build)
+        self.assertEquals(live.version, 1)
+        self.assertTrue(live.status()['stale'])
+        self.assertFalse('fred' in live)
+
+        self.assertTrue(live.refresh())
+        status = live.status()
+        self.assertEquals(status['version'], 2)
+        self.assertFalse(status['stale'])
+        self.assertTrue(status['build_time'] >= 0)
+        self.assertEquals(live.get('fred')[0].time, 3)
+
+    def test_result_added_after_fit(self):
+        live = runner_index.LiveRunnerIndex(self.folder, self.results,
+                                            self.build)
+        self.assertTrue(live.refresh())
+
+        # a new race and results, which the fit hasn't seen yet
+        with open(join(self.results, '444.csv'), 'w') as f_out:
+            f_out.write('name,club,category,time\nFred,,,0:00:05\n'
+                        'Dave,,,0:00:06\n')
+        with open(join(self.folder, 'result_to_race_index.dat'), 'a') as f_out:
+            f_out.write('444\tDDD\n')
+        with open(join(self.folder, 'rinfo.dat'), 'a') as f_out:
+            f_out.write('DDD\tRace D\t4-4-2017\t4.0\t4.0\n')
+        os.utime(join(self.results, '444.csv'), (0, 2e9))
+
+        self.assertTrue(live.refresh())
+        status = live.status()
+        self.assertEquals(status['version'], 2)
+        self.assertFalse(status['stale'])
+        fred = live.get('fred')
+        self.assertEquals([(p.result_id, p.time, p.score) for p in fred],
+                          [('444', 5, None)])
+        self.assertEquals([p.score is None for p in live.get('dave')],
+                          [False, False, False, True])
+
+    def test_background_refresh(self):
+        live = runner_index.LiveRunnerIndex(self.folder, self.results,
+                                            self.build, check_interval=0.01)
+        live.start()
+        try:
+            for _ in xrange(500):
+                if live.version:
+                    break
+                time.sleep(0.01)
+        finally:
+            live.stop()
+        self.assertEquals(live.version, 1)
+        self.assertEquals(live.status()['last_error'], None)